@@ -0,0 +1,698 @@
+#!/usr/bin/env python
+
+"""
+Benchmark riproducibile della catena fuoco prescritto e dell'indice di Haines.
+
+Gli input vengono generati in una cartella di lavoro con un seme fisso:
+ - modello GrADS .gra + .ctl (tmpsfc, apcpsfc, rhsfc, wind10m, 3 tempi)
+ - indici di rischio modello_Rdmc_RunN / modello_Rfff_RunN (.rst)
+ - pioggia giornaliera toscana_Prec_dem1000_1_1_263_239_<data>.rst per la finestra
+ - GRIB2 con temperatura e umidita' specifica a 950/850/700/500 hPa e orografia
+
+Il caso haines_kernel confronta tempi e risultati del kernel Haines con le formule degli script.
+Il caso datacube aggiunge al cubo NetCDF slice a passo di 3 ore e verifica che ogni tempo
+abbia la sua slice (richiede netCDF4, altrimenti viene saltato).
+Ogni caso gira in un processo separato (picco RSS del solo caso) e viene ripetuto -n volte.
+Le fasi vengono misurate con stage_metrics; per ogni fase si riportano tempo minimo,
+pixel/s e picco di memoria.
+
+Ogni caso scrive i prodotti in una propria cartella. I raster di ogni caso vengono confrontati
+con quelli del suo percorso di riferimento (fuoco_prescritto con fuoco_prescritto_legacy,
+haines_all_stream e haines_all_parallel con haines_all) e con i risultati di riferimento
+salvati in benchmark_golden.json per la configurazione. Differenze o risultati di riferimento
+mancanti fanno terminare il benchmark con errore; --update-golden li rigenera dai percorsi
+di riferimento (che devono essere fra i casi eseguiti).
+
+benchmark.py -o <workdir> [--model 267x201] [--risk 267x200] [--prec 239x263] [--grib 120x80]
+             [--times 4] [-w <window>] [-n <repeat>] [--seed <n>] [--report <file.json>] [--update-golden]
+"""
+
+import os
+import sys
+import getopt
+import glob
+import json
+import hashlib
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from osgeo import gdal
+from datetime import timedelta, datetime
+import time
+start_time = time.time()
+
+import stage_metrics
+
+golden_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_golden.json')
+
+"""Tolleranza relativa per i raster in virgola mobile"""
+golden_rtol = 1e-6
+
+"""Tolleranza (C) del kernel float32 rispetto alle formule float64 degli script"""
+kernel_atol = 1e-3
+
+bench_day = '2024-07-10'
+bench_model = 'incendi_arw_bench_run00'
+bench_ref_time = datetime(2024, 7, 10, 0, 0)
+haines_levels = (950, 850, 700, 500)
+"""Processi del caso haines_all_parallel"""
+bench_workers = min(4, os.cpu_count())
+
+"""Caso -> percorso di riferimento che deve dare gli stessi prodotti"""
+reference_cases = {
+    'fuoco_prescritto': 'fuoco_prescritto_legacy',
+    'haines_all_stream': 'haines_all',
+    'haines_all_parallel': 'haines_all'
+}
+
+haines_types = {
+    'low': {'sup': 950, 'inf': 850},
+    'mid': {'sup': 850, 'inf': 700},
+    'high': {'sup': 700, 'inf': 500}
+}
+
+
+def parse_grid(value):
+    """<colonne>x<righe>"""
+    [cols, rows] = value.lower().split('x')
+    return [int(cols), int(rows)]
+
+
+def config_key(config):
+    return 'model{0}x{1}_risk{2}x{3}_prec{4}x{5}_grib{6}x{7}_t{8}_w{9}_seed{10}'.format(
+        config['model'][0], config['model'][1],
+        config['risk'][0], config['risk'][1],
+        config['prec'][0], config['prec'][1],
+        config['grib'][0], config['grib'][1],
+        config['times'], config['window'], config['seed'])
+
+
+"""
+Generazione degli input sintetici
+"""
+def smooth_field(rng, rows, cols, mean, amplitude, noise):
+    """Campo con un gradiente nord-sud, un'onda est-ovest e rumore"""
+    y = np.linspace(0, 1, rows, dtype=np.float32)[:, None]
+    x = np.linspace(0, 2 * np.pi, cols, dtype=np.float32)[None, :]
+    field = mean + amplitude * (y - 0.5) + 0.5 * amplitude * np.sin(x * 3)
+    return (field + rng.normal(0, noise, (rows, cols))).astype(np.float32)
+
+
+def write_raster(filename, array, geotransform, projection, driver_name='RST'):
+    [rows, cols] = array.shape
+    dataset = gdal.GetDriverByName(driver_name).Create(filename, cols, rows, 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(projection)
+    dataset.GetRasterBand(1).WriteArray(array)
+    dataset = None
+
+
+def write_model(directory, cols, rows, rng, fp):
+    """GrADS .gra + .ctl sulla griglia 0.03 gradi con origine (8, 40) come il modello operativo"""
+    modello = os.path.join(directory, bench_model)
+    ntimes = 3
+    data = np.empty((ntimes, 4, rows, cols), dtype=np.float32)
+    for t in range(ntimes):
+        data[t, 0] = smooth_field(rng, rows, cols, 14 + t, 16, 3)
+        data[t, 1] = np.maximum(rng.gamma(0.4, 4, (rows, cols)), 0)
+        data[t, 2] = np.clip(smooth_field(rng, rows, cols, 65, 40, 10), 5, 100)
+        data[t, 3] = np.abs(smooth_field(rng, rows, cols, 3, 4, 1.5))
+    data.tofile(modello + '.gra')
+
+    model_geotransform = fp.get_geotransform('model')
+    with open(modello + '.ctl', 'w') as f:
+        f.write('dset ^' + bench_model + '.gra\n')
+        f.write('undef 9.999E+20\n')
+        f.write('title Synthetic Model Data for Fire\n')
+        f.write('xdef {0} LINEAR {1} {2}\n'.format(cols, model_geotransform[0], model_geotransform[1]))
+        f.write('ydef {0} LINEAR {1} {2}\n'.format(rows, model_geotransform[3], model_geotransform[5]))
+        f.write('zdef 1 levels 1000\n')
+        f.write('tdef {0} linear 00Z{1} 1dy\n'.format(ntimes, bench_ref_time.strftime('%d%b%Y').upper()))
+        f.write('vars 4\n')
+        f.write('tmpsfc 0 11,1,0 ** Mean Daily T2m [C]\n')
+        f.write('apcpsfc 0 61,1,0 ** Total Daily precipitation [kg/m^2]\n')
+        f.write('rhsfc 0 52,1,0 ** Mean Daily 2m Relative Humidity [%]\n')
+        f.write('wind10m 0 32,105,10 ** Mean Daily 10 m Wind Velocity [m/s]\n')
+        f.write('endvars\n')
+    return modello
+
+
+def write_risk(directory, cols, rows, rng, fp):
+    for i in range(3):
+        ffmc = np.clip(smooth_field(rng, rows, cols, 82, 20, 4), 0, 101)
+        dmc = np.clip(smooth_field(rng, rows, cols, 18, 30, 5), 0, None)
+        for prefix, array in (('modello_Rfff_', ffmc), ('modello_Rdmc_', dmc)):
+            write_raster(
+                fp.risk_filename(directory, prefix, 'Run' + str(i), bench_day),
+                array,
+                fp.get_geotransform('rst'),
+                fp.wkt_projection)
+
+
+def write_prec(fp, cols, rows, finestra, rng):
+    """Pioggia giornaliera dei <finestra> giorni che precedono bench_day (circa 60% di giorni secchi)"""
+    os.makedirs(fp.metout_directory, exist_ok=True)
+    end_date = datetime.strptime(bench_day, "%Y-%m-%d").date() - timedelta(days=1)
+    for n in range(finestra):
+        prec_date = (end_date - timedelta(days=n)).strftime("%Y-%m-%d")
+        prec = rng.gamma(0.5, 8, (rows, cols)).astype(np.float32)
+        prec[rng.random((rows, cols)) < 0.6] = 0
+        write_raster(fp.prec_filename(prec_date), prec, fp.get_geotransform('prec'), fp.wkt_projection_prec)
+
+
+def grib_band_options(band, category, number, forecast_hours, surface, value):
+    """Opzioni GRIB2 (template 4.0) di una banda"""
+    prefix = 'BAND_' + str(band) + '_'
+    return [
+        prefix + 'DISCIPLINE=0',
+        prefix + 'PDS_PDTN=0',
+        prefix + 'PDS_TEMPLATE_ASSEMBLED_VALUES=' + ' '.join(str(v) for v in (
+            category, number, 2, 0, 0, 0, 0, 1, forecast_hours, surface, 0, value, 255, 0, 0))
+    ]
+
+
+def write_grib(filename, cols, rows, ntimes, rng, projection):
+    """
+    GRIB2 multi-livello: per ogni tempo orografia (0-SFC) e temperatura/umidita'
+    specifica sui livelli isobarici (<livello>00-ISBL), passo 6 ore
+    """
+    bands = []
+    for t in range(ntimes):
+        hours = 6 * t
+        bands.append(('orography', None, hours))
+        for level in haines_levels:
+            bands.append(('temperature', level, hours))
+            bands.append(('humidity', level, hours))
+
+    dataset = gdal.GetDriverByName('MEM').Create('', cols, rows, len(bands), gdal.GDT_Float32)
+    dataset.SetGeoTransform([5.0, 8.0 / cols, 0, 46.0, 0, -5.0 / rows])
+    dataset.SetProjection(projection)
+
+    orography = np.clip(smooth_field(rng, rows, cols, 500, 1600, 150), 0, None) * 9.80665
+    surface_temperature = {950: 24, 850: 16, 700: 6, 500: -12}
+    options = [
+        'IDS_CENTER=98',
+        'IDS_SUBCENTER=0',
+        'IDS_MASTER_TABLE=2',
+        'IDS_SIGNF_REF_TIME=1',
+        'IDS_REF_TIME=' + bench_ref_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'IDS_PROD_STATUS=0',
+        'IDS_TYPE=1',
+        'DATA_ENCODING=SIMPLE_PACKING',
+        'INPUT_UNIT=C'
+    ]
+    for n, [name, level, hours] in enumerate(bands):
+        band = n + 1
+        if name == 'orography':
+            array = orography
+            options += grib_band_options(band, 3, 4, hours, 1, 0)
+        elif name == 'temperature':
+            array = smooth_field(rng, rows, cols, surface_temperature[level] + 0.2 * hours, 10, 1.5)
+            options += grib_band_options(band, 0, 0, hours, 100, level * 100)
+        else:
+            array = np.clip(smooth_field(rng, rows, cols, 0.012 * level / 1000.0, 0.008, 0.001), 1e-5, None)
+            options += grib_band_options(band, 1, 0, hours, 100, level * 100)
+        dataset.GetRasterBand(band).WriteArray(array)
+
+    gdal.GetDriverByName('GRIB').CreateCopy(filename, dataset, options=options)
+    dataset = None
+
+
+def make_fixtures(workdir, config):
+    """Genero tutti gli input nella cartella di lavoro (sempre uguali a parita' di configurazione)"""
+    import calc_fuoco_prescritto as fp
+    configure_fire(fp, workdir, config)
+    rng = np.random.default_rng(config['seed'])
+
+    os.makedirs(os.path.join(workdir, 'model'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'rischio'), exist_ok=True)
+    write_model(os.path.join(workdir, 'model'), config['model'][0], config['model'][1], rng, fp)
+    write_risk(os.path.join(workdir, 'rischio'), config['risk'][0], config['risk'][1], rng, fp)
+    write_prec(fp, config['prec'][0], config['prec'][1], config['window'], rng)
+
+    os.makedirs(os.path.join(workdir, 'haines'), exist_ok=True)
+    write_grib(os.path.join(workdir, 'haines', 'ecm.0p10.run00.grb'), config['grib'][0], config['grib'][1], config['times'], rng, fp.wkt_projection)
+
+
+"""
+Casi del benchmark (ognuno in un processo separato)
+"""
+def case_directory(workdir, case):
+    """Cartella dei prodotti del caso"""
+    if case.startswith('haines'):
+        return os.path.join(workdir, 'haines', case)
+    return os.path.join(workdir, 'output', case)
+
+
+def configure_fire(fp, workdir, config, case=None):
+    """Sostituisco i percorsi operativi e le dimensioni delle griglie con quelli del benchmark"""
+    fp.cache_directory = os.path.join(workdir, 'cache') + '/'
+    fp.stage_cache_directory = fp.cache_directory + 'stages/'
+    fp.checkpoint_directory = fp.cache_directory + 'checkpoint/'
+    fp.output_directory = (case_directory(workdir, case) if case else os.path.join(workdir, 'output')) + '/'
+    fp.metout_directory = os.path.join(workdir, 'metout') + '/'
+    fp.prec_cube_directory = fp.metout_directory + 'prec_cube/'
+    fp.log_directory = os.path.join(workdir, 'log') + '/'
+    [fp.nlon, fp.nlat] = config['model']
+    [fp.prec_ncols, fp.prec_nrows] = config['prec']
+    """Il benchmark misura il calcolo: niente cache dei risultati delle fasi"""
+    fp.stage_cache_enabled = False
+    for directory in (fp.cache_directory, fp.output_directory, fp.log_directory):
+        os.makedirs(directory, exist_ok=True)
+
+
+def run_case(args):
+    """Eseguo un caso e restituisco (misure delle fasi, secondi, picco RSS)"""
+    [case, workdir, config] = args
+    stage_metrics.pop_records()
+    start = time.time()
+
+    if case in ('fuoco_prescritto', 'fuoco_prescritto_legacy'):
+        import calc_fuoco_prescritto as fp
+        configure_fire(fp, workdir, config, case)
+        """Le tabelle di riproiezione sono preparate una volta sola, come in esercizio"""
+        fp.load_warp_tables()
+        error = fp.process_day(
+            bench_day,
+            os.path.join(workdir, 'model', bench_model),
+            os.path.join(workdir, 'rischio'),
+            case == 'fuoco_prescritto',
+            config['window'],
+            False,
+            None,
+            0
+        )
+        if error is not None:
+            raise RuntimeError('{0}: {1}'.format(error[0], error[1]))
+    else:
+        """Gli script Haines leggono ../ecm.0p10.run00.grb e scrivono in haines_images*/ del caso"""
+        os.makedirs(case_directory(workdir, case), exist_ok=True)
+        os.chdir(case_directory(workdir, case))
+        for directory in ('haines_images', 'haines_images_all'):
+            os.makedirs(directory, exist_ok=True)
+        if case in ('haines_all', 'haines_all_stream', 'haines_all_parallel'):
+            import haines_index_calc_all
+            haines_index_calc_all.streaming = case == 'haines_all_stream'
+            haines_index_calc_all.workers = bench_workers if case == 'haines_all_parallel' else 1
+            haines_index_calc_all.haines_index_calc(haines_types)
+        else:
+            import haines_index_calc
+            haines_index_calc.haines_index_calc(case[len('haines_'):])
+
+    return {
+        'records': stage_metrics.pop_records(),
+        'seconds': time.time() - start,
+        'peak_rss_bytes': stage_metrics.peak_rss()
+    }
+
+
+def run_isolated(case, workdir, config):
+    """Processo nuovo per ogni esecuzione; non daemon, perche' haines_all_parallel avvia i suoi worker"""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run_case, (case, workdir, config)).result()
+
+
+def stage_pixels(case, stage, config):
+    """Pixel elaborati per ogni esecuzione della fase (per il calcolo dei pixel/s)"""
+    model_pixels = config['model'][0] * config['model'][1]
+    risk_pixels = config['risk'][0] * config['risk'][1]
+    prec_pixels = config['prec'][0] * config['prec'][1]
+    grib_pixels = config['grib'][0] * config['grib'][1]
+    if case.startswith('haines'):
+        return grib_pixels
+    return {
+        'read_model': model_pixels * 9,
+        'models_threshold': model_pixels * 3,
+        'risk_threshold': risk_pixels * 2,
+        'prec_threshold': prec_pixels * config['window'],
+        'tot_threshold': prec_pixels
+    }.get(stage, prec_pixels)
+
+
+def summarize(case, results, config):
+    """Per ogni fase il tempo minimo fra le ripetizioni e i pixel/s corrispondenti"""
+    stages = {}
+    for result in results:
+        stage_metrics.add_records(result['records'])
+        for entry in stage_metrics.summary():
+            name = entry['stage'] + ''.join('[' + k + '=' + v + ']' for k, v in sorted(entry['labels'].items()))
+            best = stages.get(name)
+            if best is None or entry['seconds'] < best['seconds']:
+                pixels = stage_pixels(case, entry['stage'], config) * entry['count']
+                stages[name] = {
+                    'seconds': entry['seconds'],
+                    'count': entry['count'],
+                    'pixels_per_second': pixels / entry['seconds'] if entry['seconds'] > 0 else None,
+                    'read_bytes': entry['read_bytes'],
+                    'write_bytes': entry['write_bytes']
+                }
+        stage_metrics.pop_records()
+    return {
+        'seconds': min(result['seconds'] for result in results),
+        'peak_rss_bytes': max(result['peak_rss_bytes'] for result in results),
+        'stages': stages
+    }
+
+
+"""
+Confronto con i risultati di riferimento
+"""
+def raster_summary(filename):
+    """Impronta di un raster: hash esatto per i tipi interi, statistiche per quelli float"""
+    dataset = gdal.Open(filename)
+    array = dataset.GetRasterBand(1).ReadAsArray()
+    dataset = None
+    summary = {'shape': list(array.shape), 'dtype': str(array.dtype)}
+    if array.dtype.kind == 'f':
+        valid = array[np.isfinite(array)]
+        summary.update({
+            'mean': float(valid.mean()) if valid.size else None,
+            'min': float(valid.min()) if valid.size else None,
+            'max': float(valid.max()) if valid.size else None,
+            'nonzero': int(np.count_nonzero(valid))
+        })
+    else:
+        summary['sha1'] = hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+        summary['nonzero'] = int(np.count_nonzero(array))
+    return summary
+
+
+def collect_outputs(workdir, case):
+    """Impronte dei prodotti del caso, con nomi relativi alla sua cartella (uguali fra casi equivalenti)"""
+    directory = case_directory(workdir, case)
+    outputs = {}
+    patterns = [
+        os.path.join(directory, 'fire_presc_*.rst'),
+        os.path.join(directory, 'haines_images', 'haines_index_reclass_*'),
+        os.path.join(directory, 'haines_images_all', 'haines_index_reclass_*')
+    ]
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)):
+            if filename.endswith('.aux.xml') or filename.endswith('.rdc'):
+                continue
+            outputs[os.path.relpath(filename, directory)] = raster_summary(filename)
+    return outputs
+
+
+def compare_outputs(outputs, golden, prefix=''):
+    """Elenco delle differenze rispetto ai risultati di riferimento"""
+    errors = []
+    for name in sorted(set(golden) | set(outputs)):
+        if name not in outputs:
+            errors.append(prefix + name + ': mancante')
+            continue
+        if name not in golden:
+            errors.append(prefix + name + ': non presente nei risultati di riferimento')
+            continue
+        expected = golden[name]
+        actual = outputs[name]
+        for field in sorted(expected):
+            a = actual.get(field)
+            e = expected[field]
+            if isinstance(e, float) and isinstance(a, float):
+                if not np.isclose(a, e, rtol=golden_rtol, atol=golden_rtol):
+                    errors.append('{0}{1}: {2} {3} invece di {4}'.format(prefix, name, field, a, e))
+            elif a != e:
+                errors.append('{0}{1}: {2} {3} invece di {4}'.format(prefix, name, field, a, e))
+    return errors
+
+
+def check_outputs(outputs, golden, key, update_golden):
+    """
+    Confronto i prodotti di ogni caso con quelli del suo percorso di riferimento e con benchmark_golden.json.
+    Con update_golden i risultati di riferimento della configurazione vengono presi dai percorsi di riferimento.
+    """
+    errors = []
+    for case in sorted(outputs):
+        reference = reference_cases.get(case, case)
+        if reference != case and reference in outputs:
+            errors += compare_outputs(outputs[case], outputs[reference], case + ' / ' + reference + ': ')
+
+    if update_golden:
+        missing = sorted(set(reference_cases.get(case, case) for case in outputs) - set(outputs))
+        if missing:
+            return errors + ['percorsi di riferimento non eseguiti: ' + ', '.join(missing)]
+        golden.setdefault(key, {}).update((case, outputs[case]) for case in outputs if case not in reference_cases)
+        return errors
+
+    for case in sorted(outputs):
+        reference = reference_cases.get(case, case)
+        if reference not in golden.get(key, {}):
+            errors.append('{0}: risultati di riferimento assenti per {1} (usare --update-golden)'.format(case, key))
+            continue
+        errors += compare_outputs(outputs[case], golden[key][reference], case + ': ')
+    return errors
+
+
+def legacy_factor(values, termine):
+    """Riclassificazione con putmask come nella versione precedente di write_haines_array()"""
+    values = values.copy()
+    np.putmask(values, np.less_equal(values, termine['one'][0]), 1)
+    np.putmask(values, np.greater_equal(values, termine['three'][0]), 3)
+    np.putmask(values, np.logical_and([np.greater(values, termine['two'][0])],
+                                      [np.less(values, termine['two'][1])]), 2)
+    return values
+
+
+def legacy_haines_type(hc, key, value, t_sup, t_inf, q):
+    moisture_level = 'inf' if key == 'low' else 'sup'
+    temperature = t_inf if key == 'low' else t_sup
+    lapse_rate = t_sup - t_inf
+    moisture = temperature - hc.dewpoint_temp_calc(value[moisture_level], temperature, q)
+    haines_index = legacy_factor(lapse_rate, hc.check_termine_a(key)) + legacy_factor(moisture, hc.check_termine_b(key))
+    for [total, day_class] in ((2, 1), (3, 1), (4, 2), (5, 3), (6, 4)):
+        np.putmask(haines_index, np.equal(haines_index, total), day_class)
+    return haines_index, lapse_rate, moisture
+
+
+def kernel_fields(config, rng, value, key):
+    """Temperature e umidita' specifica plausibili (umidita' relativa 5-100%) sulla griglia GRIB"""
+    [cols, rows] = config['grib']
+    t_sup = rng.uniform(-25, 20, (rows, cols))
+    t_inf = t_sup - rng.uniform(-2, 25, (rows, cols))
+    moisture_level = 'inf' if key == 'low' else 'sup'
+    temperature = t_inf if key == 'low' else t_sup
+    saturation = np.power(10, (0.7859 + 0.03477 * temperature) / (1.0 + 0.00412 * temperature) + 2)
+    x = rng.uniform(5, 100, (rows, cols)) * saturation / (value[moisture_level] * 10000)
+    return t_sup, t_inf, 0.622 * x / (1 - 0.378 * x)
+
+
+def kernel_benchmark(config, repeat):
+    """Micro-benchmark del kernel Haines e confronto con le formule degli script"""
+    import haines_index_calc_all as hc
+    import haines_kernel
+
+    rng = np.random.default_rng(config['seed'])
+    result = {'types': {}, 'ok': True}
+    for key, value in haines_types.items():
+        [t_sup, t_inf, q] = kernel_fields(config, rng, value, key)
+        moisture_level = 'inf' if key == 'low' else 'sup'
+        termine_a = hc.check_termine_a(key)
+        termine_b = hc.check_termine_b(key)
+        limits_a = (termine_a['one'][0], termine_a['three'][0])
+        limits_b = (termine_b['one'][0], termine_b['three'][0])
+
+        legacy_seconds = []
+        kernel_seconds = []
+        for n in range(repeat):
+            start = time.time()
+            [expected, lapse_rate, moisture] = legacy_haines_type(hc, key, value, t_sup, t_inf, q)
+            legacy_seconds.append(time.time() - start)
+            start = time.time()
+            [actual, buffers] = haines_kernel.haines_type(key, value[moisture_level], t_sup, t_inf, q, limits_a, limits_b)
+            kernel_seconds.append(time.time() - start)
+
+        """Le classi possono differire solo dove lapse rate o moisture sono entro la tolleranza da una soglia"""
+        moisture_error = float(np.abs(buffers['moisture'] - moisture).max())
+        near = np.zeros(moisture.shape, dtype=bool)
+        for edge in limits_a:
+            near |= np.abs(lapse_rate - edge) <= kernel_atol
+        for edge in limits_b:
+            near |= np.abs(moisture - edge) <= kernel_atol
+        mismatches = int(np.count_nonzero((actual != expected) & ~near))
+        ok = moisture_error <= kernel_atol and mismatches == 0
+        result['ok'] = result['ok'] and ok
+        result['types'][key] = {
+            'legacy_seconds': min(legacy_seconds),
+            'kernel_seconds': min(kernel_seconds),
+            'speedup': min(legacy_seconds) / max(min(kernel_seconds), 1e-9),
+            'moisture_max_error': moisture_error,
+            'class_mismatches': mismatches,
+            'ok': ok
+        }
+    return result
+
+
+def datacube_check(workdir, config):
+    """
+    Slice Haines a 00Z, 03Z, 06Z, 12Z e un giorno dopo, una ripetuta: ogni tempo deve restare
+    distinto e la riscrittura deve sostituire solo la propria slice.
+    """
+    import datacube
+    if datacube.netCDF4 is None:
+        return {'ok': True, 'skipped': 'manca netCDF4'}
+
+    [cols, rows] = config['grib']
+    filename = os.path.join(workdir, 'datacube', 'haines_check.nc')
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    grid = {
+        'geotransform': [5.0, 8.0 / cols, 0, 46.0, 0, -5.0 / rows],
+        'rows': rows,
+        'cols': cols,
+        'projection': '',
+        'geographic': True,
+        'runs': None
+    }
+    steps = [bench_ref_time + timedelta(hours=hours) for hours in (0, 3, 6, 12, 24)]
+    for n, when in enumerate(steps + steps[1:2]):
+        datacube.append_product(filename, grid, datacube.haines_variables, when,
+                                {'haines_class': np.full((rows, cols), n + 1, dtype=np.uint8)})
+
+    """La slice delle 03Z riscritta per ultima vale len(steps) + 1, le altre il loro ordine di scrittura"""
+    expected = [n + 1 for n in range(len(steps))]
+    expected[1] = len(steps) + 1
+    series = datacube.point_series(filename, 'haines_class', grid['geotransform'][0], grid['geotransform'][3])
+    times = [when for when, value in series]
+    values = [value for when, value in series]
+    return {
+        'ok': times == steps and values == expected,
+        'values': values,
+        'expected': expected
+    }
+
+
+def print_report(report):
+    print('{0:<26} {1:<34} {2:>10} {3:>16} {4:>12}'.format('caso', 'fase', 'secondi', 'pixel/s', 'picco MB'))
+    for case, result in report['cases'].items():
+        print('{0:<26} {1:<34} {2:>10.4f} {3:>16} {4:>12.1f}'.format(
+            case, 'totale', result['seconds'], '', result['peak_rss_bytes'] / 1e6))
+        for name, stage in sorted(result['stages'].items()):
+            rate = '' if stage['pixels_per_second'] is None else '{0:.3e}'.format(stage['pixels_per_second'])
+            print('{0:<26} {1:<34} {2:>10.4f} {3:>16} {4:>12}'.format('', name, stage['seconds'], rate, ''))
+
+
+def benchmark(workdir, config, repeat, cases, update_golden=False, report_filename=None):
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    make_fixtures(workdir, config)
+
+    report = {'config': config, 'key': config_key(config), 'cases': {}}
+    outputs = {}
+    for case in cases:
+        if case == 'haines_kernel':
+            report['kernel'] = kernel_benchmark(config, repeat)
+            continue
+        if case == 'datacube':
+            report['datacube'] = datacube_check(workdir, config)
+            continue
+        results = [run_isolated(case, workdir, config) for n in range(repeat)]
+        report['cases'][case] = summarize(case, results, config)
+        outputs[case] = collect_outputs(workdir, case)
+
+    golden = {}
+    if os.path.exists(golden_filename):
+        with open(golden_filename) as f:
+            golden = json.load(f)
+
+    errors = check_outputs(outputs, golden, report['key'], update_golden)
+    if update_golden and not errors:
+        with open(golden_filename, 'w') as f:
+            json.dump(golden, f, indent=2, sort_keys=True)
+            f.write('\n')
+        report['golden'] = 'aggiornato'
+    else:
+        report['golden'] = errors if errors else 'ok'
+
+    print_report(report)
+    if 'kernel' in report:
+        for key, result in report['kernel']['types'].items():
+            print('kernel {0:<5} {1:>10.4f} s (script {2:.4f} s, x{3:.1f}) errore moisture {4:.2e} classi diverse {5}'.format(
+                key, result['kernel_seconds'], result['legacy_seconds'], result['speedup'],
+                result['moisture_max_error'], result['class_mismatches']))
+    if 'datacube' in report:
+        result = report['datacube']
+        print('datacube: ' + result.get('skipped', 'ok' if result['ok'] else 'ERRORE, valori {0} invece di {1}'.format(
+            result['values'], result['expected'])))
+    print('risultati di riferimento: ' + (report['golden'] if isinstance(report['golden'], str) else 'DIFFERENZE'))
+    if isinstance(report['golden'], list):
+        for error in report['golden']:
+            print('  ' + error)
+
+    if report_filename is not None:
+        with open(report_filename, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    return (not isinstance(report['golden'], list) and report.get('kernel', {'ok': True})['ok'] and
+            report.get('datacube', {'ok': True})['ok'])
+
+
+def print_usage():
+    print("benchmark.py -o <workdir> [--model 267x201] [--risk 267x200] [--prec 239x263] [--grib 120x80]")
+    print("             [--times 4] [-w <window>] [-n <repeat>] [--seed <n>] [--cases a,b] [--report <file.json>] [--update-golden]")
+    print("    casi: fuoco_prescritto, fuoco_prescritto_legacy, haines_low, haines_mid, haines_high, haines_all, haines_all_stream, haines_all_parallel, haines_kernel, datacube")
+
+
+def main(argv):
+    workdir = None
+    config = {
+        'model': [267, 201],
+        'risk': [267, 200],
+        'prec': [239, 263],
+        'grib': [120, 80],
+        'times': 4,
+        'window': 7,
+        'seed': 20240710
+    }
+    repeat = 3
+    cases = ['fuoco_prescritto', 'fuoco_prescritto_legacy', 'haines_low', 'haines_mid', 'haines_high', 'haines_all', 'haines_all_stream', 'haines_all_parallel', 'haines_kernel', 'datacube']
+    update_golden = False
+    report_filename = None
+    try:
+        opts, args = getopt.getopt(argv, "ho:w:n:", ["help", "workdir=", "model=", "risk=", "prec=", "grib=", "times=", "window=", "repeat=", "seed=", "cases=", "report=", "update-golden"])
+    except getopt.GetoptError as err:
+        print(err)
+        print_usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_usage()
+            sys.exit(2)
+        elif opt in ("-o", "--workdir"):
+            workdir = os.path.abspath(arg)
+        elif opt in ("--model", "--risk", "--prec", "--grib"):
+            config[opt[2:]] = parse_grid(arg)
+        elif opt == "--times":
+            config['times'] = int(arg)
+        elif opt in ("-w", "--window"):
+            config['window'] = int(arg)
+        elif opt in ("-n", "--repeat"):
+            repeat = int(arg)
+        elif opt == "--seed":
+            config['seed'] = int(arg)
+        elif opt == "--cases":
+            cases = arg.split(',')
+        elif opt == "--report":
+            report_filename = arg
+        elif opt == "--update-golden":
+            update_golden = True
+        else:
+            assert False, "unhandled option"
+
+    if workdir is None:
+        print_usage()
+        sys.exit(2)
+
+    """I moduli dello script vengono importati dai processi del benchmark"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        success = benchmark(workdir, config, repeat, cases, update_golden, report_filename)
+    except Exception as e:
+        print(e)
+        sys.exit(2)
+    if not success:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+    print("--- %s seconds ---" % (time.time() - start_time))
@@ -25,25 +25,45 @@ import getopt
 import sys
 from sys import path
 
-path.remove('/mnt/hd/sviluppo/library/libimage/gdal/swig/python/build/lib.linux-x86_64-2.7')
+gdal_build_path = '/mnt/hd/sviluppo/library/libimage/gdal/swig/python/build/lib.linux-x86_64-2.7'
+if gdal_build_path in path:
+    path.remove(gdal_build_path)
 
 import numpy as np
-from osgeo import gdal, gdalconst
+from osgeo import gdal, gdalconst, osr
 from datetime import timedelta, datetime
 import time
 start_time = time.time()
 import fnmatch
-from functools import reduce
-import subprocess
+import hashlib
+import json
+import shutil
+import tempfile
+import uuid
 import logging
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import prec_cube
+import grads
+import stage_metrics
+import output_backend
+import datacube
+import zonal_stats
 
 wkt_projection = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.01745329251994328,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
 wkt_projection_prec = 'PROJCS["WGS 84 / UTM zone 32N",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]],PROJECTION["Transverse_Mercator"],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",9],PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],PARAMETER["false_northing",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]],AXIS["Easting",EAST],AXIS["Northing",NORTH],AUTHORITY["EPSG","32632"]]'
-tmp_directory = '/mnt/hd/operativo/tmp/fuoco_prescr_tmp_data/'
+cache_directory = '/mnt/hd/operativo/tmp/fuoco_prescr_cache/'
+output_directory = '/mnt/hd/operativo/risout_prev/arw/'
+metout_directory = '../../metout/'
+prec_cube_directory = metout_directory + 'prec_cube/'
 driver_list = ["GTiff", "RST"]
 driver = gdal.GetDriverByName(driver_list[1])
 driver_ext = '.rst'
 
+"""Formato dei prodotti finali (rst, gtiff, cog), anche per prodotto: --format threshold=cog,criteria=rst"""
+product_formats = {'default': 'rst'}
+
 """
     SOGLIE ORIGINALI
 
@@ -64,6 +84,19 @@ threshold_dict = {
     "threshold_prec": [3, 20],
 }
 
+"""
+Bit del raster diagnostico fire_presc_criteria: bit acceso = criterio soddisfatto
+La finestra per il fuoco prescritto e' aperta quando tutti i bit richiesti sono accesi
+"""
+criteria_bits = {
+    "tmpsfc": 0,
+    "rhsfc": 1,
+    "wind10m": 2,
+    "ffmc": 3,
+    "dmc": 4,
+    "prec": 5,
+}
+
 def get_threshold(params):
     dict = threshold_dict
     threshold = list(dict.get(params))
@@ -111,30 +144,222 @@ def get_geotransform(params):
 
 nlat = 201
 nlon = 267
-nz = 1
 
-dt = np.dtype((np.float32, (nlat, nlon)))
+"""Valori non validi: undef del file ctl e nodata dei raster"""
+model_undef = 9.999E+20
+nodata = -9999
+
+"""Griglia finale UTM 32N a 1 km (get_geotransform('prec'))"""
+prec_nrows = 263
+prec_ncols = 239
+
+"""Finestra (giorni) per il conteggio dei giorni senza pioggia e soglia (mm) del giorno secco"""
+prec_window = 7
+prec_dry_limit = 5
+
+"""Thread per la lettura anticipata degli input (0 = lettura nelle singole fasi)"""
+prefetch_workers = 4
 
-def read(f, n=1, offset=0):
-    """in numpy > 1.17.3"""
-    return np.fromfile(f, dt, n, "", offset)
+"""Cache dei risultati delle fasi: dimensione massima (byte) prima di eliminare le voci usate meno di recente"""
+stage_cache_directory = cache_directory + 'stages/'
+stage_cache_max_bytes = 256 * 1024 * 1024
 
-def calc_byte(n, var):
-    img_bytes = nlon * nlat * 4
-    if (n == 0):
-        return img_bytes * var
+"""Checkpoint delle fasi per giorno (manifest.json + maschere) usati da --resume"""
+checkpoint_directory = cache_directory + 'checkpoint/'
+log_directory = '/mnt/hd/operativo/log/'
 
-    if (n == 1):
-        return img_bytes * (var + 4)
+"""Cubo NetCDF (time, run, y, x) a cui aggiungere maschera finale e criteri di ogni giorno (--datacube)"""
+datacube_filename = None
 
-    if (n == 2):
-        return img_bytes * (var + 8)
+"""Zone per le statistiche della finestra (--zones nome=file[:campo]) e cache dei raster delle etichette"""
+zonal_zones = {}
+zones_cache_directory = cache_directory + 'zones/'
+zonal_classes = [(0, 'closed'), (1, 'window')]
 
-    if (n == 3):
-        return img_bytes * (var + 12)
+"""Run del modello: ognuno viene elaborato per intero in un proprio thread"""
+model_runs = (0, 1, 2)
 
+"""Posizione delle variabili all'interno di ogni tempo del file .gra (se manca il file .ctl)"""
+model_vars = {
+    "tmpsfc": 0,
+    "apcpsfc": 1,
+    "rhsfc": 2,
+    "wind10m": 3
+}
+
+"""Indici di rischio: criterio -> prefisso dei file in <rischio>"""
+risk_products = {
+    "dmc": "modello_Rdmc_",
+    "ffmc": "modello_Rfff_"
+}
+
+"""Fattori di conversione delle variabili del modello (m/s -> km/h)"""
+model_scale = {
+    "wind10m": 3.6
+}
+
+def open_model(modello):
+    """
+    Descrittore del modello: dal file <modello>.ctl se presente,
+    altrimenti dalle costanti nlat, nlon e model_vars
+    """
+    if os.path.exists(modello + ".ctl"):
+        return grads.parse_ctl(modello + ".ctl")
+    model_geotransform = get_geotransform('model')
+    return grads.legacy_descriptor(
+        modello + ".gra",
+        nlon,
+        nlat,
+        list(model_vars),
+        model_undef,
+        [model_geotransform[0], model_geotransform[1]],
+        [model_geotransform[3], model_geotransform[5]])
 
-def write_geotiff_file(data, filename, transformparams):
+
+"""
+Tabelle di riproiezione EPSG:4326 -> EPSG:32632 (sostituiscono gdalwarp -r bilinear)
+Per ogni pixel della griglia prec: 4 indici dei pixel sorgente e 4 pesi bilineari
+"""
+warp_tables = {}
+
+def product_geotransform(transformparams, rows, geotransform=None):
+    """Geotransform effettivo dei dati scritti (con RST i dati del modello vengono ribaltati)"""
+    if geotransform is None:
+        geotransform = get_geotransform(transformparams)
+    if transformparams == 'model' and driver.ShortName == 'RST':
+        return north_up_geotransform(geotransform, rows)
+    return list(geotransform)
+
+
+def north_up_geotransform(geotransform, rows):
+    """Riporto il geotransform con spaziatura N-S negativa (origine nell'angolo UL)"""
+    geotransform = list(geotransform)
+    if geotransform[5] > 0:
+        geotransform[3] = geotransform[3] + geotransform[5] * rows
+        geotransform[5] = -geotransform[5]
+    return geotransform
+
+
+def build_warp_table(src_geotransform, src_shape):
+    """Calcolo la tabella di riproiezione bilineare per un raster sorgente in EPSG:4326"""
+    [src_rows, src_cols] = src_shape
+    dst_geotransform = get_geotransform('prec')
+
+    """Centri dei pixel della griglia di arrivo"""
+    x = dst_geotransform[0] + (np.arange(prec_ncols) + 0.5) * dst_geotransform[1]
+    y = dst_geotransform[3] + (np.arange(prec_nrows) + 0.5) * dst_geotransform[5]
+    xx, yy = np.meshgrid(x, y)
+
+    src_srs = osr.SpatialReference()
+    src_srs.ImportFromWkt(wkt_projection_prec)
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromWkt(wkt_projection)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        """Only for gdal > 3: mantengo l'ordine lon/lat"""
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(src_srs, dst_srs)
+    lonlat = np.array(transform.TransformPoints(np.column_stack((xx.ravel(), yy.ravel())).tolist()))
+
+    """Coordinate pixel nel raster sorgente riferite al centro del pixel"""
+    px = (lonlat[:, 0] - src_geotransform[0]) / src_geotransform[1] - 0.5
+    py = (lonlat[:, 1] - src_geotransform[3]) / src_geotransform[5] - 0.5
+    x0 = np.floor(px)
+    y0 = np.floor(py)
+    fx = px - x0
+    fy = py - y0
+
+    valid = np.logical_and(
+        np.logical_and(np.greater_equal(px, -0.5), np.less_equal(px, src_cols - 0.5)),
+        np.logical_and(np.greater_equal(py, -0.5), np.less_equal(py, src_rows - 0.5))
+    )
+
+    x0 = x0.astype(np.int64)
+    y0 = y0.astype(np.int64)
+    x0c = np.clip(x0, 0, src_cols - 1)
+    x1c = np.clip(x0 + 1, 0, src_cols - 1)
+    y0c = np.clip(y0, 0, src_rows - 1)
+    y1c = np.clip(y0 + 1, 0, src_rows - 1)
+
+    index = np.stack((
+        y0c * src_cols + x0c,
+        y0c * src_cols + x1c,
+        y1c * src_cols + x0c,
+        y1c * src_cols + x1c
+    )).astype(np.int32)
+    weights = np.stack((
+        (1 - fx) * (1 - fy),
+        fx * (1 - fy),
+        (1 - fx) * fy,
+        fx * fy
+    )).astype(np.float32)
+    weights[:, ~valid] = 0
+
+    return {'index': index, 'weights': weights}
+
+
+def get_warp_table(src_geotransform, src_shape):
+    """Leggo la tabella di riproiezione dalla cache (memoria o disco), altrimenti la calcolo e la salvo"""
+    key = hashlib.md5(repr((
+        [round(v, 12) for v in src_geotransform],
+        list(src_shape),
+        get_geotransform('prec'),
+        [prec_nrows, prec_ncols]
+    )).encode()).hexdigest()
+
+    if key in warp_tables:
+        return warp_tables[key]
+
+    filename = cache_directory + 'warp_' + key + '.npz'
+    if os.path.exists(filename):
+        with np.load(filename) as data:
+            table = {'index': data['index'], 'weights': data['weights']}
+    else:
+        table = build_warp_table(src_geotransform, src_shape)
+        os.makedirs(cache_directory, exist_ok=True)
+        tmp_filename = filename + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, index=table['index'], weights=table['weights'])
+        os.replace(tmp_filename, filename)
+
+    warp_tables[key] = table
+    return table
+
+
+def load_warp_tables():
+    """Carico in memoria tutte le tabelle di riproiezione gia' salvate su disco"""
+    if not os.path.isdir(cache_directory):
+        return
+    for filename in fnmatch.filter(os.listdir(cache_directory), 'warp_*.npz'):
+        key = filename[len('warp_'):-len('.npz')]
+        if key not in warp_tables:
+            with np.load(cache_directory + filename) as data:
+                warp_tables[key] = {'index': data['index'], 'weights': data['weights']}
+
+
+def warp_array(data, table):
+    """Riproietto sulla griglia prec con un gather vettoriale"""
+    src = np.ravel(np.asarray(data, dtype=np.float32))
+    warped = np.multiply(src[table['index']], table['weights']).sum(axis=0)
+    return warped.reshape(prec_nrows, prec_ncols)
+
+
+def warp_stack(data, table):
+    """Riproietto una pila (n, righe, colonne) di raster con la stessa tabella"""
+    src = np.asarray(data, dtype=np.float32).reshape(len(data), -1)
+    warped = np.multiply(src[:, table['index']], table['weights']).sum(axis=1)
+    return warped.reshape(len(data), prec_nrows, prec_ncols)
+
+
+def model_undef_value(model, var):
+    """undef del descrittore (model_undef se il .ctl non lo dichiara) con la conversione applicata alla variabile"""
+    undef = np.array([model_undef if model['undef'] is None else model['undef']], dtype=np.float32)
+    if var in model_scale:
+        undef = undef * model_scale[var]
+    return undef[0]
+
+
+def write_geotiff_file(data, filename, transformparams, geotransform=None):
     if transformparams == 'model':
         """in numpy > 1.17.3"""
         data = np.squeeze(data, axis=0)
@@ -151,7 +376,7 @@ def write_geotiff_file(data, filename, transformparams):
         1,
         gdal.GDT_Float32)
 
-    dataset.SetGeoTransform(get_geotransform(transformparams))
+    dataset.SetGeoTransform(get_geotransform(transformparams) if geotransform is None else geotransform)
 
     dataset.SetProjection(wkt_projection)
 
@@ -160,302 +385,1135 @@ def write_geotiff_file(data, filename, transformparams):
     return dataset
 
 
-def threshold_calc(array, name, threshold, transformparams):
-    geotiffData = array.ReadAsArray()
+def threshold_mask(data, threshold, out=None, undef=model_undef):
+    """
+    Maschera booleana lo <= x <= hi calcolata senza temporanei float.
+    I NaN, il valore undef (quello del .ctl per i campi del modello) e il nodata (-9999)
+    restano sempre fuori soglia.
+    """
+    mask = np.greater_equal(data, threshold[0], out=out)
+    mask &= np.less_equal(data, threshold[1])
+    for sentinel in (undef, nodata):
+        if threshold[0] <= sentinel <= threshold[1]:
+            mask &= np.not_equal(data, np.float32(sentinel))
+    return mask
 
-    [rows, cols] = geotiffData.shape
 
-    temp1 = np.less(geotiffData, threshold[0])
-    np.putmask(geotiffData, temp1, -9999)
+"""
+Lettura anticipata degli input.
+Appena il giorno e' noto tutti gli input dichiarati vengono letti da un pool di thread limitato;
+le fasi chiedono i dati con fetch_raster/fetch_model e aspettano solo quelli che usano.
+I futuri sono indicizzati per nome file, quindi giorni diversi non si sovrappongono.
+"""
+prefetch_futures = {}
+prefetch_lock = threading.Lock()
+
+def read_raster(filename):
+    """Leggo la prima banda di un raster"""
+    src_ds = gdal.Open(filename)
+    if src_ds is None:
+        raise IOError('File mancante: ' + filename)
+    data = src_ds.GetRasterBand(1).ReadAsArray()
+    src_ds = None
+    return data
+
+
+def read_model_fields(modello):
+    """Descrittore del modello e campi (run, variabile) letti in memoria"""
+    model = open_model(modello)
+    fields = {}
+    for i in range(min(3, model['tdef']['n'])):
+        for var in ("tmpsfc", "rhsfc", "wind10m"):
+            fields[(i, var)] = np.array(grads.variable(model, var, i))
+    return {'desc': model, 'fields': fields}
+
+
+def pop_prefetch(key):
+    with prefetch_lock:
+        return prefetch_futures.pop(key, None)
+
+
+def fetch_raster(filename):
+    future = pop_prefetch(filename)
+    if future is not None:
+        return future.result()
+    return read_raster(filename)
+
+
+def fetch_model(modello):
+    future = pop_prefetch(modello + ".gra")
+    if future is not None:
+        return future.result()
+    return read_model_fields(modello)
+
+
+def risk_filename(rischio_dir, prefix, value, giorno):
+    return rischio_dir + "/" + prefix + value + "_" + giorno + ".rst"
+
+
+def prec_dates_needed(giorno, finestra, stato):
+    """Giorni di pioggia che prec_threshold dovra' leggere con GDAL"""
+    end_date = datetime.strptime(giorno, "%Y-%m-%d").date() - timedelta(days=1)
+    start_date = end_date - timedelta(days=finestra - 1)
+    cube = shared_prec_cube
+    if cube is None:
+        cube = prec_cube.open_cube(prec_cube_directory)
+    if stato:
+        state = load_dry_days_state(finestra)
+        if state is not None and state['end_date'] == end_date:
+            return []
+        if state is not None and state['end_date'] == end_date - timedelta(days=1):
+            start_date = end_date
+    if prec_cube.has_window(cube, start_date, end_date):
+        return []
+    return [start_date + timedelta(days=n) for n in range((end_date - start_date).days + 1)]
+
+
+def start_prefetch(giorno, modello, rischio_dir, in_memory, finestra, stato, workers=prefetch_workers):
+    if workers <= 0:
+        return None
+    executor = ThreadPoolExecutor(max_workers=workers)
+    """Gli input delle fasi gia' presenti nella cache non vengono letti"""
+    requests = []
+    if in_memory and not model_cached(modello, model_runs, 'memory'):
+        requests.append((modello + ".gra", read_model_fields, modello))
+    for criterion, prefix in risk_products.items():
+        for value in ('Run0', 'Run1', 'Run2'):
+            filename = risk_filename(rischio_dir, prefix, value, giorno)
+            if not has_stage(risk_stage_key(filename, criterion)):
+                requests.append((filename, read_raster, filename))
+    if not has_stage(prec_stage_key(giorno, finestra)):
+        for prec_date in prec_dates_needed(giorno, finestra, stato):
+            filename = prec_filename(prec_date.strftime("%Y-%m-%d"))
+            requests.append((filename, read_raster, filename))
+
+    with prefetch_lock:
+        for [key, function, arg] in requests:
+            prefetch_futures[key] = executor.submit(function, arg)
+    return {'executor': executor, 'keys': [request[0] for request in requests]}
+
+
+def stop_prefetch(prefetch):
+    """Libero i dati letti in anticipo e non usati"""
+    if prefetch is None:
+        return
+    for key in prefetch['keys']:
+        future = pop_prefetch(key)
+        if future is not None:
+            future.cancel()
+    prefetch['executor'].shutdown(wait=True)
 
-    temp2 = np.greater(geotiffData, threshold[1])
-    np.putmask(geotiffData, temp2, -9999)
 
-    temp3 = np.logical_and([np.greater_equal(geotiffData, threshold[0])], [np.less_equal(geotiffData, threshold[1])])
-    np.putmask(geotiffData, temp3, 1)
+"""
+Cache dei risultati delle fasi.
+Ogni maschera e' indicizzata con un hash dell'identita' dei file di input (percorso, dimensione, mtime)
+e delle soglie usate; la maschera finale con le chiavi delle maschere che la compongono.
+Cambiando solo threshold_ffmc vengono ricalcolate solo le maschere FFMC e la maschera finale.
+Le voci sono file npz in stage_cache_directory: la lettura aggiorna l'mtime e oltre
+stage_cache_max_bytes si eliminano le voci usate meno di recente.
+"""
+stage_cache_version = 1
+stage_cache_enabled = True
 
-    temp4 = np.equal(geotiffData, -9999)
-    np.putmask(geotiffData, temp4, 0)
+def file_identity(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return [filename, None, None]
+    return [os.path.abspath(filename), st.st_size, st.st_mtime_ns]
 
-    outData = driver.Create(
-        name,
-        cols,
-        rows,
-        1,
-        gdal.GDT_Float32)
 
-    outData.SetGeoTransform(get_geotransform(transformparams))
-
-    outData.SetProjection(wkt_projection)
-    outData.GetRasterBand(1).WriteArray(geotiffData)
-    outData.GetRasterBand(1).SetNoDataValue(-9999)
-    outData = None
-
-
-def models_threshold(giorno, modello):
-    for i in range(3):
-        with open(modello + ".gra", 'rb') as f:
-            byte = calc_byte(i, 0)
-            tmpsfc = read(f, nz, byte)
-            threshold_calc(
-                write_geotiff_file(
-                    tmpsfc,
-                    tmp_directory + 'tmpsfc_Run' + str(i) + driver_ext,
-                    'model'
-                ),
-                tmp_directory + 'tmpsfc_Run' + str(i) + '_threshold_' + giorno + driver_ext,
-                get_threshold('threshold_tmpsfc'),
-                'model'
-            )
-            dataset = None
-            f.close
-
-        with open(modello + ".gra", 'rb') as f:
-            byte = calc_byte(i, 2)
-            rhsfc = read(f, nz, byte)
-            threshold_calc(
-                write_geotiff_file(
-                    rhsfc,
-                    tmp_directory + 'rhsfc_Run' + str(i) + driver_ext,
-                    'model'
-                ),
-                tmp_directory + 'rhsfc_Run' + str(i) + '_threshold_' + giorno + driver_ext,
-                get_threshold('threshold_rhsfc'),
-                'model'
+def stage_key(*parts):
+    return hashlib.sha1(json.dumps([stage_cache_version] + list(parts), default=str).encode()).hexdigest()
+
+
+def stage_cache_filename(key):
+    return stage_cache_directory + key + '.npz'
+
+
+def has_stage(key):
+    return stage_cache_enabled and os.path.exists(stage_cache_filename(key))
+
+
+def load_stage(key):
+    """Array salvati per la chiave (None se la voce non c'e' o non e' leggibile)"""
+    if key is None or not stage_cache_enabled:
+        return None
+    filename = stage_cache_filename(key)
+    try:
+        with np.load(filename) as data:
+            arrays = dict((name, data[name]) for name in data.files)
+        os.utime(filename)
+    except Exception:
+        return None
+    return arrays
+
+
+def save_stage(key, arrays):
+    if key is None or not stage_cache_enabled:
+        return
+    os.makedirs(stage_cache_directory, exist_ok=True)
+    filename = stage_cache_filename(key)
+    tmp_filename = filename + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_filename, filename)
+    evict_stages()
+
+
+def evict_stages(max_bytes=stage_cache_max_bytes):
+    """Elimino le voci usate meno di recente finche' la cache non rientra in max_bytes"""
+    entries = []
+    for name in fnmatch.filter(os.listdir(stage_cache_directory), '*.npz'):
+        try:
+            st = os.stat(stage_cache_directory + name)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(entry[1] for entry in entries)
+    for [mtime, size, name] in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(stage_cache_directory + name)
+        except OSError:
+            pass
+        total -= size
+
+
+def cached_stage(key, compute):
+    """Risultato della fase dalla cache, altrimenti compute() (dict di array) viene calcolato e salvato"""
+    arrays = load_stage(key)
+    if arrays is None:
+        arrays = compute()
+        save_stage(key, arrays)
+    return arrays
+
+
+def model_stage_key(desc, i, var, mode):
+    """Maschera (run, variabile) del modello; mode 'memory' (-i) o 'file'. Il .gra e' quello letto (dset del .ctl)"""
+    return stage_key(
+        'model',
+        mode,
+        file_identity(desc['dset']),
+        file_identity(desc['ctl']) if desc['ctl'] else None,
+        i,
+        var,
+        get_threshold('threshold_' + var),
+        model_scale.get(var),
+        driver.ShortName)
+
+
+def model_stage_keys(modello, runs, mode):
+    """
+    Chiavi attuali delle maschere {(run, variabile): chiave} con un solo parsing del .ctl;
+    None se il modello non si apre (l'errore viene riportato dalla fase del modello)
+    """
+    try:
+        desc = open_model(modello)
+    except Exception:
+        desc = None
+    return dict(
+        ((i, var), model_stage_key(desc, i, var, mode) if desc is not None else None)
+        for i in runs for var in ("tmpsfc", "rhsfc", "wind10m"))
+
+
+def model_cached(modello, runs, mode):
+    return all(key is not None and has_stage(key) for key in model_stage_keys(modello, runs, mode).values())
+
+
+def risk_stage_key(filename, criterion):
+    return stage_key('risk', file_identity(filename), criterion, get_threshold('threshold_' + criterion))
+
+
+def prec_stage_key(giorno, finestra):
+    """
+    Conteggio dei giorni senza pioggia: dipende dalle date della finestra e dai dati di quei giorni,
+    non dalla soglia. Aggiungere al cubo i giorni successivi non invalida le finestre precedenti.
+    """
+    end_date = datetime.strptime(giorno, "%Y-%m-%d").date() - timedelta(days=1)
+    start_date = end_date - timedelta(days=finestra - 1)
+    cube = shared_prec_cube
+    if cube is None:
+        cube = prec_cube.open_cube(prec_cube_directory)
+    if prec_cube.has_window(cube, start_date, end_date):
+        inputs = prec_cube.window_identity(prec_cube_directory, cube, start_date, end_date)
+    else:
+        inputs = [file_identity(filename) for filename in prec_window_files(giorno, finestra)]
+    return stage_key('prec', start_date, end_date, prec_dry_limit, inputs)
+
+
+def prec_product_key(giorno, finestra, key=None):
+    """Maschera della pioggia: conteggio della finestra e soglia"""
+    if key is None:
+        key = prec_stage_key(giorno, finestra)
+    return stage_key(key, get_threshold('threshold_prec'))
+
+
+"""
+Area di lavoro isolata per ogni invocazione.
+Le maschere calcolate restano in memoria, registrate in workspace['prodotti'] con chiave
+(run, criterio), run None per i prodotti comuni (pioggia): tot_threshold legge solo da qui.
+Gli unici file intermedi (i campi del modello riletti senza -i) vanno in /vsimem/
+(oppure in una cartella temporanea con -t <dir>) e vengono cancellati a fine elaborazione.
+Gli input opzionali mancanti (indici di rischio, pioggia) vanno in workspace['mancanti'].
+"""
+def create_workspace(giorno, directory=None):
+    if directory is None:
+        root = '/vsimem/fuoco_prescritto_' + giorno + '_' + uuid.uuid4().hex + '/'
+    else:
+        root = tempfile.mkdtemp(prefix='fuoco_prescritto_' + giorno + '_', dir=directory) + '/'
+    return {
+        'giorno': giorno,
+        'directory': root,
+        'prodotti': {},
+        'mancanti': {},
+        'manifest': {'giorno': giorno, 'stages': {}},
+        'resume': False
+    }
+
+
+def workspace_file(workspace, name):
+    return workspace['directory'] + name + '_' + workspace['giorno'] + driver_ext
+
+
+def cleanup_workspace(workspace):
+    root = workspace['directory']
+    if root.startswith('/vsimem/'):
+        for name in gdal.ReadDir(root) or []:
+            gdal.Unlink(root + name)
+        gdal.Rmdir(root)
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+    workspace['prodotti'] = {}
+
+
+def register_product(workspace, run, criterion, mask, transformparams, geotransform=None, key=None):
+    """Registro la maschera per il calcolo finale"""
+    workspace['prodotti'][(run, criterion)] = {
+        'mask': mask,
+        'transformparams': transformparams,
+        'geotransform': product_geotransform(transformparams, mask.shape[0], geotransform),
+        'key': key
+    }
+
+
+def missing_input(workspace, run, criterion, filenames):
+    """Il criterio viene escluso dalla maschera finale, che viene segnata come parziale"""
+    workspace['mancanti'][(run, criterion)] = list(filenames)
+
+
+"""
+Checkpoint delle fasi.
+Ogni fase salva le maschere che ha registrato in checkpoint_directory/<giorno>/<fase>.npz
+e il suo esito (done, partial, failed) in manifest.json.
+Con --resume le fasi done vengono ripristinate dal checkpoint e si riparte dalle fasi
+fallite o parziali; una fase done viene rieseguita se la chiave di una sua maschera
+non coincide piu' con quella calcolata dagli input attuali (es. .gra o indici di rischio
+rigenerati dopo l'errore). La maschera finale viene sempre ricalcolata.
+"""
+manifest_lock = threading.Lock()
+
+def checkpoint_path(giorno):
+    return checkpoint_directory + giorno + '/'
+
+
+def load_manifest(giorno, resume=False):
+    filename = checkpoint_path(giorno) + 'manifest.json'
+    if resume and os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+    return {'giorno': giorno, 'stages': {}}
+
+
+def save_manifest(workspace):
+    """Da chiamare con manifest_lock acquisito"""
+    directory = checkpoint_path(workspace['giorno'])
+    os.makedirs(directory, exist_ok=True)
+    filename = directory + 'manifest.json'
+    tmp_filename = filename + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(workspace['manifest'], f, indent=2, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+def save_checkpoint(workspace, stage, products):
+    """Salvo le maschere registrate dalla fase; restituisce la loro descrizione per il manifest"""
+    entries = []
+    arrays = {}
+    for (run, criterion) in products:
+        product = workspace['prodotti'].get((run, criterion))
+        if product is None:
+            continue
+        name = 'mask_' + str(len(arrays))
+        arrays[name] = product['mask']
+        entries.append({
+            'array': name,
+            'run': run,
+            'criterion': criterion,
+            'transformparams': product['transformparams'],
+            'geotransform': [float(v) for v in product['geotransform']],
+            'key': product['key']
+        })
+    if arrays:
+        directory = checkpoint_path(workspace['giorno'])
+        os.makedirs(directory, exist_ok=True)
+        filename = directory + stage + '.npz'
+        tmp_filename = filename + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_filename, filename)
+    return entries
+
+
+def restore_checkpoint(workspace, stage, entry):
+    if not entry['products']:
+        return
+    with np.load(checkpoint_path(workspace['giorno']) + stage + '.npz') as data:
+        for product in entry['products']:
+            register_product(
+                workspace,
+                product['run'],
+                product['criterion'],
+                data[product['array']],
+                product['transformparams'],
+                product['geotransform'],
+                product['key']
             )
-            dataset = None
-            f.close
-
-        with open(modello + ".gra", 'rb') as f:
-            byte = calc_byte(i, 3)
-            wind10m = read(f, nz, byte)
-            wind10m = wind10m * 3.6
-            threshold_calc(
-                write_geotiff_file(
-                    wind10m,
-                    tmp_directory + 'wind10m_Run' + str(i) + driver_ext,
-                    'model'
-                ),
-                tmp_directory + 'wind10m_Run' + str(i) + '_threshold_' + giorno + driver_ext,
-                get_threshold('threshold_wind10m'),
-                'model'
+
+
+def stage_done(workspace, stage):
+    entry = workspace['manifest']['stages'].get(stage)
+    return workspace['resume'] and entry is not None and entry['status'] == 'done'
+
+
+def checkpoint_current(entry, products):
+    """Le maschere del checkpoint sono state calcolate dagli input attuali"""
+    return all(
+        product['key'] is not None and product['key'] == products.get((product['run'], product['criterion']))
+        for product in entry['products']
+    )
+
+
+def run_stage(workspace, stage, products, function, *args):
+    """
+    Eseguo una fase e ne registro l'esito nel manifest; restituisce l'errore o None.
+    products: {(run, criterio): chiave attuale} delle maschere registrate dalla fase e salvate
+    nel checkpoint (None per le fasi che non vengono mai ripristinate, come la maschera finale).
+    """
+    if (products is not None and stage_done(workspace, stage) and
+            checkpoint_current(workspace['manifest']['stages'][stage], products)):
+        try:
+            with stage_metrics.stage('restore_checkpoint', stage=stage):
+                restore_checkpoint(workspace, stage, workspace['manifest']['stages'][stage])
+            return None
+        except Exception:
+            """Checkpoint non leggibile: rieseguo la fase"""
+            pass
+
+    [name, sep, run] = stage.partition('_Run')
+    labels = {'run': run} if sep else {}
+    error = None
+    try:
+        with stage_metrics.stage(name, **labels):
+            function(workspace, *args)
+        missing = sorted(
+            criterion for (run, criterion) in list(workspace['mancanti'])
+            if (run, criterion) in (products or [])
+        )
+        entry = {
+            'status': 'partial' if missing else 'done',
+            'missing': missing,
+            'products': save_checkpoint(workspace, stage, products or [])
+        }
+    except Exception as e:
+        error = e
+        entry = {'status': 'failed', 'error': str(e), 'products': []}
+    entry['time'] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+    with manifest_lock:
+        workspace['manifest']['stages'][stage] = entry
+        save_manifest(workspace)
+    return error
+
+
+def finish_manifest(workspace, error):
+    """Esito complessivo del giorno e input mancanti"""
+    missing = [
+        {'run': run, 'criterion': criterion, 'files': filenames}
+        for (run, criterion), filenames in sorted(
+            workspace['mancanti'].items(), key=lambda item: (str(item[0][0]), item[0][1]))
+    ]
+    with manifest_lock:
+        manifest = workspace['manifest']
+        manifest['missing'] = missing
+        if error is not None:
+            manifest['status'] = 'failed'
+        elif missing:
+            manifest['status'] = 'partial'
+        else:
+            manifest['status'] = 'done'
+        save_manifest(workspace)
+    return manifest['status']
+
+
+def models_threshold_memory(workspace, modello, runs=model_runs, model=None):
+    """
+    Calcolo le soglie del modello senza file intermedi:
+    il .gra viene mappato una sola volta e le maschere sono calcolate in memoria.
+    Griglia, variabili e tempi vengono dal file .ctl (se presente)
+    Il modello viene letto solo se almeno una maschera non e' nella cache
+    """
+    desc = model['desc'] if model is not None else open_model(modello)
+    for i in runs:
+        for var in ("tmpsfc", "rhsfc", "wind10m"):
+            key = model_stage_key(desc, i, var, 'memory')
+            cached = load_stage(key)
+            if cached is not None:
+                register_product(workspace, i, var, cached['mask'], 'model', cached['geotransform'].tolist(), key)
+                continue
+
+            if model is None:
+                model = fetch_model(modello)
+            if i >= model['desc']['tdef']['n']:
+                raise IndexError('Tempo ' + str(i) + ' non presente nel modello ' + modello)
+            model_geotransform = grads.geotransform(model['desc'])
+            data = model['fields'][(i, var)]
+            if var in model_scale:
+                data = data * model_scale[var]
+            if driver.ShortName == 'RST':
+                data = np.flip(data, axis=0)
+
+            mask = threshold_mask(data, get_threshold('threshold_' + var), undef=model_undef_value(model['desc'], var))
+            save_stage(key, {'mask': mask, 'geotransform': np.array(model_geotransform)})
+            register_product(workspace, i, var, mask, 'model', model_geotransform, key)
+    model = None
+
+
+def models_threshold(workspace, modello, runs=model_runs):
+    """Ogni campo passa da un raster nell'area di lavoro; il descrittore viene letto una sola volta"""
+    desc = open_model(modello)
+    model_geotransform = grads.geotransform(desc)
+    for i in runs:
+        for var in ("tmpsfc", "rhsfc", "wind10m"):
+            key = model_stage_key(desc, i, var, 'file')
+            cached = load_stage(key)
+            if cached is not None:
+                register_product(workspace, i, var, cached['mask'], 'model', cached['geotransform'].tolist(), key)
+                continue
+
+            if i >= desc['tdef']['n']:
+                raise IndexError('Tempo ' + str(i) + ' non presente nel modello ' + modello)
+            """Copia in float32 nativo (il .gra puo' essere big endian)"""
+            data = grads.variable(desc, var, i).astype(np.float32)
+            if var in model_scale:
+                data *= model_scale[var]
+
+            dataset = write_geotiff_file(
+                data[np.newaxis],
+                workspace_file(workspace, var + '_Run' + str(i)),
+                'model',
+                model_geotransform
             )
+            mask = threshold_mask(dataset.ReadAsArray(), get_threshold('threshold_' + var),
+                                  undef=model_undef_value(desc, var))
             dataset = None
-            f.close
+            save_stage(key, {'mask': mask, 'geotransform': np.array(model_geotransform)})
+            register_product(workspace, i, var, mask, 'model', model_geotransform, key)
+    desc = None
 
 
-def risk_threshold(giorno, rischio_dir):
+def risk_threshold(workspace, rischio_dir, runs=model_runs):
     runRange = {'1': 'Run0', '2': 'Run1', '3': 'Run2'}
-
-    for value in runRange.values():
-        src_ds_dmc = gdal.Open(rischio_dir + "/" + "modello_Rdmc_" + value + "_" + giorno + ".rst")
-        src_band_dmc = src_ds_dmc.GetRasterBand(1).ReadAsArray()
-        threshold_calc(
-                write_geotiff_file(
-                    src_band_dmc,
-                    tmp_directory + 'rdmc_' + value + '_' + giorno + driver_ext,
-                    'rst'
-                ),
-            tmp_directory + 'rdmc_' + value + '_threshold_' + giorno + driver_ext,
-            get_threshold('threshold_dmc'),
-            'rst'
-        )
-        dataset = None
-        src_ds_dmc = None
-
-    for value in runRange.values():
-        src_ds_ffmc = gdal.Open(rischio_dir + "/" + "modello_Rfff_" + value + "_" + giorno + ".rst")
-        src_band_ffmc = src_ds_ffmc.GetRasterBand(1).ReadAsArray()
-        threshold_calc(
-            write_geotiff_file(
-                src_band_ffmc,
-                tmp_directory + 'rfff_' + value + '_' + giorno + driver_ext,
-                'rst'
-            ),
-            tmp_directory + 'rfff_' + value + '_threshold_' + giorno + driver_ext,
-            get_threshold('threshold_ffmc'),
-            'rst'
-        )
-        dataset = None
-        src_ds_ffmc = None
+    giorno = workspace['giorno']
+
+    for criterion, prefix in risk_products.items():
+        for i, value in enumerate(runRange.values()):
+            if i not in runs:
+                continue
+            filename = risk_filename(rischio_dir, prefix, value, giorno)
+            key = risk_stage_key(filename, criterion)
+            try:
+                mask = cached_stage(
+                    key,
+                    lambda: {'mask': threshold_mask(fetch_raster(filename), get_threshold('threshold_' + criterion))}
+                )['mask']
+            except IOError:
+                if os.path.exists(filename):
+                    raise
+                missing_input(workspace, i, criterion, [filename])
+                continue
+            register_product(workspace, i, criterion, mask, 'rst', key=key)
 
 
 """
 Calcolo numero giorni senza pioggia
+
+Lo stato (buffer circolare delle bitmap giorno secco/piovoso + conteggio)
+viene salvato in cache_directory: ogni giorno si legge un solo raster,
+si toglie il giorno piu' vecchio e si aggiunge il nuovo.
+Se manca un giorno rispetto allo stato salvato la finestra viene ricostruita.
 """
-def prec_threshold(giorno):
-    def prec_sum(prec_data):
-        prec_data_len = len(prec_data)
-        prec_num_sum = []
-        for i in range(prec_data_len):
-            prec = prec_data[i].ReadAsArray()
+def prec_filename(prec_date):
+    return metout_directory + "toscana_Prec_dem1000_1_1_263_239_" + prec_date + ".rst"
+
+
+def prec_window_files(giorno, finestra):
+    """Raster giornalieri della finestra che precede <giorno>"""
+    end_date = datetime.strptime(giorno, "%Y-%m-%d").date() - timedelta(days=1)
+    return [
+        prec_filename((end_date - timedelta(days=n)).strftime("%Y-%m-%d"))
+        for n in range(finestra - 1, -1, -1)
+    ]
+
+
+"""Cubo della pioggia aperto una sola volta e condiviso dai worker in modalita' batch"""
+shared_prec_cube = None
+
+def read_prec_window(start_date, end_date):
+    """
+    Pioggia giornaliera [start_date, end_date] come array (giorni, righe, colonne).
+    Se il cubo (prec_cube.py) copre la finestra la lettura e' una sola slice,
+    altrimenti si apre un raster per giorno.
+    """
+    cube = shared_prec_cube
+    if cube is None:
+        cube = prec_cube.open_cube(prec_cube_directory)
+    if prec_cube.has_window(cube, start_date, end_date):
+        return prec_cube.read_window(cube, start_date, end_date)
+
+    list_prec = []
+    for n in range((end_date - start_date).days + 1):
+        prec_date = (start_date + timedelta(days=n)).strftime("%Y-%m-%d")
+        list_prec.append(fetch_raster(prec_filename(prec_date)))
+    return np.stack(list_prec)
 
-            temp1 = np.less(prec, 5)
-            np.putmask(prec, temp1, 1)
 
-            temp2 = np.greater_equal(prec, 5)
-            np.putmask(prec, temp2, -9999)
+def read_dry_day(prec_date):
+    """Bitmap del giorno: 1 giorno senza pioggia, 0 giorno piovoso"""
+    prec_date = datetime.strptime(prec_date, "%Y-%m-%d").date()
+    return np.less(read_prec_window(prec_date, prec_date)[0], prec_dry_limit)
 
-            temp3 = np.equal(prec, -9999)
-            np.putmask(prec, temp3, 0)
 
-            prec_num_sum.append(prec)
+def dry_days_state_filename(finestra):
+    return cache_directory + 'prec_dry_days_' + str(finestra) + '.npz'
 
-        prec_tot = sum(prec_num_sum)
 
-        outData = driver.Create(
-            tmp_directory + 'prec_' + giorno + driver_ext,
-            239,
-            263,
-            1,
-            gdal.GDT_Float32)
+def load_dry_days_state(finestra):
+    filename = dry_days_state_filename(finestra)
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as data:
+        return {
+            'end_date': datetime.strptime(str(data['end_date']), "%Y-%m-%d").date(),
+            'head': int(data['head']),
+            'dry': np.unpackbits(data['dry'], axis=-1, count=prec_ncols).astype(bool),
+            'count': data['count']
+        }
+
+
+def save_dry_days_state(finestra, state):
+    os.makedirs(cache_directory, exist_ok=True)
+    filename = dry_days_state_filename(finestra)
+    tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez(
+            f,
+            end_date=state['end_date'].strftime("%Y-%m-%d"),
+            head=state['head'],
+            dry=np.packbits(state['dry'], axis=-1),
+            count=state['count']
+        )
+    os.replace(tmp_filename, filename)
 
-        outData.SetGeoTransform(get_geotransform('prec'))
 
-        outData.SetProjection(wkt_projection_prec)
-        outData.GetRasterBand(1).WriteArray(prec_tot)
-        outData.GetRasterBand(1).SetNoDataValue(-9999)
+def rebuild_dry_days(end_date, finestra):
+    """Ricostruisco la finestra completa [end_date - finestra + 1, end_date]"""
+    dry = np.less(read_prec_window(end_date - timedelta(days=finestra - 1), end_date), prec_dry_limit)
+    return {
+        'end_date': end_date,
+        'head': 0,
+        'dry': dry,
+        'count': dry.sum(axis=0, dtype=np.uint16)
+    }
 
-        # CREO LE SOGLIE PER LA PIOGGIA
-        outDataArray = outData.ReadAsArray()
 
-        temp1 = np.less(outDataArray, get_threshold('threshold_prec')[0])
-        np.putmask(outDataArray, temp1, -9999)
+def dry_days_count(giorno, finestra=prec_window, stato=True):
+    """
+    Numero di giorni senza pioggia negli ultimi <finestra> giorni prima di <giorno>
+    Con stato=False la finestra viene letta per intero senza leggere o aggiornare lo stato salvato
+    """
+    end_date = datetime.strptime(giorno, "%Y-%m-%d").date() - timedelta(days=1)
+    if not stato:
+        return rebuild_dry_days(end_date, finestra)['count']
+
+    state = load_dry_days_state(finestra)
+
+    if state is not None and state['end_date'] == end_date:
+        return state['count']
+
+    if state is not None and state['end_date'] == end_date - timedelta(days=1):
+        """Aggiornamento incrementale: il giorno nuovo sostituisce il piu' vecchio"""
+        head = state['head']
+        dry = read_dry_day(end_date.strftime("%Y-%m-%d"))
+        state['count'] -= state['dry'][head]
+        state['count'] += dry
+        state['dry'][head] = dry
+        state['head'] = (head + 1) % finestra
+        state['end_date'] = end_date
+        save_dry_days_state(finestra, state)
+        return state['count']
+
+    rebuilt = rebuild_dry_days(end_date, finestra)
+    if state is None or state['end_date'] < end_date:
+        """Non sovrascrivo lo stato con una finestra piu' vecchia (rielaborazioni)"""
+        save_dry_days_state(finestra, rebuilt)
+    return rebuilt['count']
+
+
+def advance_dry_days(giorno, finestra):
+    """
+    Con il conteggio preso dalla cache porto comunque lo stato della finestra mobile a <giorno>,
+    cosi' il giorno successivo resta un aggiornamento incrementale.
+    Lo stato gia' piu' avanti (rielaborazioni) non viene toccato.
+    """
+    end_date = datetime.strptime(giorno, "%Y-%m-%d").date() - timedelta(days=1)
+    state = load_dry_days_state(finestra)
+    if state is not None and state['end_date'] >= end_date:
+        return
+    try:
+        dry_days_count(giorno, finestra, True)
+    except IOError:
+        """Il conteggio c'e' gia': lo stato verra' ricostruito quando i dati saranno disponibili"""
+        pass
 
-        temp2 = np.greater(outDataArray, get_threshold('threshold_prec')[1])
-        np.putmask(outDataArray, temp2, -9999)
 
-        temp3 = np.logical_and([np.greater_equal(outDataArray, get_threshold('threshold_prec')[0])],
-                               [np.less_equal(outDataArray, get_threshold('threshold_prec')[1])])
-        np.putmask(outDataArray, temp3, 1)
+def prec_threshold(workspace, finestra=prec_window, stato=True):
+    key = prec_stage_key(workspace['giorno'], finestra)
+    try:
+        cached = load_stage(key)
+        if cached is not None:
+            prec_tot = cached['count']
+            if stato:
+                advance_dry_days(workspace['giorno'], finestra)
+        else:
+            prec_tot = dry_days_count(workspace['giorno'], finestra, stato)
+            save_stage(key, {'count': prec_tot})
+    except IOError:
+        """Se mancano dei giorni di pioggia la maschera finale viene calcolata senza questo criterio"""
+        missing = [filename for filename in prec_window_files(workspace['giorno'], finestra) if not os.path.exists(filename)]
+        if not missing:
+            raise
+        missing_input(workspace, None, 'prec', missing)
+        return
 
-        temp4 = np.equal(outDataArray, -9999)
-        np.putmask(outDataArray, temp4, 0)
+    # CREO LE SOGLIE PER LA PIOGGIA
+    threshold = get_threshold('threshold_prec')
+    register_product(workspace, None, 'prec', threshold_mask(prec_tot, threshold), 'prec',
+                     key=prec_product_key(workspace['giorno'], finestra, key))
 
-        outDataPrec = driver.Create(
-            tmp_directory + 'prec_threshold_' + giorno + driver_ext,
-            239,
-            263,
-            1,
-            gdal.GDT_Float32)
 
-        outDataPrec.SetGeoTransform(get_geotransform('prec'))
+def window_mask(criteria, required):
+    """Finestra aperta (1) dove tutti i bit di <required> sono accesi"""
+    return np.equal(np.bitwise_and(criteria, required), required).view(np.uint8)
 
-        outDataPrec.SetProjection(wkt_projection_prec)
-        outDataPrec.GetRasterBand(1).WriteArray(outDataArray)
-        outDataPrec.GetRasterBand(1).SetNoDataValue(-9999)
 
-        outData = None
-        outDataPrec = None
+def product_filename(product, run, giorno):
+    fmt = output_backend.product_format(product_formats, product)
+    return (output_directory + 'fire_presc_' + product + '_Run' + str(run) + '_' + giorno +
+            output_backend.output_extensions[fmt])
 
-    def daterange(start_date, end_date):
-        for n in range(int((end_date - start_date).days)):
-            yield start_date + timedelta(n)
 
-    start_date = datetime.strptime(giorno, "%Y-%m-%d").date() # - timedelta(days=1)
-    end_date = start_date - timedelta(days=7)
-    list_prec = []
-    for single_date in daterange(end_date, start_date):
-        #print(single_date.strftime("%Y-%m-%d"))
-        prec_date = single_date.strftime("%Y-%m-%d")
-        src_ds_prec = gdal.Open("../../metout/toscana_Prec_dem1000_1_1_263_239_" + prec_date + ".rst")
-        list_prec.append(src_ds_prec)
-    src_ds_prec = None
-    prec_sum(list_prec)
-
-
-def tot_threshold(giorno):
-    directory = os.fsencode(tmp_directory)
-    filelists = os.listdir(directory)
-    for i in range(3):
-        array_mul = []
-        for file in filelists:
-            filename = os.fsdecode(file)
-            if fnmatch.fnmatch(filename, '*Run' + str(i) + '_threshold_' + giorno + driver_ext) or fnmatch.fnmatch(filename, 'prec_threshold_' + giorno + driver_ext):
-                raster = gdal.Open(tmp_directory + filename)
-                if fnmatch.fnmatch(filename, 'prec_threshold_' + giorno + driver_ext):
-                    ds_array = raster.ReadAsArray()
-                    array_mul.append(ds_array)
+def write_criteria_file(criteria, required, filename, missing=()):
+    """Scrivo il raster diagnostico: un byte per pixel, un bit per criterio"""
+    output_backend.write_raster(
+        filename,
+        criteria,
+        get_geotransform('prec'),
+        wkt_projection_prec,
+        gdal.GDT_Byte,
+        output_backend.product_format(product_formats, 'criteria'),
+        metadata=dict(
+            [('BIT_' + str(bit), name) for name, bit in criteria_bits.items()] +
+            [('REQUIRED', str(required))] +
+            partial_metadata(missing)
+        )
+    )
+
+
+def partial_metadata(missing):
+    """Prodotto parziale: criteri esclusi perche' mancano i loro input"""
+    if not missing:
+        return []
+    return [('PARTIAL', '1'), ('MISSING', ','.join(missing))]
+
+
+def tot_threshold(workspace, runs=model_runs):
+    giorno = workspace['giorno']
+    for i in runs:
+        products = [
+            (criterion, product)
+            for (run, criterion), product in list(workspace['prodotti'].items())
+            if run is None or run == i
+        ]
+        missing = sorted(set(
+            criterion for (run, criterion) in list(workspace['mancanti'])
+            if run is None or run == i
+        ))
+
+        """La maschera finale e' nella cache se tutte le maschere che la compongono lo sono"""
+        key = None
+        if all(product['key'] is not None for criterion, product in products):
+            key = stage_key(
+                'combine',
+                sorted((criterion, product['key']) for criterion, product in products),
+                get_geotransform('prec'))
+        cached = load_stage(key)
+
+        if cached is not None:
+            criteria = cached['criteria']
+            required = int(cached['required'])
+        else:
+            criteria = np.zeros((prec_nrows, prec_ncols), dtype=np.uint8)
+            required = 0
+            for criterion, product in products:
+                if product['transformparams'] == 'prec':
+                    passed = np.greater_equal(product['mask'], 0.5)
                 else:
-                    """Only for gdal 1.9.0"""
-                    subprocess.call('gdalwarp ' + tmp_directory + filename + ' ' + tmp_directory + 'temp.rst -s_srs "EPSG:4326" -t_srs "EPSG:32632" -of RST -tr 1000 1000 -r bilinear -te 548174.9000000000232831 4670721.0000000000000000 787174.9000000000232831 4933721.0000000000000000', shell=True)
-
-                    """PROVA"""
-                    rasterrst = gdal.Open(tmp_directory + 'temp.rst')
-                    ds_array = rasterrst.ReadAsArray()
-                    array_mul.append(ds_array)
-                    rasterrst = None
-                    os.remove(tmp_directory + 'temp.rst')
-
-                    """For gdal > 2"""
-                    """BUONO"""
-                    #ds = gdal.Warp(
-                    #    '',
-                    #    raster,
-                    #    targetAlignedPixels=False,
-                    #    outputBounds=[
-                    #        548174.9000000000232831,
-                    #        4670721.0000000000000000,
-                    #        787174.9000000000232831,
-                    #        4933721.0000000000000000
-                    #    ],
-                    #    dstSRS='EPSG:32632',
-                    #    srcSRS='EPSG:4326',
-                    #    format='VRT',
-                    #    outputType=gdal.GDT_Float32,
-                    #    xRes=1000,
-                    #    yRes=1000,
-                    #    resampleAlg=gdalconst.GRIORA_NearestNeighbour
-                    #)
-                    #ds_array = ds.ReadAsArray()
-                    #array_mul.append(ds_array)
-                ds_array = None
-                ds = None
-                raster = None
-
-        final_data = reduce((lambda x, y: x * y), array_mul)
-
-        array_mul_data = driver.Create(
-            '/mnt/hd/operativo/risout_prev/arw/fire_presc_threshold_Run' + str(i) + '_' + giorno + driver_ext,
-            239,
-            263,
-            1,
-            gdal.GDT_Byte)
-
-        array_mul_data.SetGeoTransform(get_geotransform('prec'))
-
-        array_mul_data.SetProjection(wkt_projection_prec)
-        array_mul_data.GetRasterBand(1).WriteArray(final_data)
-        array_mul_data.GetRasterBand(1).SetNoDataValue(0)
-
-        array_mul_data = None
-
-    #for file in filelists:
-    #    filename = os.fsdecode(file)
-    #    os.remove(tmp_directory + filename)
+                    """Riproietto con la tabella precalcolata invece di gdalwarp"""
+                    table = get_warp_table(product['geotransform'], product['mask'].shape)
+                    passed = np.greater_equal(warp_array(product['mask'], table), 0.5)
+
+                bit = criteria_bits[criterion]
+                criteria |= passed.view(np.uint8) << bit
+                required |= 1 << bit
+            save_stage(key, {'criteria': criteria, 'required': np.array(required)})
+
+        write_criteria_file(
+            criteria,
+            required,
+            product_filename('criteria', i, giorno),
+            missing
+        )
 
-def print_error_log(day, log, e):
-        logger = logging.getLogger('fuoco_prescritto')
-        hdlr = logging.FileHandler('/mnt/hd/operativo/log/fuoco_prescritto_{1}_{0}.log'.format(day, log))
+        final_data = window_mask(criteria, required)
+
+        output_backend.write_raster(
+            product_filename('threshold', i, giorno),
+            final_data,
+            get_geotransform('prec'),
+            wkt_projection_prec,
+            gdal.GDT_Byte,
+            output_backend.product_format(product_formats, 'threshold'),
+            nodata=0,
+            metadata=dict(partial_metadata(missing))
+        )
+
+        if datacube_filename is not None:
+            with stage_metrics.stage('datacube', run=i):
+                datacube.append_product(
+                    datacube_filename,
+                    fire_datacube_grid(),
+                    datacube.fire_variables,
+                    datetime.strptime(giorno, "%Y-%m-%d"),
+                    {'threshold': final_data, 'criteria': criteria},
+                    run=i
+                )
+
+        if zonal_zones:
+            with stage_metrics.stage('zonal', run=i):
+                zonal_stats.zonal_stats(
+                    zonal_zones,
+                    zones_cache_directory,
+                    final_data,
+                    zonal_classes,
+                    get_geotransform('prec'),
+                    wkt_projection_prec,
+                    output_directory + 'fire_presc_zonal_{zones}_Run' + str(i) + '_' + giorno + '.csv'
+                )
+
+
+def fire_datacube_grid():
+    return {
+        'geotransform': get_geotransform('prec'),
+        'rows': prec_nrows,
+        'cols': prec_ncols,
+        'projection': wkt_projection_prec,
+        'geographic': False,
+        'runs': len(model_runs)
+    }
+
+def get_logger(day, log):
+    """Un logger per file di log: l'handler viene aggiunto una sola volta"""
+    logger = logging.getLogger('fuoco_prescritto').getChild('{1}_{0}'.format(day, log))
+    if not logger.handlers:
+        hdlr = logging.FileHandler(log_directory + 'fuoco_prescritto_{1}_{0}.log'.format(day, log))
         formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
         hdlr.setFormatter(formatter)
         logger.addHandler(hdlr)
-        logger.setLevel(logging.ERROR)
-        logger.error('Error: {0}'.format(e))
+        logger.setLevel(logging.WARNING)
+    return logger
+
+def log_error(day, log, e):
+        get_logger(day, log).error('Error: {0}'.format(e))
+
+def log_partial(day, missing):
+        get_logger(day, 'partial').warning('Prodotto parziale, input mancanti: {0}'.format(', '.join(missing)))
+
+def print_error_log(day, log, e):
+        log_error(day, log, e)
 
         sys.exit(2)
 
+def write_stage_metrics(metrics_dir, extra):
+    """Le misure non devono far fallire l'elaborazione"""
+    if metrics_dir is None:
+        return
+    try:
+        stage_metrics.write_metrics('calc_fuoco_prescritto', metrics_dir, time.time() - start_time, extra)
+    except Exception as e:
+        print(e)
+
 def print_usage():
-    print("calc_fuoco_prescritto.py -d <day> -m <model> -r <rischio>")
+    print("calc_fuoco_prescritto.py -d <day> -m <model> -r <rischio> [-i] [-w <window>] [-t <tmp>] [-p <prefetch>] [-n] [--resume] [--metrics <dir>] [--format <fmt>] [--datacube <file.nc>] [--zones <zone>]")
+    print("calc_fuoco_prescritto.py --from <day> --to <day> -m <model> -r <rischio> [-j <workers>] [-w <window>] [-t <tmp>] [-n] [--resume] [--metrics <dir>] [--format <fmt>] [--datacube <file.nc>] [--zones <zone>]")
+    print("    in modalita' batch {day} in <model> e <rischio> viene sostituito con il giorno elaborato")
+    print("    senza -t i file intermedi restano in /vsimem/")
+    print("    -p imposta i thread di lettura anticipata degli input (0 per disattivarla)")
+    print("    -n ricalcola tutte le fasi senza usare la cache dei risultati")
+    print("    --format <fmt> formato dei prodotti finali: rst (default), gtiff, cog; per prodotto threshold=cog,criteria=rst")
+    print("    --datacube <file.nc> aggiunge maschera finale e criteri di ogni run al cubo NetCDF (richiede netCDF4)")
+    print("    --zones comuni=comuni.shp:NOME,... scrive per ogni insieme di zone un csv con l'area della finestra per zona")
+    print("    --metrics <dir> scrive le misure delle fasi (json e prometheus), --tracemalloc aggiunge il picco della memoria Python")
+    print("    --resume riparte dalle fasi fallite o parziali usando i checkpoint del giorno")
+    print("    se mancano indici di rischio o pioggia la maschera finale viene segnata come parziale (PARTIAL)")
+
+
+def process_day(day, model, rischio_dir, in_memory=False, finestra=prec_window, stato=True, scratch=None, prefetch=prefetch_workers, resume=False):
+    """Eseguo la catena per un giorno; restituisce (fase, errore) della prima fase fallita o None"""
+    workspace = create_workspace(day, scratch)
+    workspace['resume'] = resume
+    workspace['manifest'] = load_manifest(day, resume)
+    try:
+        prefetch = start_prefetch(day, model, rischio_dir, in_memory, finestra, stato, prefetch)
+    except Exception:
+        """La lettura anticipata e' solo un'ottimizzazione: gli errori emergono nelle fasi"""
+        prefetch = None
+    try:
+        error = run_stages(workspace, model, rischio_dir, in_memory, finestra, stato)
+        if finish_manifest(workspace, error) == 'partial':
+            log_partial(day, sorted(set(criterion for (run, criterion) in workspace['mancanti'])))
+        return error
+    finally:
+        stop_prefetch(prefetch)
+        cleanup_workspace(workspace)
+
+
+def run_stages(workspace, model, rischio_dir, in_memory, finestra, stato):
+    """
+    Ogni fase salva un checkpoint: un errore non ferma le fasi indipendenti
+    e la maschera finale di un run viene calcolata solo se le sue fasi sono riuscite.
+    """
+    """
+    Calcolo le soglie per i giorni di pioggia
+    "../metout/toscana_Prec_dem1000_1_1_263_239_"+prec_date+".rst"
+    threshold_prec = [1, 7]
+
+    Con -w si cambia la finestra (default 7 giorni, es. 15 o 30)
+    La maschera della pioggia e' comune ai tre run e viene calcolata per prima
+    """
+    prec_error = run_stage(workspace, 'prec_threshold', {(None, 'prec'): prec_product_key(workspace['giorno'], finestra)},
+                           prec_threshold, finestra, stato)
+
+    model_fields = None
+    if (in_memory and not model_cached(model, model_runs, 'memory') and
+            not all(stage_done(workspace, 'models_threshold_Run' + str(i)) for i in model_runs)):
+        try:
+            with stage_metrics.stage('read_model'):
+                model_fields = fetch_model(model)
+        except Exception:
+            """L'errore viene riportato dalla fase del modello di ogni run"""
+            model_fields = None
+
+    with ThreadPoolExecutor(max_workers=len(model_runs)) as executor:
+        futures = [
+            executor.submit(process_run, workspace, i, model, model_fields, rischio_dir, in_memory, prec_error is None)
+            for i in model_runs
+        ]
+        results = [future.result() for future in futures]
+
+    # updateAITcache(db_connection, to_data)
+    # db_connection.close()
+
+    if prec_error is not None:
+        return ('prec_threshold', prec_error)
+
+    """Esito deterministico: vale il primo run fallito nell'ordine Run0, Run1, Run2"""
+    for result in results:
+        if result is not None:
+            return result
+    return None
+
+
+def run_error(i, e):
+    return RuntimeError('Run{0}: {1}'.format(i, e))
+
+
+def process_run(workspace, i, model, model_fields, rischio_dir, in_memory, combine=True):
+    """Soglie, riproiezione e maschera finale di un singolo run"""
+    run = 'Run' + str(i)
+
+    """Funzioni per calcolare le soglie"""
+    """
+    Calcolo le soglie per il modello ../metprev/incendi_arw_ecm_3km_run00.gra
+    Le variabili che mi interessano del modello sono:
+     - Temperatura °: threshold_tmpsfc = [0, 18]
+     - Umidità %: threshold_rhsfc = [40, 75]
+     - Intensità del vento (km hr -1): threshold_wind10m = [1, 15]
+
+    Il modello contiene le variabili con media giornaliera giornaliera
+    Contiene 4 tempi -> OGGI, DOMANI, DOPO DOMANI, TERZO GIORNO
+
+    Con -i il file .gra viene letto una sola volta e vengono scritte solo le maschere finali
+    """
+    model_products = model_stage_keys(model, (i,), 'memory' if in_memory else 'file')
+    if in_memory:
+        error = run_stage(workspace, 'models_threshold_' + run, model_products,
+                          models_threshold_memory, model, (i,), model_fields)
+    else:
+        error = run_stage(workspace, 'models_threshold_' + run, model_products,
+                          models_threshold, model, (i,))
+    failed = None
+    if error is not None:
+        failed = ('models_threshold', run_error(i, error))
+
+    """
+    Calcolo le soglie per gli indici di rischio FFMC() e DMC()
+    "../risout_prev/modello_Rfff_Run0_2020-01-29.rst"
+    "../risout_prev/modello_Rfff_Run1_2020-01-29.rst"
+    "../risout_prev/modello_Rfff_Run2_2020-01-29.rst"
+
+    Run0, Run1, Run2
+    threshold_ffmc = [80, 95]
+    threshold_dmc = [0, 20]
+
+    Se manca un file il criterio viene escluso e il prodotto finale e' parziale
+    """
+    risk_keys = dict(
+        ((i, criterion), risk_stage_key(risk_filename(rischio_dir, prefix, run, workspace['giorno']), criterion))
+        for criterion, prefix in risk_products.items())
+    error = run_stage(workspace, 'risk_threshold_' + run, risk_keys, risk_threshold, rischio_dir, (i,))
+    if failed is None and error is not None:
+        failed = ('risk_threshold', run_error(i, error))
+
+    if failed is not None or not combine:
+        return failed
+
+    """
+    Calcolo della maschera finale VERO-FALSO per individuare
+    le finestre ambientali per l'applicazione del fuoco prescritto.
+    """
+    error = run_stage(workspace, 'tot_threshold_' + run, None, tot_threshold, (i,))
+    if error is not None:
+        return ('tot_threshold', run_error(i, error))
+
+    return None
+
+
+def backfill_day(args):
+    """Elaborazione di un giorno in un processo del pool (nessun sys.exit nei worker)"""
+    [day, model, rischio_dir, finestra, scratch, resume] = args
+    error = process_day(
+        day,
+        model.replace('{day}', day),
+        rischio_dir.replace('{day}', day),
+        True,
+        finestra,
+        False,
+        scratch,
+        prefetch_workers,
+        resume
+    )
+    """Le misure del worker vengono restituite al processo principale"""
+    if error is not None:
+        log_error(day, error[0], error[1])
+        return (day, error[0], str(error[1]), stage_metrics.pop_records())
+    return (day, None, None, stage_metrics.pop_records())
+
+
+def worker_settings():
+    """Opzioni di main() per i worker: con spawn o forkserver i globali del processo principale non vengono ereditati"""
+    return {
+        'stage_cache_enabled': stage_cache_enabled,
+        'product_formats': product_formats,
+        'datacube_filename': datacube_filename,
+        'zonal_zones': zonal_zones,
+        'tracemalloc': stage_metrics.tracemalloc_enabled()
+    }
+
+
+def init_worker(settings):
+    """Ogni worker applica le opzioni e apre una volta tabelle di riproiezione e cubo della pioggia"""
+    global stage_cache_enabled, product_formats, datacube_filename, zonal_zones, shared_prec_cube
+    stage_cache_enabled = settings['stage_cache_enabled']
+    product_formats = settings['product_formats']
+    datacube_filename = settings['datacube_filename']
+    zonal_zones = settings['zonal_zones']
+    if settings['tracemalloc']:
+        stage_metrics.enable_tracemalloc()
+    """Le misure ereditate dal processo principale (fork) restano a lui"""
+    stage_metrics.pop_records()
+    load_warp_tables()
+    shared_prec_cube = prec_cube.open_cube(prec_cube_directory)
+
+
+def backfill(from_day, to_day, model, rischio_dir, workers, finestra=prec_window, scratch=None, resume=False):
+    """
+    Rielaborazione di un intervallo di giorni con un pool di processi.
+    Le opzioni arrivano ai worker con init_worker, che carica anche le tabelle di riproiezione
+    e apre il cubo della pioggia (condiviso dai giorni del worker); la pioggia viene letta
+    senza toccare lo stato della finestra mobile.
+    """
+    start_date = datetime.strptime(from_day, "%Y-%m-%d").date()
+    end_date = datetime.strptime(to_day, "%Y-%m-%d").date()
+    days = [
+        (start_date + timedelta(days=n)).strftime("%Y-%m-%d")
+        for n in range((end_date - start_date).days + 1)
+    ]
+
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(worker_settings(),)) as pool:
+        results = pool.map(
+            backfill_day,
+            [(day, model, rischio_dir, finestra, scratch, resume) for day in days],
+            chunksize=1
+        )
+
+    for result in results:
+        stage_metrics.add_records(result[3])
+
+    failed = [result for result in results if result[1] is not None]
+    for [day, stage, error, records] in failed:
+        print("{0} {1}: {2}".format(day, stage, error))
+    return len(failed) == 0
 
 
 def main(argv):
+    global stage_cache_enabled, product_formats, datacube_filename, zonal_zones
     #print("ARGV      :", sys.argv[1:])
+    in_memory = False
+    finestra = prec_window
+    from_day = None
+    to_day = None
+    workers = os.cpu_count()
+    scratch = None
+    prefetch = prefetch_workers
+    resume = False
+    metrics_dir = None
     try:
         # opts is a list of returning key-value pairs, args is the options left after striped
         # the short options 'hi:o:', if an option requires an input, it should be followed by a ":"
         # the long options 'ifile=' is an option that requires an input, followed by a "="
-        opts, args = getopt.getopt(argv, "hd:m:r:", ["help", "day=", "model=", "rischio="])
+        opts, args = getopt.getopt(argv, "hd:m:r:iw:j:t:p:n", ["help", "day=", "model=", "rischio=", "in-memory", "window=", "from=", "to=", "workers=", "tmp=", "prefetch=", "no-cache", "resume", "metrics=", "tracemalloc", "format=", "datacube=", "zones="])
     except getopt.GetoptError as err:
         print(err)  # will print something like "option -a not recognized"
         print_usage()
@@ -465,7 +1523,7 @@ def main(argv):
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print("calc_fuoco_prescritto.py -d <day> -m <model> -r <rischio>")
+            print_usage()
             sys.exit(2)
         elif opt in ("-d", "--day"):
             day = arg
@@ -473,61 +1531,51 @@ def main(argv):
             model = arg
         elif opt in ("-r", "--rischio"):
             rischio_dir = arg
+        elif opt in ("-i", "--in-memory"):
+            in_memory = True
+        elif opt in ("-w", "--window"):
+            finestra = int(arg)
+        elif opt == "--from":
+            from_day = arg
+        elif opt == "--to":
+            to_day = arg
+        elif opt in ("-j", "--workers"):
+            workers = int(arg)
+        elif opt in ("-t", "--tmp"):
+            scratch = arg
+        elif opt in ("-p", "--prefetch"):
+            prefetch = int(arg)
+        elif opt in ("-n", "--no-cache"):
+            stage_cache_enabled = False
+        elif opt == "--resume":
+            resume = True
+        elif opt == "--metrics":
+            metrics_dir = arg
+        elif opt == "--tracemalloc":
+            stage_metrics.enable_tracemalloc()
+        elif opt == "--format":
+            product_formats = output_backend.parse_formats(arg, 'rst')
+        elif opt == "--datacube":
+            datacube_filename = arg
+        elif opt == "--zones":
+            zonal_zones = zonal_stats.parse_zones(arg)
         else:
             assert False, "unhandled option"
 
-    try:
-        """Funzioni per calcolare le soglie"""
-        """
-        Calcolo le soglie per il modello ../metprev/incendi_arw_ecm_3km_run00.gra
-        Le variabili che mi interessano del modello sono:
-         - Temperatura °: threshold_tmpsfc = [0, 18]
-         - Umidità %: threshold_rhsfc = [40, 75]
-         - Intensità del vento (km hr -1): threshold_wind10m = [1, 15]
-
-        Il modello contiene le variabili con media giornaliera giornaliera
-        Contiene 4 tempi -> OGGI, DOMANI, DOPO DOMANI, TERZO GIORNO
-        """
-        models_threshold(day, model)
-    except Exception as e:
-        print_error_log(day, 'models_threshold', e)
-
-    try:
-        """
-        Calcolo le soglie per gli indici di rischio FFMC() e DMC()
-        "../risout_prev/modello_Rfff_Run0_2020-01-29.rst"
-        "../risout_prev/modello_Rfff_Run1_2020-01-29.rst"
-        "../risout_prev/modello_Rfff_Run2_2020-01-29.rst"
-
-        Run0, Run1, Run2
-        threshold_ffmc = [80, 95]
-        threshold_dmc = [0, 20]
-        """
-        risk_threshold(day, rischio_dir)
-    except Exception as e:
-        print_error_log(day, 'risk_threshold', e)
-
-    try:
-        """
-        Calcolo le soglie per i giorni di pioggia
-        "../metout/toscana_Prec_dem1000_1_1_263_239_"+prec_date+".rst"
-        threshold_prec = [1, 7]
-        """
-        prec_threshold(day)
-    except Exception as e:
-        print_error_log(day, 'prec_threshold', e)
-
-    try:
-        """
-        Calcolo della maschera finale VERO-FALSO per individuare
-        le finestre ambientali per l'applicazione del fuoco prescritto.
-        """
-        tot_threshold(day)
-    except Exception as e:
-        print_error_log(day, 'tot_threshold', e)
+    if from_day is not None or to_day is not None:
+        if from_day is None or to_day is None:
+            print_usage()
+            sys.exit(2)
+        success = backfill(from_day, to_day, model, rischio_dir, workers, finestra, scratch, resume)
+        write_stage_metrics(metrics_dir, {'from': from_day, 'to': to_day})
+        if not success:
+            sys.exit(2)
+        return
 
-    # updateAITcache(db_connection, to_data)
-    # db_connection.close()
+    error = process_day(day, model, rischio_dir, in_memory, finestra, True, scratch, prefetch, resume)
+    write_stage_metrics(metrics_dir, {'day': day})
+    if error is not None:
+        print_error_log(day, error[0], error[1])
 
 if __name__ == '__main__':
     main(sys.argv[1:])
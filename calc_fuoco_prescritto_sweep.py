@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+Analisi di sensibilita' delle soglie per il fuoco prescritto.
+
+I campi del giorno (modello, indici di rischio FFMC/DMC, giorni senza pioggia)
+vengono letti una sola volta; per ogni variabile si indica una lista di soglie
+candidate in un file json, ad esempio:
+
+{
+    "threshold_tmpsfc": [[-5, 20], [0, 18]],
+    "threshold_rhsfc": [[40, 75], [40, 80]],
+    "threshold_ffmc": [[75, 95], [80, 95]]
+}
+
+Le variabili non indicate usano le soglie di threshold_dict.
+Per ogni run vengono calcolate, con un unico broadcast sulle maschere gia' riproiettate,
+l'area della finestra per ogni combinazione di soglie (csv) e la frequenza per pixel
+(frazione delle combinazioni con finestra aperta, raster Float32).
+"""
+
+import os
+import sys
+import getopt
+import csv
+import json
+import itertools
+import numpy as np
+from osgeo import gdal
+import time
+start_time = time.time()
+
+import calc_fuoco_prescritto as fp
+
+"""Memoria massima (byte) per il blocco combinazioni x pixel"""
+sweep_block_bytes = 64 * 1024 * 1024
+
+sweep_criteria = ("tmpsfc", "rhsfc", "wind10m", "ffmc", "dmc", "prec")
+
+
+def read_sweep_file(filename):
+    """Soglie candidate per criterio (una sola coppia se il criterio non e' nel file)"""
+    with open(filename) as f:
+        sweep = json.load(f)
+    candidates = {}
+    for criterion in sweep_criteria:
+        candidates[criterion] = [list(bounds) for bounds in sweep.get(
+            'threshold_' + criterion, [fp.get_threshold('threshold_' + criterion)])]
+    return candidates
+
+
+def load_fields(giorno, modello, rischio_dir, finestra):
+    """Leggo una sola volta i campi del giorno: {run: {criterio: (dati, transformparams, geotransform, undef)}}"""
+    fields = {0: {}, 1: {}, 2: {}}
+
+    model = fp.open_model(modello)
+    model_geotransform = fp.grads.geotransform(model)
+    for i in range(3):
+        for var in ("tmpsfc", "rhsfc", "wind10m"):
+            data = np.array(fp.grads.variable(model, var, i))
+            if var in fp.model_scale:
+                data = data * fp.model_scale[var]
+            if fp.driver.ShortName == 'RST':
+                data = np.flip(data, axis=0)
+            fields[i][var] = (data, 'model', model_geotransform, fp.model_undef_value(model, var))
+    model = None
+
+    for criterion, prefix in fp.risk_products.items():
+        for i in range(3):
+            data = fp.read_raster(fp.risk_filename(rischio_dir, prefix, 'Run' + str(i), giorno))
+            fields[i][criterion] = (data, 'rst', None, fp.model_undef)
+
+    prec_tot = fp.dry_days_count(giorno, finestra, False)
+    for i in range(3):
+        fields[i]['prec'] = (prec_tot, 'prec', None, fp.model_undef)
+
+    return fields
+
+
+def candidate_masks(data, transformparams, geotransform, undef, candidates):
+    """Maschere (candidati, pixel) sulla griglia prec per tutte le soglie candidate di un criterio"""
+    stack = np.empty((len(candidates),) + data.shape, dtype=bool)
+    for k, threshold in enumerate(candidates):
+        fp.threshold_mask(data, threshold, out=stack[k], undef=undef)
+
+    if transformparams != 'prec':
+        table = fp.get_warp_table(fp.product_geotransform(transformparams, data.shape[0], geotransform), data.shape)
+        stack = np.greater_equal(fp.warp_stack(stack.view(np.uint8), table), 0.5)
+
+    return stack.reshape(len(candidates), -1)
+
+
+def sweep_run(masks):
+    """
+    masks: lista di array (K_v, pixel), uno per criterio.
+    Restituisce l'area (pixel) per ogni combinazione, con forma (K_1, ..., K_n),
+    e la frequenza per pixel della finestra aperta sulle combinazioni.
+    """
+    shape = tuple(len(m) for m in masks)
+    ncombinations = int(np.prod(shape))
+    npixels = masks[0].shape[1]
+
+    """Frequenza: le combinazioni sono un prodotto cartesiano, quindi si fattorizza per criterio"""
+    frequency = np.ones(npixels, dtype=np.float64)
+    for m in masks:
+        frequency *= m.sum(axis=0)
+    frequency /= ncombinations
+
+    area = np.zeros(ncombinations, dtype=np.int64)
+    block = max(1, sweep_block_bytes // ncombinations)
+    for start in range(0, npixels, block):
+        joint = masks[0][:, start:start + block]
+        for m in masks[1:]:
+            joint = np.logical_and(
+                joint[:, None, :],
+                m[None, :, start:start + block]
+            ).reshape(-1, joint.shape[-1])
+        area += joint.sum(axis=1)
+
+    return area.reshape(shape), frequency.reshape(fp.prec_nrows, fp.prec_ncols)
+
+
+def write_sweep_csv(filename, candidates, area):
+    pixel_km2 = abs(fp.get_geotransform('prec')[1] * fp.get_geotransform('prec')[5]) / 1e6
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        header = []
+        for criterion in sweep_criteria:
+            header += [criterion + '_min', criterion + '_max']
+        writer.writerow(header + ['area_pixel', 'area_km2'])
+        for index in itertools.product(*[range(len(candidates[c])) for c in sweep_criteria]):
+            row = []
+            for criterion, k in zip(sweep_criteria, index):
+                row += candidates[criterion][k]
+            writer.writerow(row + [int(area[index]), float(area[index]) * pixel_km2])
+
+
+def write_frequency_file(frequency, filename):
+    outData = fp.driver.Create(
+        filename,
+        fp.prec_ncols,
+        fp.prec_nrows,
+        1,
+        gdal.GDT_Float32)
+
+    outData.SetGeoTransform(fp.get_geotransform('prec'))
+
+    outData.SetProjection(fp.wkt_projection_prec)
+    outData.GetRasterBand(1).WriteArray(frequency.astype(np.float32))
+    outData = None
+
+
+def threshold_sweep(giorno, modello, rischio_dir, sweep_file, output_dir, finestra=fp.prec_window):
+    candidates = read_sweep_file(sweep_file)
+    fields = load_fields(giorno, modello, rischio_dir, finestra)
+
+    for i in range(3):
+        masks = []
+        for criterion in sweep_criteria:
+            [data, transformparams, geotransform, undef] = fields[i][criterion]
+            masks.append(candidate_masks(data, transformparams, geotransform, undef, candidates[criterion]))
+        area, frequency = sweep_run(masks)
+
+        write_sweep_csv(
+            os.path.join(output_dir, 'fire_presc_sweep_Run' + str(i) + '_' + giorno + '.csv'),
+            candidates,
+            area
+        )
+        write_frequency_file(
+            frequency,
+            os.path.join(output_dir, 'fire_presc_sweep_frequency_Run' + str(i) + '_' + giorno + fp.driver_ext)
+        )
+
+
+def print_usage():
+    print("calc_fuoco_prescritto_sweep.py -d <day> -m <model> -r <rischio> -s <sweep.json> -o <output> [-w <window>]")
+
+
+def main(argv):
+    finestra = fp.prec_window
+    output_dir = '.'
+    try:
+        opts, args = getopt.getopt(argv, "hd:m:r:s:o:w:", ["help", "day=", "model=", "rischio=", "sweep=", "output=", "window="])
+    except getopt.GetoptError as err:
+        print(err)
+        print_usage()
+        sys.exit(2)
+    if not opts:
+        print_usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_usage()
+            sys.exit(2)
+        elif opt in ("-d", "--day"):
+            day = arg
+        elif opt in ("-m", "--model"):
+            model = arg
+        elif opt in ("-r", "--rischio"):
+            rischio_dir = arg
+        elif opt in ("-s", "--sweep"):
+            sweep_file = arg
+        elif opt in ("-o", "--output"):
+            output_dir = arg
+        elif opt in ("-w", "--window"):
+            finestra = int(arg)
+        else:
+            assert False, "unhandled option"
+
+    try:
+        threshold_sweep(day, model, rischio_dir, sweep_file, output_dir, finestra)
+    except Exception as e:
+        print(e)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+    print("--- %s seconds ---" % (time.time() - start_time))
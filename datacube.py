@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""
+Archivio a cubo (NetCDF4/HDF5) dei prodotti giornalieri.
+
+Invece di un file per giorno, run e prodotto, ogni elaborazione aggiunge le proprie
+slice a un unico file con dimensioni (time, [run,] y, x), chunk lungo tempo e spazio,
+compressione zlib e coordinate CF (x/y o lon/lat, time, crs con il WKT).
+Le interrogazioni (serie storica in un punto, aggregati stagionali) leggono solo
+i chunk che contengono i dati richiesti.
+
+Le scritture sono serializzate con un lock su <file>.lock (thread e processi);
+un giorno gia' presente viene sovrascritto, quindi le rielaborazioni non duplicano i tempi.
+
+Il modulo netCDF4 e' opzionale: serve solo se si usa --datacube.
+
+datacube.py -f <cubo.nc> -v <variabile> --point <x>,<y> [--run <n>] [--from <data>] [--to <data>]
+datacube.py -f <cubo.nc> -v <variabile> --aggregate <mean|max|sum> -o <raster> [--run <n>] [--from <data>] [--to <data>]
+"""
+
+import os
+import sys
+import getopt
+import csv
+import json
+import fcntl
+import numpy as np
+from contextlib import contextmanager
+from datetime import datetime
+import time
+start_time = time.time()
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+time_units = 'hours since 1970-01-01 00:00:00'
+datacube_chunk_time = 32
+datacube_chunk_space = 64
+
+"""Variabili dei prodotti: nome -> (tipo, fill value, descrizione)"""
+fire_variables = {
+    'threshold': ('u1', 255, 'Finestra per il fuoco prescritto (1 aperta)'),
+    'criteria': ('u1', 255, 'Criteri soddisfatti, un bit per criterio')
+}
+haines_variables = {
+    'haines_class': ('u1', 255, 'Classe dell\'indice di Haines (1 molto basso - 4 alto)')
+}
+
+
+def require_netcdf():
+    if netCDF4 is None:
+        raise ImportError('Il cubo richiede il modulo netCDF4 (pip install netCDF4)')
+
+
+def grid_coordinates(geotransform, rows, cols):
+    """Centri dei pixel lungo x e y"""
+    x = geotransform[0] + (np.arange(cols) + 0.5) * geotransform[1]
+    y = geotransform[3] + (np.arange(rows) + 0.5) * geotransform[5]
+    return x, y
+
+
+@contextmanager
+def store_lock(filename, exclusive=True):
+    with open(filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def create_store(filename, grid, variables):
+    """
+    grid: {'geotransform', 'rows', 'cols', 'projection', 'geographic', 'runs' (None senza dimensione run)}
+    """
+    dataset = netCDF4.Dataset(filename, 'w', format='NETCDF4')
+    dataset.Conventions = 'CF-1.7'
+    dataset.geotransform = json.dumps(list(grid['geotransform']))
+
+    dataset.createDimension('time', None)
+    dims = ('time',)
+    if grid['runs'] is not None:
+        dataset.createDimension('run', grid['runs'])
+        run = dataset.createVariable('run', 'i1', ('run',))
+        run.long_name = 'giorno di previsione (Run0 = giorno di emissione)'
+        run.units = 'days'
+        run[:] = np.arange(grid['runs'])
+        dims += ('run',)
+    dataset.createDimension('y', grid['rows'])
+    dataset.createDimension('x', grid['cols'])
+    dims += ('y', 'x')
+
+    t = dataset.createVariable('time', 'f8', ('time',), chunksizes=(1024,))
+    t.standard_name = 'time'
+    t.units = time_units
+    t.calendar = 'standard'
+
+    [x, y] = grid_coordinates(grid['geotransform'], grid['rows'], grid['cols'])
+    if grid['geographic']:
+        xv = dataset.createVariable('x', 'f8', ('x',))
+        xv.standard_name = 'longitude'
+        xv.units = 'degrees_east'
+        yv = dataset.createVariable('y', 'f8', ('y',))
+        yv.standard_name = 'latitude'
+        yv.units = 'degrees_north'
+    else:
+        xv = dataset.createVariable('x', 'f8', ('x',))
+        xv.standard_name = 'projection_x_coordinate'
+        xv.units = 'm'
+        yv = dataset.createVariable('y', 'f8', ('y',))
+        yv.standard_name = 'projection_y_coordinate'
+        yv.units = 'm'
+    xv[:] = x
+    yv[:] = y
+
+    crs = dataset.createVariable('crs', 'i4')
+    crs.crs_wkt = grid['projection']
+    crs.spatial_ref = grid['projection']
+    crs.GeoTransform = ' '.join(str(v) for v in grid['geotransform'])
+
+    chunks = (datacube_chunk_time,) + ((1,) if grid['runs'] is not None else ()) + (
+        min(datacube_chunk_space, grid['rows']), min(datacube_chunk_space, grid['cols']))
+    for name, [dtype, fill, description] in variables.items():
+        var = dataset.createVariable(name, dtype, dims, zlib=True, complevel=4, shuffle=True,
+                                     chunksizes=chunks, fill_value=fill)
+        var.long_name = description
+        var.grid_mapping = 'crs'
+    return dataset
+
+
+def time_index(dataset, when):
+    """
+    Indice del tempo <when> (nuovo indice in coda se non presente).
+    Confronto esatto (a meno dell'arrotondamento): con la tolleranza relativa di default di np.isclose
+    su ~4.4e5 ore i passi a 3 ore delle previsioni finivano nella stessa slice.
+    """
+    value = netCDF4.date2num(when, time_units, 'standard')
+    times = dataset.variables['time'][:]
+    found = np.nonzero(np.isclose(np.ma.filled(times, np.nan), value, rtol=0, atol=1e-6))[0]
+    if len(found):
+        return int(found[0])
+    index = len(times)
+    dataset.variables['time'][index] = value
+    return index
+
+
+def append_product(filename, grid, variables, when, arrays, run=None):
+    """Aggiungo (o sostituisco) le slice del tempo <when>; arrays: {variabile: array (y, x)}"""
+    require_netcdf()
+    with store_lock(filename):
+        if os.path.exists(filename):
+            dataset = netCDF4.Dataset(filename, 'a')
+        else:
+            dataset = create_store(filename, grid, variables)
+        try:
+            index = time_index(dataset, when)
+            for name, array in arrays.items():
+                if run is None:
+                    dataset.variables[name][index] = array
+                else:
+                    dataset.variables[name][index, run] = array
+        finally:
+            dataset.close()
+
+
+def time_range(dataset, start=None, end=None):
+    """Indici dei tempi compresi fra start e end (nell'ordine di scrittura) e tutti i tempi del cubo"""
+    times = netCDF4.num2date(dataset.variables['time'][:], time_units, 'standard',
+                             only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    selected = [
+        n for n, t in enumerate(times)
+        if (start is None or t >= start) and (end is None or t <= end)
+    ]
+    return selected, times
+
+
+def pixel(dataset, x, y):
+    geotransform = json.loads(dataset.geotransform)
+    col = int(np.floor((x - geotransform[0]) / geotransform[1]))
+    row = int(np.floor((y - geotransform[3]) / geotransform[5]))
+    if not (0 <= row < len(dataset.dimensions['y']) and 0 <= col < len(dataset.dimensions['x'])):
+        raise ValueError('Punto fuori dalla griglia: {0}, {1}'.format(x, y))
+    return row, col
+
+
+def point_series(filename, name, x, y, run=None, start=None, end=None):
+    """Serie storica in un punto (coordinate nel sistema del cubo): [(tempo, valore)]"""
+    require_netcdf()
+    with store_lock(filename, exclusive=False):
+        with netCDF4.Dataset(filename, 'r') as dataset:
+            [row, col] = pixel(dataset, x, y)
+            [selected, times] = time_range(dataset, start, end)
+            if not selected:
+                return []
+            var = dataset.variables[name]
+            """Una sola lettura [t0:t1] in un pixel: vengono decompressi solo i chunk della colonna"""
+            t0 = min(selected)
+            t1 = max(selected) + 1
+            if 'run' in var.dimensions:
+                values = var[t0:t1, run if run is not None else 0, row, col]
+            else:
+                values = var[t0:t1, row, col]
+            values = np.ma.filled(values, var._FillValue)
+            return [(times[n], values[n - t0].item()) for n in selected]
+
+
+def aggregate(filename, name, statistic='mean', run=None, start=None, end=None):
+    """Media, massimo o somma sui tempi selezionati, letti a blocchi di un chunk temporale"""
+    require_netcdf()
+    with store_lock(filename, exclusive=False):
+        with netCDF4.Dataset(filename, 'r') as dataset:
+            [selected, times] = time_range(dataset, start, end)
+            var = dataset.variables[name]
+            shape = (len(dataset.dimensions['y']), len(dataset.dimensions['x']))
+            total = np.zeros(shape, dtype=np.float64)
+            count = np.zeros(shape, dtype=np.int64)
+            result = np.full(shape, -np.inf) if statistic == 'max' else None
+            selected = set(selected)
+            for t0 in range(0, len(times), datacube_chunk_time):
+                block = [n for n in range(t0, min(t0 + datacube_chunk_time, len(times))) if n in selected]
+                if not block:
+                    continue
+                if 'run' in var.dimensions:
+                    data = var[block[0]:block[-1] + 1, run if run is not None else 0]
+                else:
+                    data = var[block[0]:block[-1] + 1]
+                data = np.ma.masked_array(data)[[n - block[0] for n in block]]
+                valid = ~np.ma.getmaskarray(data)
+                count += valid.sum(axis=0)
+                if statistic == 'max':
+                    result = np.maximum(result, np.ma.filled(data.astype(np.float64), -np.inf).max(axis=0))
+                else:
+                    total += np.ma.filled(data.astype(np.float64), 0).sum(axis=0)
+            geotransform = json.loads(dataset.geotransform)
+            projection = dataset.variables['crs'].crs_wkt
+
+    if statistic == 'max':
+        result[count == 0] = np.nan
+    elif statistic == 'sum':
+        result = total
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = total / count
+    return result, geotransform, projection
+
+
+def parse_day(value):
+    return datetime.strptime(value, "%Y-%m-%d") if value else None
+
+
+def print_usage():
+    print("datacube.py -f <cubo.nc> -v <variabile> --point <x>,<y> [--run <n>] [--from <data>] [--to <data>]")
+    print("datacube.py -f <cubo.nc> -v <variabile> --aggregate <mean|max|sum> -o <raster> [--run <n>] [--from <data>] [--to <data>]")
+
+
+def main(argv):
+    filename = None
+    name = None
+    point = None
+    statistic = None
+    output = None
+    run = None
+    start = None
+    end = None
+    try:
+        opts, args = getopt.getopt(argv, "hf:v:o:", ["help", "file=", "variable=", "point=", "aggregate=", "output=", "run=", "from=", "to="])
+    except getopt.GetoptError as err:
+        print(err)
+        print_usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_usage()
+            sys.exit(2)
+        elif opt in ("-f", "--file"):
+            filename = arg
+        elif opt in ("-v", "--variable"):
+            name = arg
+        elif opt == "--point":
+            point = [float(v) for v in arg.split(',')]
+        elif opt == "--aggregate":
+            statistic = arg
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt == "--run":
+            run = int(arg)
+        elif opt == "--from":
+            start = parse_day(arg)
+        elif opt == "--to":
+            end = parse_day(arg)
+        else:
+            assert False, "unhandled option"
+
+    if filename is None or name is None or (point is None and statistic is None):
+        print_usage()
+        sys.exit(2)
+
+    try:
+        if point is not None:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['time', name])
+            for when, value in point_series(filename, name, point[0], point[1], run, start, end):
+                writer.writerow([when.strftime("%Y-%m-%dT%H:%M:%S"), value])
+        else:
+            if output is None:
+                print_usage()
+                sys.exit(2)
+            from osgeo import gdal
+            import output_backend
+            [result, geotransform, projection] = aggregate(filename, name, statistic, run, start, end)
+            output_backend.write_raster(
+                output, result.astype(np.float32), geotransform, projection, gdal.GDT_Float32,
+                'cog' if output.endswith('.tif') else 'rst', nodata=float('nan'))
+    except Exception as e:
+        print(e)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+    print("--- %s seconds ---" % (time.time() - start_time))
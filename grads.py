@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+Lettore dei file GrADS .ctl/.gra.
+
+Il descrittore .ctl (dset, undef, options, xdef, ydef, zdef, tdef, vars) viene
+letto una volta e da esso si ricava l'indice (variabile, tempo, livello) -> byte
+del file .gra. I dati vengono restituiti come viste su un file mappato in memoria:
+si leggono solo i byte effettivamente usati.
+
+Esempio di ctl supportato:
+
+dset ^incendi_arw_ecm_3km_run00.gra
+undef 9.999E+20
+title Model Data for Fire
+xdef 267 LINEAR 8 0.03
+ydef 201 LINEAR 40 0.03
+zdef 1 levels 1000
+tdef 3 linear 00Z18FEB2020 1dy
+vars 4
+tmpsfc 0 11,1,0 ** Mean Daily T2m [C]
+apcpsfc 0 61,1,0 ** Total Daily precipitation [kg/m^2]
+rhsfc 0 52,1,0 ** Mean Daily 2m Relative Humidity [%]
+wind10m 0 32,105,10 ** Mean Daily 10 m Wind Velocity [m/s]
+endvars
+"""
+
+import os
+import re
+import numpy as np
+from datetime import datetime, timedelta
+
+grads_months = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+def parse_time(value):
+    """Tempo GrADS: hh[:mm]Zddmmmyyyy (ora e giorno opzionali)"""
+    match = re.match(r'^(?:(\d{1,2})(?::(\d{2}))?Z)?(\d{1,2})?([A-Za-z]{3})(\d{4})$', value)
+    if match is None:
+        raise ValueError('Tempo GrADS non valido: ' + value)
+    [hour, minute, day, month, year] = match.groups()
+    return datetime(
+        int(year),
+        grads_months.index(month.upper()) + 1,
+        int(day or 1),
+        int(hour or 0),
+        int(minute or 0))
+
+
+def add_increment(start, n, increment):
+    """Sommo n incrementi GrADS (mn, hr, dy, mo, yr) a start"""
+    match = re.match(r'^(\d+)(mn|hr|dy|mo|yr)$', increment.lower())
+    if match is None:
+        raise ValueError('Incremento GrADS non valido: ' + increment)
+    step = int(match.group(1)) * n
+    unit = match.group(2)
+    if unit == 'mn':
+        return start + timedelta(minutes=step)
+    if unit == 'hr':
+        return start + timedelta(hours=step)
+    if unit == 'dy':
+        return start + timedelta(days=step)
+    if unit == 'yr':
+        step = step * 12
+    months = start.month - 1 + step
+    return start.replace(year=start.year + months // 12, month=months % 12 + 1)
+
+
+def parse_dimension(tokens):
+    """xdef/ydef/zdef: n LINEAR start step | n LEVELS v1 v2 ..."""
+    n = int(tokens[0])
+    mapping = tokens[1].upper()
+    if mapping == 'LINEAR':
+        start = float(tokens[2])
+        step = float(tokens[3])
+        return {'n': n, 'start': start, 'step': step, 'levels': [start + step * k for k in range(n)]}
+    if mapping == 'LEVELS':
+        return {'n': n, 'start': None, 'step': None, 'levels': [float(v) for v in tokens[2:2 + n]]}
+    raise ValueError('Mappatura GrADS non supportata: ' + tokens[1])
+
+
+def parse_ctl(filename):
+    """Leggo il descrittore .ctl e costruisco l'indice dei record"""
+    desc = {
+        'ctl': filename,
+        'dset': None,
+        'undef': None,
+        'title': '',
+        'byteorder': '<',
+        'yrev': False,
+        'fileheader': 0,
+        'theader': 0,
+        'xyheader': 0,
+        'vars': []
+    }
+
+    with open(filename) as f:
+        lines = [line.strip() for line in f if line.strip() and not line.strip().startswith('*')]
+
+    n = 0
+    while n < len(lines):
+        tokens = lines[n].split()
+        keyword = tokens[0].lower()
+        if keyword == 'dset':
+            dset = lines[n].split(None, 1)[1]
+            if dset.startswith('^'):
+                dset = os.path.join(os.path.dirname(filename), dset[1:])
+            desc['dset'] = dset
+        elif keyword == 'undef':
+            desc['undef'] = float(tokens[1])
+        elif keyword == 'title':
+            desc['title'] = lines[n].split(None, 1)[1] if len(tokens) > 1 else ''
+        elif keyword == 'options':
+            for option in tokens[1:]:
+                option = option.lower()
+                if option == 'big_endian':
+                    desc['byteorder'] = '>'
+                elif option == 'little_endian':
+                    desc['byteorder'] = '<'
+                elif option == 'yrev':
+                    desc['yrev'] = True
+                elif option in ('template', 'sequential', 'zrev'):
+                    raise ValueError('Opzione GrADS non supportata: ' + option)
+        elif keyword in ('fileheader', 'theader', 'xyheader'):
+            desc[keyword] = int(tokens[1])
+        elif keyword in ('xdef', 'ydef', 'zdef'):
+            desc[keyword] = parse_dimension(tokens[1:])
+        elif keyword == 'tdef':
+            desc['tdef'] = {
+                'n': int(tokens[1]),
+                'start': parse_time(tokens[3]),
+                'increment': tokens[4]
+            }
+        elif keyword == 'vars':
+            for k in range(int(tokens[1])):
+                n += 1
+                var_tokens = lines[n].split()
+                description = lines[n].split('**', 1)[1].strip() if '**' in lines[n] else ''
+                desc['vars'].append({
+                    'name': var_tokens[0].lower(),
+                    'nlev': int(var_tokens[1]),
+                    'units': var_tokens[2] if len(var_tokens) > 2 else '',
+                    'description': description
+                })
+        n += 1
+
+    return build_index(desc)
+
+
+def legacy_descriptor(dset, nx, ny, variables, undef, xdef, ydef):
+    """
+    Descrittore per un .gra senza ctl: variabili a un solo livello,
+    numero di tempi ricavato dalla dimensione del file
+    """
+    desc = {
+        'ctl': None,
+        'dset': dset,
+        'undef': undef,
+        'title': '',
+        'byteorder': '<',
+        'yrev': False,
+        'fileheader': 0,
+        'theader': 0,
+        'xyheader': 0,
+        'xdef': {'n': nx, 'start': xdef[0], 'step': xdef[1], 'levels': [xdef[0] + xdef[1] * k for k in range(nx)]},
+        'ydef': {'n': ny, 'start': ydef[0], 'step': ydef[1], 'levels': [ydef[0] + ydef[1] * k for k in range(ny)]},
+        'zdef': {'n': 1, 'start': None, 'step': None, 'levels': [0]},
+        'vars': [{'name': name, 'nlev': 0, 'units': '', 'description': ''} for name in variables]
+    }
+    ntime = os.path.getsize(dset) // (nx * ny * 4 * len(variables))
+    desc['tdef'] = {'n': ntime, 'start': None, 'increment': None}
+    return build_index(desc)
+
+
+def build_index(desc):
+    """Offset (byte) di ogni variabile all'interno di un tempo e dimensione di un tempo"""
+    record_bytes = desc['xdef']['n'] * desc['ydef']['n'] * 4
+    offset = desc['theader']
+    desc['index'] = {}
+    for var in desc['vars']:
+        var['levels'] = max(1, var['nlev'])
+        desc['index'][var['name']] = offset
+        offset += var['levels'] * (desc['xyheader'] + record_bytes)
+    desc['record_bytes'] = record_bytes
+    desc['time_bytes'] = offset
+    desc['dtype'] = np.dtype(desc['byteorder'] + 'f4')
+    desc['data'] = None
+    return desc
+
+
+def variable_names(desc):
+    return [var['name'] for var in desc['vars']]
+
+
+def times(desc):
+    """Tempi validi del file (None se il ctl non li definisce)"""
+    if desc['tdef']['start'] is None:
+        return [None] * desc['tdef']['n']
+    return [add_increment(desc['tdef']['start'], t, desc['tdef']['increment']) for t in range(desc['tdef']['n'])]
+
+
+def geotransform(desc):
+    """Parametri SetGeoTransform con la stessa convenzione di get_geotransform('model')"""
+    return [desc['xdef']['start'], desc['xdef']['step'], 0, desc['ydef']['start'], 0, desc['ydef']['step']]
+
+
+def record_offset(desc, name, t, z=0):
+    """Byte del record (variabile, tempo, livello) nel file .gra"""
+    name = name.lower()
+    if name not in desc['index']:
+        raise KeyError('Variabile non presente nel ctl: ' + name)
+    if t < 0 or t >= desc['tdef']['n']:
+        raise IndexError('Tempo fuori dal ctl: ' + str(t))
+    return (desc['fileheader'] + t * desc['time_bytes'] + desc['index'][name] +
+            z * (desc['xyheader'] + desc['record_bytes']) + desc['xyheader'])
+
+
+def open_data(desc):
+    """Mappo il file .gra in memoria (una sola volta per descrittore)"""
+    if desc['data'] is None:
+        desc['data'] = np.memmap(desc['dset'], dtype=np.uint8, mode='r')
+    return desc['data']
+
+
+def variable(desc, name, t, z=0):
+    """Vista (ny, nx) sul record richiesto: nessun byte viene letto finche' non si usano i dati"""
+    nx = desc['xdef']['n']
+    ny = desc['ydef']['n']
+    data = np.frombuffer(open_data(desc), dtype=desc['dtype'], count=nx * ny, offset=record_offset(desc, name, t, z))
+    data = data.reshape(ny, nx)
+    if desc['yrev']:
+        data = data[::-1]
+    return data
+
+
+def cube(desc):
+    """
+    Vista (time, var, ny, nx) sull'intero file, disponibile solo se tutte le variabili
+    hanno un livello e non ci sono header di tempo o di record
+    """
+    if desc['theader'] or desc['xyheader'] or any(var['levels'] != 1 for var in desc['vars']):
+        raise ValueError('Il file non e\' una sequenza regolare (time, var, y, x)')
+    shape = (desc['tdef']['n'], len(desc['vars']), desc['ydef']['n'], desc['xdef']['n'])
+    data = np.frombuffer(
+        open_data(desc),
+        dtype=desc['dtype'],
+        count=int(np.prod(shape)),
+        offset=desc['fileheader']).reshape(shape)
+    if desc['yrev']:
+        data = data[:, :, ::-1]
+    return data
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Indice delle bande di un file GRIB: (variabile, tipo di livello, livello, tempo di validita') -> banda.
+
+L'indice si costruisce con una sola lettura dei metadati di tutte le bande e viene salvato
+accanto al GRIB (<file>.idx.json) con dimensione e data di modifica del file: finche' il GRIB
+non cambia le ricerche sono accessi a un dizionario, senza GetMetadata() per banda.
+
+ - variabile: GRIB_COMMENT senza unita' e note, es. 'Temperature', 'Specific humidity',
+   'Geopotential' (anche per 'Geopotential (at the surface = orography)' del GRIB1)
+ - livello: da GRIB_SHORT_NAME, es. '85000-ISBL' -> ('ISBL', 850) in hPa, '0-SFC' -> ('SFC', 0);
+   il confronto e' esatto (find('500') trovava anche '95000-ISBL')
+ - tempo di validita': secondi UTC da GRIB_VALID_TIME
+"""
+
+import os
+import json
+import threading
+
+index_version = 1
+index_suffix = '.idx.json'
+
+
+def variable_name(comment):
+    """'Temperature [C]' -> 'Temperature', 'Geopotential (at the surface = orography) [m^2/s^2]' -> 'Geopotential'"""
+    return comment.split(' [')[0].split(' (')[0].strip()
+
+
+def parse_level(short_name):
+    """'85000-ISBL' -> ('ISBL', 850.0): i livelli isobarici sono in Pa nel GRIB, in hPa nell'indice"""
+    parts = short_name.strip().split('-')
+    level_type = parts[-1]
+    try:
+        level = float(parts[0])
+    except ValueError:
+        level = None
+    if level is not None and level_type == 'ISBL':
+        level = level / 100
+    return level_type, level
+
+
+def parse_seconds(grib_time):
+    """'  1581292800 sec UTC' -> 1581292800"""
+    return int(grib_time.split()[0])
+
+
+def file_identity(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def scan_bands(src_ds):
+    """Una sola lettura dei metadati di tutte le bande"""
+    entries = []
+    for band in range(1, src_ds.RasterCount + 1):
+        metadata = src_ds.GetRasterBand(band).GetMetadata()
+        [level_type, level] = parse_level(metadata.get('GRIB_SHORT_NAME', ''))
+        entries.append({
+            'band': band,
+            'element': metadata.get('GRIB_ELEMENT', ''),
+            'variable': variable_name(metadata.get('GRIB_COMMENT', '')),
+            'level_type': level_type,
+            'level': level,
+            'valid_time': parse_seconds(metadata['GRIB_VALID_TIME']) if 'GRIB_VALID_TIME' in metadata else None
+        })
+    return entries
+
+
+def build_lookup(entries):
+    lookup = {}
+    for entry in entries:
+        key = (entry['variable'], entry['level_type'], entry['level'])
+        lookup.setdefault(key, {})[entry['valid_time']] = entry['band']
+    return lookup
+
+
+def load_index(filename, src_ds):
+    """Indice dal file accanto al GRIB se e' ancora valido, altrimenti ricostruito e salvato"""
+    identity = dict(file_identity(filename), version=index_version)
+    index_filename = filename + index_suffix
+    entries = None
+    if os.path.exists(index_filename):
+        try:
+            with open(index_filename) as f:
+                saved = json.load(f)
+            if saved.get('identity') == identity:
+                entries = saved['entries']
+        except (IOError, ValueError, KeyError):
+            entries = None
+
+    if entries is None:
+        entries = scan_bands(src_ds)
+        """Una directory del GRIB non scrivibile non deve fermare l'elaborazione"""
+        tmp_filename = index_filename + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                json.dump({'identity': identity, 'entries': entries}, f)
+            os.replace(tmp_filename, index_filename)
+        except (IOError, OSError):
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    return {'entries': entries, 'lookup': build_lookup(entries)}
+
+
+def find_bands(index, variable, level_type, level):
+    """{tempo di validita': banda} per variabile e livello esatto"""
+    return index['lookup'].get((variable, level_type, float(level)), {})
+
+
+def band_for(index, variable, level_type, level, valid_time):
+    return find_bands(index, variable, level_type, level).get(valid_time)
+
+
+def valid_times(index):
+    return sorted(set(entry['valid_time'] for entry in index['entries'] if entry['valid_time'] is not None))
@@ -18,6 +18,7 @@
 #
 # ------------------------------------------------------
 
+import os
 import sys
 import getopt
 import numpy as np
@@ -25,27 +26,26 @@ from osgeo import gdal
 from datetime import datetime
 import time
 start_time = time.time()
+import stage_metrics
+import output_backend
 
 driver = gdal.GetDriverByName("GTiff")
 wkt_projection = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.01745329251994328,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
 
-def write_geotiff(filename, tempo, src_ds, array, type):
-    """Scrivo i risultati in geotiff"""
-    [rows, cols] = array.shape
-    dataset = driver.Create(
-        filename + '_' + type + '_' + tempo,
-        cols,  # cols
-        rows,  # rows
-        1,
-        gdal.GDT_Float64)
-
-    dataset.SetGeoTransform(src_ds.GetGeoTransform())
-    dataset.SetProjection(wkt_projection)
-
-    dataset.GetRasterBand(1).WriteArray(array)
-
-    dataset.FlushCache()
-    dataset = None
+"""Formato delle immagini (gtiff o cog), anche per prodotto: --format haines_index_reclass=cog"""
+product_formats = {'default': 'gtiff'}
+
+def write_geotiff(filename, tempo, src_ds, array, type, categorical=None):
+    """Scrivo i risultati in geotiff; categorical per le classi (*_reclass) scritte come float"""
+    with stage_metrics.stage('write', type=type):
+        output_backend.write_raster(
+            filename + '_' + type + '_' + tempo,
+            array,
+            src_ds.GetGeoTransform(),
+            wkt_projection,
+            gdal.GDT_Float64,
+            output_backend.product_format(product_formats, os.path.basename(filename)),
+            categorical=categorical)
 
 def checktime(grib_time):
     """Estraggo la data per nominare i forecast"""
@@ -86,26 +86,28 @@ def haines_index_calc(type):
 
     for band in range(bands_count):
         band += 1
-        src_subds = src_ds.GetRasterBand(band)
-        metadata = src_subds.GetMetadata()
-
-        if (metadata['GRIB_COMMENT'].find('Temperature [C]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(sup)) != -1):
-            temperature_sup_dataset = src_subds
-            temperature_sup_dataset_array = temperature_sup_dataset.ReadAsArray()
-
-        if (metadata['GRIB_COMMENT'].find('Temperature [C]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(inf)) != -1):
-            temperature_inf_dataset = src_subds
-            temperature_inf_dataset_array = temperature_inf_dataset.ReadAsArray()
-
-        """Estraggo la corretta specific humidity a seconda del tipo di elevation index"""
-        if (type == 'low'):
-            if (metadata['GRIB_COMMENT'].find('Specific humidity [kg/kg]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(inf)) != -1):
-                specific_humidity_dataset = src_subds
-                specific_humidity_dataset_array = specific_humidity_dataset.ReadAsArray()
-        else:
-            if (metadata['GRIB_COMMENT'].find('Specific humidity [kg/kg]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(sup)) != -1):
-                specific_humidity_dataset = src_subds
-                specific_humidity_dataset_array = specific_humidity_dataset.ReadAsArray()
+        """Lettura della banda (metadati GRIB e, se serve, dati)"""
+        with stage_metrics.stage('band_scan', type=type):
+            src_subds = src_ds.GetRasterBand(band)
+            metadata = src_subds.GetMetadata()
+
+            if (metadata['GRIB_COMMENT'].find('Temperature [C]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(sup)) != -1):
+                temperature_sup_dataset = src_subds
+                temperature_sup_dataset_array = temperature_sup_dataset.ReadAsArray()
+
+            if (metadata['GRIB_COMMENT'].find('Temperature [C]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(inf)) != -1):
+                temperature_inf_dataset = src_subds
+                temperature_inf_dataset_array = temperature_inf_dataset.ReadAsArray()
+
+            """Estraggo la corretta specific humidity a seconda del tipo di elevation index"""
+            if (type == 'low'):
+                if (metadata['GRIB_COMMENT'].find('Specific humidity [kg/kg]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(inf)) != -1):
+                    specific_humidity_dataset = src_subds
+                    specific_humidity_dataset_array = specific_humidity_dataset.ReadAsArray()
+            else:
+                if (metadata['GRIB_COMMENT'].find('Specific humidity [kg/kg]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(sup)) != -1):
+                    specific_humidity_dataset = src_subds
+                    specific_humidity_dataset_array = specific_humidity_dataset.ReadAsArray()
 
         if (specific_humidity_dataset_array is not None and
                 temperature_inf_dataset_array is not None and
@@ -115,10 +117,11 @@ def haines_index_calc(type):
             tempo = checktime(metadata['GRIB_VALID_TIME'])
 
             """Calcolo la dew-point temperatura per il livello a seconda del tipo di elevation index"""
-            if (type == 'low'):
-                tdc = dewpoint_temp_calc(inf, temperature_inf_dataset_array, specific_humidity_dataset_array)
-            else:
-                tdc = dewpoint_temp_calc(sup, temperature_sup_dataset_array, specific_humidity_dataset_array)
+            with stage_metrics.stage('dewpoint', type=type):
+                if (type == 'low'):
+                    tdc = dewpoint_temp_calc(inf, temperature_inf_dataset_array, specific_humidity_dataset_array)
+                else:
+                    tdc = dewpoint_temp_calc(sup, temperature_sup_dataset_array, specific_humidity_dataset_array)
 
 
             """
@@ -131,18 +134,19 @@ def haines_index_calc(type):
             write_geotiff('haines_images/lapse_rate_values', tempo, src_ds, lapse_rate, type)
 
             """Calcolo Factor Values (A)"""
-            lapse_rate1_temp = np.less(lapse_rate, 4)
-            np.putmask(lapse_rate, lapse_rate1_temp, 1)
+            with stage_metrics.stage('reclass', type=type):
+                lapse_rate1_temp = np.less(lapse_rate, 4)
+                np.putmask(lapse_rate, lapse_rate1_temp, 1)
 
-            lapse_rate3_temp = np.greater_equal(lapse_rate, 8)
-            np.putmask(lapse_rate, lapse_rate3_temp, 3)
+                lapse_rate3_temp = np.greater_equal(lapse_rate, 8)
+                np.putmask(lapse_rate, lapse_rate3_temp, 3)
 
-            lapse_rate2_temp = np.logical_and([np.greater_equal(lapse_rate, 4)],
-                                   [np.less(lapse_rate, 8)])
-            np.putmask(lapse_rate, lapse_rate2_temp, 2)
+                lapse_rate2_temp = np.logical_and([np.greater_equal(lapse_rate, 4)],
+                                       [np.less(lapse_rate, 8)])
+                np.putmask(lapse_rate, lapse_rate2_temp, 2)
 
             """Write geotiff lapse_rate_reclass"""
-            write_geotiff('haines_images/lapse_rate_reclass', tempo, src_ds, lapse_rate, type)
+            write_geotiff('haines_images/lapse_rate_reclass', tempo, src_ds, lapse_rate, type, True)
 
 
             """
@@ -158,18 +162,19 @@ def haines_index_calc(type):
             write_geotiff('haines_images/moisture_values', tempo, src_ds, moisture, type)
 
             """Calcolo Factor Values (B)"""
-            moisture1_temp = np.less(moisture, 6)
-            np.putmask(moisture, moisture1_temp, 1)
+            with stage_metrics.stage('reclass', type=type):
+                moisture1_temp = np.less(moisture, 6)
+                np.putmask(moisture, moisture1_temp, 1)
 
-            moisture3_temp = np.greater_equal(moisture, 10)
-            np.putmask(moisture, moisture3_temp, 3)
+                moisture3_temp = np.greater_equal(moisture, 10)
+                np.putmask(moisture, moisture3_temp, 3)
 
-            moisture2_temp = np.logical_and([np.greater_equal(moisture, 6)],
-                                   [np.less(moisture, 10)])
-            np.putmask(moisture, moisture2_temp, 2)
+                moisture2_temp = np.logical_and([np.greater_equal(moisture, 6)],
+                                       [np.less(moisture, 10)])
+                np.putmask(moisture, moisture2_temp, 2)
 
             """Write geotiff moisture_reclass"""
-            write_geotiff('haines_images/moisture_reclass', tempo, src_ds, moisture, type)
+            write_geotiff('haines_images/moisture_reclass', tempo, src_ds, moisture, type, True)
 
 
             """
@@ -182,37 +187,49 @@ def haines_index_calc(type):
             write_geotiff('haines_images/haines_index_values', tempo, src_ds, haines_index, type)
 
             """Class of day (potential for large fire)"""
-            haines_index_verylow_temp = np.logical_or([np.equal(haines_index, 2)],
-                                   [np.equal(haines_index, 3)])
-            np.putmask(haines_index, haines_index_verylow_temp, 1)
+            with stage_metrics.stage('reclass', type=type):
+                haines_index_verylow_temp = np.logical_or([np.equal(haines_index, 2)],
+                                       [np.equal(haines_index, 3)])
+                np.putmask(haines_index, haines_index_verylow_temp, 1)
 
-            haines_index_low_temp = np.equal(haines_index, 4)
-            np.putmask(haines_index, haines_index_low_temp, 2)
+                haines_index_low_temp = np.equal(haines_index, 4)
+                np.putmask(haines_index, haines_index_low_temp, 2)
 
-            haines_index_moderate_temp = np.equal(haines_index, 5)
-            np.putmask(haines_index, haines_index_moderate_temp, 3)
+                haines_index_moderate_temp = np.equal(haines_index, 5)
+                np.putmask(haines_index, haines_index_moderate_temp, 3)
 
-            haines_index_high_temp = np.equal(haines_index, 6)
-            np.putmask(haines_index, haines_index_high_temp, 4)
+                haines_index_high_temp = np.equal(haines_index, 6)
+                np.putmask(haines_index, haines_index_high_temp, 4)
 
             """Write geotiff haines index"""
-            write_geotiff('haines_images/haines_index_reclass', tempo, src_ds, haines_index, type)
+            write_geotiff('haines_images/haines_index_reclass', tempo, src_ds, haines_index, type, True)
 
 
             temperature_sup_dataset_array = None
             temperature_inf_dataset_array = None
             specific_humidity_dataset_array = None
 
+def write_stage_metrics(metrics_dir, elev):
+    """Le misure non devono far fallire l'elaborazione"""
+    if metrics_dir is None:
+        return
+    try:
+        stage_metrics.write_metrics('haines_index_calc', metrics_dir, time.time() - start_time, {'type': elev})
+    except Exception as e:
+        print(e)
+
 def print_usage():
-    print("haines_index_calc.py -e <elevation>")
+    print("haines_index_calc.py -e <elevation> [--metrics <dir>] [--tracemalloc] [--format <fmt>]")
 
 def main(argv):
+    global product_formats
     #print("ARGV      :", sys.argv[1:])
+    metrics_dir = None
     try:
         # opts is a list of returning key-value pairs, args is the options left after striped
         # the short options 'hi:o:', if an option requires an input, it should be followed by a ":"
         # the long options 'ifile=' is an option that requires an input, followed by a "="
-        opts, args = getopt.getopt(argv, "he:", ["help", "elevation="])
+        opts, args = getopt.getopt(argv, "he:", ["help", "elevation=", "metrics=", "tracemalloc", "format="])
     except getopt.GetoptError as err:
         print(err)  # will print something like "option -a not recognized"
         print_usage()
@@ -222,10 +239,19 @@ def main(argv):
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print("haines_index_calc.py -e <elevation>")
+            print("haines_index_calc.py -e <elevation> [--metrics <dir>] [--tracemalloc] [--format <fmt>]")
             sys.exit(2)
         elif opt in ("-e", "--elevation"):
             elev = arg
+        elif opt == "--metrics":
+            metrics_dir = arg
+        elif opt == "--tracemalloc":
+            stage_metrics.enable_tracemalloc()
+        elif opt == "--format":
+            product_formats = output_backend.parse_formats(arg, 'gtiff')
+            if 'rst' in product_formats.values():
+                print("formati ammessi: gtiff, cog")
+                sys.exit(2)
         else:
             assert False, "unhandled option"
 
@@ -233,7 +259,9 @@ def main(argv):
         haines_index_calc(elev)
     except Exception as e:
         print(e)
+        write_stage_metrics(metrics_dir, elev)
         sys.exit(2)
+    write_stage_metrics(metrics_dir, elev)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
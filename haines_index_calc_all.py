@@ -22,43 +22,64 @@
 https://www.earthdatascience.org/courses/earth-analytics-bootcamp/functions/apply-functions-numpy-arrays/
 """
 
+import os
 import sys
 import getopt
+import json
+import hashlib
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 from osgeo import gdal
 from datetime import datetime
 import time
 start_time = time.time()
+import stage_metrics
+import output_backend
+import datacube
+import zonal_stats
+import grib_index
+import haines_kernel
 
 driver = gdal.GetDriverByName("GTiff")
+grib_filename = '../ecm.0p10.run00.grb'
 wkt_projection = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.01745329251994328,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
 
-def write_geotiff(filename, tempo, src_ds, array, type_str, type = gdal.GDT_Float64):
-    """Scrivo i risultati in geotiff"""
-    [rows, cols] = array.shape
-    dataset = driver.Create(
-        filename + '_' + type_str + '_' + tempo + '.tiff',
-        cols,  # cols
-        rows,  # rows
-        1,
-        type)
+"""Formato delle immagini (gtiff o cog), anche per prodotto: --format haines_index_reclass=cog"""
+product_formats = {'default': 'gtiff'}
 
-    dataset.SetGeoTransform(src_ds.GetGeoTransform())
-    dataset.SetProjection(wkt_projection)
+"""Cubo NetCDF (time, y, x) a cui aggiungere la classe ALL di ogni scadenza (--datacube)"""
+datacube_filename = None
 
-    dataset.GetRasterBand(1).WriteArray(array)
+"""Classe di quota (LOW/MID/HIGH) per griglia: limiti (m) e cache su disco"""
+elevation_limits = (300, 900)
+elevation_cache_directory = 'haines_images_all/cache/'
 
-    dataset.FlushCache()
-    dataset = None
+"""Elaborazione per scadenza (--stream): in memoria solo i campi della scadenza corrente"""
+streaming = False
 
-def checktime(grib_time):
-    """Estraggo la data per nominare i forecast"""
-    data_hours = int(grib_time[:-8])
-    return datetime.utcfromtimestamp(data_hours).strftime('%Y%m%d') + 'T' + datetime.utcfromtimestamp(
-        data_hours).strftime('%H%M%S') + '000Z'
+"""Processi per le scadenze (--workers): con piu' di un worker si elabora sempre per scadenza"""
+workers = 1
+
+"""Zone per le statistiche delle classi ALL (--zones nome=file[:campo]) e cache dei raster delle etichette"""
+zonal_zones = {}
+zones_cache_directory = 'haines_images_all/zones/'
+zonal_classes = [(0, 'undefined'), (1, 'very_low'), (2, 'low'), (3, 'moderate'), (4, 'high')]
+
+def write_geotiff(filename, tempo, src_ds, array, type_str, type = gdal.GDT_Float64, categorical=None):
+    """Scrivo i risultati in geotiff; categorical per le classi (*_reclass) scritte come float"""
+    with stage_metrics.stage('write', type=type_str):
+        output_backend.write_raster(
+            filename + '_' + type_str + '_' + tempo + '.tiff',
+            array,
+            src_ds.GetGeoTransform(),
+            wkt_projection,
+            type,
+            output_backend.product_format(product_formats, os.path.basename(filename)),
+            categorical=categorical)
 
 def dewpoint_temp_calc(liv, temperature, umidity):
-    """Calcolo la dew-point temperature per il livello"""
+    """Calcolo la dew-point temperature per il livello (formula di riferimento di haines_kernel.dewpoint)"""
     pc = liv * 10000
 
     """definisco la rh al livello impostato"""
@@ -126,101 +147,34 @@ def write_haines_array(key, value, src_ds, variable_dict, i, writegeotiff, varia
         tempo = variable_dict['tempi'][i]
 
         """
-        (A) Calcolo 0000 GMT lapse rate DIFFERENZA FRA TEMPERATURE A DIVERSI LIVELLI DI PRESSIONE
+        (A) lapse rate DIFFERENZA FRA TEMPERATURE A DIVERSI LIVELLI DI PRESSIONE
         Q < 300         ->> 950 - 850 (LOW)
         300 >= Q <= 900 ->> 850 - 700 (MID)
         Q > 900         ->> 700 - 500 (HIGH)
+        (B) moisture al livello piu' BASSO per LOW, piu' ALTO per MID e HIGH
+        Calcolo in float32/int8 su buffer riusati (haines_kernel), stesse soglie di check_termine_a/b
         """
-        lapse_rate = variable_dict['temperature_sup_dataset_array_dict'][key][tempo] - variable_dict['temperature_inf_dataset_array_dict'][key][tempo]
-
-        """Write geotiff lapse_rate_values"""
-        if (writegeotiff):
-            write_geotiff('haines_images/lapse_rate_values', tempo, src_ds, lapse_rate, key)
-
-        """Calcolo Factor Values (A)"""
+        moisture_level = 'inf' if key == 'low' else 'sup'
         termine_a = check_termine_a(key)
-        termine_a_uno = termine_a['one'][0]
-        termine_a_due_inf = termine_a['two'][0]
-        termine_a_due_sup = termine_a['two'][1]
-        termine_a_tre = termine_a['three'][0]
-
-        lapse_rate1_temp = np.less_equal(lapse_rate, termine_a_uno)
-        np.putmask(lapse_rate, lapse_rate1_temp, 1)
-
-        lapse_rate3_temp = np.greater_equal(lapse_rate, termine_a_tre)
-        np.putmask(lapse_rate, lapse_rate3_temp, 3)
-
-        lapse_rate2_temp = np.logical_and([np.greater(lapse_rate, termine_a_due_inf)],
-                                          [np.less(lapse_rate, termine_a_due_sup)])
-        np.putmask(lapse_rate, lapse_rate2_temp, 2)
-
-        """Write geotiff lapse_rate_reclass"""
-        if (writegeotiff):
-            write_geotiff('haines_images/lapse_rate_reclass', tempo, src_ds, lapse_rate, key)
-
-        """Calcolo la dew-point temperatura per il livello a seconda del tipo di elevation index"""
-
-        """If LOW calcolo la Temperatura di rugiada del livello più BASSO"""
-        tdc_low = dewpoint_temp_calc(value['inf'], variable_dict['temperature_inf_dataset_array_dict'][key][tempo], variable_dict['specific_humidity_inf_dataset_array_dict'][key][tempo])
-
-        """If MID or HIGH calcolo la Temperatura di rugiada del livello più ALTO"""
-        tdc_mid_high = dewpoint_temp_calc(value['sup'], variable_dict['temperature_sup_dataset_array_dict'][key][tempo], variable_dict['specific_humidity_sup_dataset_array_dict'][key][tempo])
-
-        """
-        (B) Calcolo moisture a seconda del tipo di elevation index
-        """
-        if (key == 'low'):
-            moisture = variable_dict['temperature_inf_dataset_array_dict'][key][tempo] - tdc_low
-        else:
-            moisture = variable_dict['temperature_sup_dataset_array_dict'][key][tempo] - tdc_mid_high
-
-        """Write geotiff moisture_values"""
-        if (writegeotiff):
-            write_geotiff('haines_images/moisture_values', tempo, src_ds, moisture, key)
-
         termine_b = check_termine_b(key)
-        termine_b_uno = termine_b['one'][0]
-        termine_b_due_inf = termine_b['two'][0]
-        termine_b_due_sup = termine_b['two'][1]
-        termine_b_tre = termine_b['three'][0]
-
-        """Calcolo Factor Values (B)"""
-        moisture1_temp = np.less_equal(moisture, termine_b_uno)
-        np.putmask(moisture, moisture1_temp, 1)
-
-        moisture3_temp = np.greater_equal(moisture, termine_b_tre)
-        np.putmask(moisture, moisture3_temp, 3)
-
-        moisture2_temp = np.logical_and([np.greater(moisture, termine_b_due_inf)],
-                                        [np.less(moisture, termine_b_due_sup)])
-        np.putmask(moisture, moisture2_temp, 2)
-
-        """Write geotiff moisture_reclass"""
-        if (writegeotiff):
-            write_geotiff('haines_images/moisture_reclass', tempo, src_ds, moisture, key)
-
-        """
-        Calcolo haines index
-        factor values (A + B)
-        """
-        haines_index = lapse_rate + moisture
-
-        """Write geotiff haines index values"""
+        with stage_metrics.stage('kernel', type=key):
+            [haines_index, buffers] = haines_kernel.haines_type(
+                key,
+                value[moisture_level],
+                variable_dict['temperature_sup_dataset_array_dict'][key][tempo],
+                variable_dict['temperature_inf_dataset_array_dict'][key][tempo],
+                variable_dict['specific_humidity_' + moisture_level + '_dataset_array_dict'][key][tempo],
+                (termine_a['one'][0], termine_a['three'][0]),
+                (termine_b['one'][0], termine_b['three'][0])
+            )
+
+        """Write geotiff dei valori intermedi"""
         if (writegeotiff):
-            write_geotiff('haines_images/haines_index_values', tempo, src_ds, haines_index, key)
-
-        """Class of day (potential for large fire)"""
-        haines_index_verylow_temp = np.logical_or([np.equal(haines_index, 2)], [np.equal(haines_index, 3)])
-        np.putmask(haines_index, haines_index_verylow_temp, 1)
-
-        haines_index_low_temp = np.equal(haines_index, 4)
-        np.putmask(haines_index, haines_index_low_temp, 2)
-
-        haines_index_moderate_temp = np.equal(haines_index, 5)
-        np.putmask(haines_index, haines_index_moderate_temp, 3)
-
-        haines_index_high_temp = np.equal(haines_index, 6)
-        np.putmask(haines_index, haines_index_high_temp, 4)
+            write_geotiff('haines_images/lapse_rate_values', tempo, src_ds, buffers['lapse_rate'], key)
+            write_geotiff('haines_images/lapse_rate_reclass', tempo, src_ds, buffers['factor_a'], key, categorical=True)
+            write_geotiff('haines_images/moisture_values', tempo, src_ds, buffers['moisture'], key)
+            write_geotiff('haines_images/moisture_reclass', tempo, src_ds, buffers['factor_b'], key, categorical=True)
+            write_geotiff('haines_images/haines_index_values', tempo, src_ds, buffers['haines_values'], key)
 
         """Write geotiff haines index"""
         write_geotiff('haines_images/haines_index_reclass', tempo, src_ds, haines_index, key, gdal.GDT_Int16)
@@ -229,49 +183,25 @@ def write_haines_array(key, value, src_ds, variable_dict, i, writegeotiff, varia
 
         return variable_haines_list
 
-def read_variables(key, value, src_subds, metadata, src_ds, variable_dict):
-    tempo = checktime(metadata['GRIB_VALID_TIME'])
-    if (metadata['GRIB_COMMENT'].find('Geopotential (at the surface = orography) [m^2/s^2]') != -1 and metadata[
-        'GRIB_SHORT_NAME'].find('0-SFC') != -1):
-        geopotential = src_subds
-        geopotential_array = geopotential.ReadAsArray()
-        variable_dict['geopotential_array_dict'] = geopotential_array / 9.80665
-        write_geotiff('haines_images/orography', tempo, src_ds, geopotential_array / 9.80665, 'orography')
-
-    if (metadata['GRIB_COMMENT'].find('Temperature [C]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(value['sup'])) != -1):
-        temperature_sup_dataset = src_subds
-        temperature_sup_dataset_array = temperature_sup_dataset.ReadAsArray()
-        variable_dict['temperature_sup_dataset_array_dict'][key][tempo] = temperature_sup_dataset_array
-
-    if (metadata['GRIB_COMMENT'].find('Temperature [C]') != -1 and metadata['GRIB_SHORT_NAME'].find(str(value['inf'])) != -1):
-        temperature_inf_dataset = src_subds
-        temperature_inf_dataset_array = temperature_inf_dataset.ReadAsArray()
-        variable_dict['temperature_inf_dataset_array_dict'][key][tempo] = temperature_inf_dataset_array
-
-    """Estraggo la corretta specific humidity a seconda del tipo di elevation index"""
-    if (metadata['GRIB_COMMENT'].find('Specific humidity [kg/kg]') != -1 and metadata['GRIB_SHORT_NAME'].find(
-            str(value['inf'])) != -1):
-        specific_humidity_inf_dataset = src_subds
-        specific_humidity_inf_dataset_array = specific_humidity_inf_dataset.ReadAsArray()
-        variable_dict['specific_humidity_inf_dataset_array_dict'][key][tempo] = specific_humidity_inf_dataset_array
-
-    if (metadata['GRIB_COMMENT'].find('Specific humidity [kg/kg]') != -1 and metadata['GRIB_SHORT_NAME'].find(
-            str(value['sup'])) != -1):
-        specific_humidity_sup_dataset = src_subds
-        specific_humidity_sup_dataset_array = specific_humidity_sup_dataset.ReadAsArray()
-        variable_dict['specific_humidity_sup_dataset_array_dict'][key][tempo] = specific_humidity_sup_dataset_array
-        variable_dict['tempi'].append(tempo)
-
-    return variable_dict
-
-def haines_index_calc(types):
-
-    src_ds = gdal.Open('../ecm.0p10.run00.grb')
-
-    bands_count = src_ds.RasterCount
-
-    variable_dict = {
-        'geopotential_array_dict': {},
+def format_time(seconds):
+    """Data per nominare i forecast"""
+    return datetime.utcfromtimestamp(seconds).strftime('%Y%m%d') + 'T' + datetime.utcfromtimestamp(
+        seconds).strftime('%H%M%S') + '000Z'
+
+def type_fields(key, value):
+    """
+    Campi letti per il tipo: (variabile GRIB, livello, chiave di variable_dict).
+    L'umidita' serve solo al livello della moisture: inf per LOW, sup per MID e HIGH.
+    """
+    moisture_level = 'inf' if key == 'low' else 'sup'
+    return (
+        ('Temperature', value['sup'], 'temperature_sup_dataset_array_dict'),
+        ('Temperature', value['inf'], 'temperature_inf_dataset_array_dict'),
+        ('Specific humidity', value[moisture_level], 'specific_humidity_' + moisture_level + '_dataset_array_dict')
+    )
+
+def new_variable_dict():
+    return {
         'temperature_sup_dataset_array_dict': {
             'low': {},
             'mid': {},
@@ -295,83 +225,289 @@ def haines_index_calc(types):
         'tempi': []
     }
 
+def read_orography(src_ds, index):
+    """Orografia (m): 'Geopotential (at the surface = orography)' in GRIB1, 'Geopotential' in GRIB2"""
+    bands = grib_index.find_bands(index, 'Geopotential', 'SFC', 0)
+    if not bands:
+        raise ValueError('Orografia (Geopotential 0-SFC) non presente nel GRIB')
+    valid_time = min(bands)
+    orography = src_ds.GetRasterBand(bands[valid_time]).ReadAsArray() / 9.80665
+    write_geotiff('haines_images/orography', format_time(valid_time), src_ds, orography, 'orography')
+    return orography
+
+def elevation_class_filename(src_ds):
+    key = json.dumps([list(src_ds.GetGeoTransform()), src_ds.RasterXSize, src_ds.RasterYSize, elevation_limits])
+    return os.path.join(elevation_cache_directory, 'elevation_class_' + hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+def load_elevation_class(src_ds, index):
+    """
+    Classe di quota int8 della griglia: 0 (<= 300 m, LOW), 1 (300-900 m, MID), 2 (> 900 m, HIGH),
+    3 dove l'orografia non e' valida (indice nullo come nella composizione con le maschere).
+    L'orografia non cambia per una griglia: viene letta (e scritta in haines_images) solo
+    quando la classe non e' ancora in cache.
+    """
+    filename = elevation_class_filename(src_ds)
+    if os.path.exists(filename):
+        return np.load(filename)
+
+    orography = read_orography(src_ds, index)
+    elevation_class = np.full(orography.shape, 3, dtype=np.int8)
+    valid = np.isfinite(orography)
+    elevation_class[valid] = (
+        np.greater(orography[valid], elevation_limits[0]).view(np.int8) +
+        np.greater(orography[valid], elevation_limits[1]).view(np.int8)
+    )
+
+    os.makedirs(elevation_cache_directory, exist_ok=True)
+    tmp_filename = filename + '.' + str(os.getpid()) + '.tmp.npy'
+    np.save(tmp_filename, elevation_class)
+    os.replace(tmp_filename, filename)
+    return elevation_class
+
+def common_times(types, index):
+    """Scadenze con tutti i campi di tutti i tipi"""
+    times = None
     for key, value in types.items():
-        variable_dict['tempi'] = []
-        for band in range(bands_count):
-            band += 1
-            src_subds = src_ds.GetRasterBand(band)
-            metadata = src_subds.GetMetadata()
-
-            variable_dict = read_variables(key, value, src_subds, metadata, src_ds, variable_dict)
-
-    variable_dict['tempi'].sort()
-    dict_len = len(variable_dict['tempi'])
-
-    variable_haines_list = []
-
-    for i in range(dict_len):
-
-        variable_haines_list.append({
-            'tempo': variable_dict['tempi'][i],
-            'elev': variable_dict['geopotential_array_dict'],
-            'haines': {
-                'low': {},
-                'mid': {},
-                'high': {}
-            }
-        })
-
-        for key, value in types.items():
-            write_haines_array(key, value, src_ds, variable_dict, i, True, variable_haines_list)
-
-    variable_haines_list_lenght = len(variable_haines_list)
+        for [variable, level, dict_key] in type_fields(key, value):
+            bands = set(grib_index.find_bands(index, variable, 'ISBL', level))
+            times = bands if times is None else times & bands
+    return sorted(times)
+
+def read_variables(key, value, src_ds, index, variable_dict, times):
+    """Bande del tipo <key> dall'indice, con il livello esatto (find('500') trovava anche 95000-ISBL)"""
+    for [variable, level, dict_key] in type_fields(key, value):
+        for valid_time in times:
+            band = grib_index.band_for(index, variable, 'ISBL', level, valid_time)
+            variable_dict[dict_key][key][format_time(valid_time)] = src_ds.GetRasterBand(band).ReadAsArray()
+    return variable_dict
 
-    for c in range(variable_haines_list_lenght):
-        geopotential_array_300 = variable_haines_list[c]['elev'].copy()
-        geopotential_array_300_900 = variable_haines_list[c]['elev'].copy()
-        geopotential_array_900 = variable_haines_list[c]['elev'].copy()
+def timestep_fields(types):
+    """Campi distinti di una scadenza: i livelli comuni a piu' tipi (850, 700) sono letti una volta"""
+    return sorted(set(
+        (variable, level)
+        for key, value in types.items()
+        for [variable, level, dict_key] in type_fields(key, value)
+    ))
+
+def read_timestep(types, src_ds, index, valid_time, out=None):
+    """Solo i campi della scadenza: {(variabile, livello): array}, in <out> (campi, righe, colonne) se indicato"""
+    fields = {}
+    for n, [variable, level] in enumerate(timestep_fields(types)):
+        band = grib_index.band_for(index, variable, 'ISBL', level, valid_time)
+        if out is None:
+            fields[(variable, level)] = src_ds.GetRasterBand(band).ReadAsArray()
+        else:
+            out[n] = src_ds.GetRasterBand(band).ReadAsArray()
+            fields[(variable, level)] = out[n]
+    return fields
+
+def process_timestep(types, src_ds, fields, elevation_class, valid_time):
+    """low/mid/high, composizione e scrittura di una scadenza"""
+    tempo = format_time(valid_time)
+    variable_dict = new_variable_dict()
+    for key, value in types.items():
+        for [variable, level, dict_key] in type_fields(key, value):
+            variable_dict[dict_key][key][tempo] = fields[(variable, level)]
+    variable_dict['tempi'] = [tempo]
 
+    variable_haines_list = [new_variable_haines(tempo, elevation_class)]
+    for key, value in types.items():
+        write_haines_array(key, value, src_ds, variable_dict, 0, True, variable_haines_list)
+
+    blend_haines(src_ds, variable_haines_list[0])
+
+def blend_haines(src_ds, variable_haines):
+    """Composizione low/mid/high secondo la classe di quota: una sola scelta per pixel"""
+    with stage_metrics.stage('blend'):
+        haines = variable_haines['haines']
+        elevation_class = variable_haines['elev']
+        new_total = np.choose(elevation_class, (haines['low'], haines['mid'], haines['high'], np.zeros_like(haines['low'])))
+
+    write_geotiff('haines_images_all/haines_index_reclass', variable_haines['tempo'], src_ds, new_total, 'ALL', gdal.GDT_Byte)
+
+    if datacube_filename is not None:
+        append_datacube(src_ds, variable_haines['tempo'], new_total)
+
+    if zonal_zones:
+        with stage_metrics.stage('zonal'):
+            zonal_stats.zonal_stats(
+                zonal_zones,
+                zones_cache_directory,
+                new_total,
+                zonal_classes,
+                src_ds.GetGeoTransform(),
+                wkt_projection,
+                'haines_images_all/haines_index_zonal_{zones}_' + variable_haines['tempo'] + '.csv',
+                geographic=True
+            )
+
+def new_variable_haines(tempo, elev):
+    return {
+        'tempo': tempo,
+        'elev': elev,
+        'haines': {
+            'low': {},
+            'mid': {},
+            'high': {}
+        }
+    }
 
-        geopotential_array_300_temp1 = np.less_equal(geopotential_array_300, 300)
-        np.putmask(geopotential_array_300, geopotential_array_300_temp1, 1)
+def haines_index_stream(types, src_ds, index, elevation_class, times):
+    """
+    Una scadenza alla volta: lettura dei 6 campi (T a 4 livelli, q a 850 e 700),
+    low/mid/high, composizione e scrittura; la memoria non dipende dal numero di scadenze.
+    """
+    for valid_time in times:
+        with stage_metrics.stage('read'):
+            fields = read_timestep(types, src_ds, index, valid_time)
+        process_timestep(types, src_ds, fields, elevation_class, valid_time)
+        fields = None
+
+worker_state = {}
+
+def worker_settings():
+    """Opzioni di main() per i worker: con spawn o forkserver i globali del processo principale non vengono ereditati"""
+    return {
+        'product_formats': product_formats,
+        'datacube_filename': datacube_filename,
+        'zonal_zones': zonal_zones,
+        'zones_cache_directory': zones_cache_directory,
+        'tracemalloc': stage_metrics.tracemalloc_enabled()
+    }
 
-        geopotential_array_300_temp2 = np.greater(geopotential_array_300, 300)
-        np.putmask(geopotential_array_300, geopotential_array_300_temp2, 0)
-        #write_geotiff('haines_images_all/geopotential_array_300', variable_haines_list[c]['tempo'], src_ds, geopotential_array_300, 'LOW')
+def init_worker(fields_name, elevation_name, fields_shape, geotransform, settings):
+    """I worker vedono campi e classe di quota nella memoria condivisa, senza copie"""
+    global product_formats, datacube_filename, zonal_zones, zones_cache_directory
+    product_formats = settings['product_formats']
+    datacube_filename = settings['datacube_filename']
+    zonal_zones = settings['zonal_zones']
+    zones_cache_directory = settings['zones_cache_directory']
+    if settings['tracemalloc']:
+        stage_metrics.enable_tracemalloc()
+
+    fields_shm = shared_memory.SharedMemory(name=fields_name)
+    elevation_shm = shared_memory.SharedMemory(name=elevation_name)
+    [rows, cols] = fields_shape[2:]
+    worker_state['shm'] = (fields_shm, elevation_shm)
+    worker_state['fields'] = np.ndarray(fields_shape, dtype=np.float32, buffer=fields_shm.buf)
+    worker_state['elevation_class'] = np.ndarray((rows, cols), dtype=np.int8, buffer=elevation_shm.buf)
+    """Le misure ereditate dal processo principale (fork) restano a lui"""
+    stage_metrics.pop_records()
+    """Dataset senza bande con la sola georeferenziazione per la scrittura delle immagini"""
+    src_ds = gdal.GetDriverByName('MEM').Create('', cols, rows, 0)
+    src_ds.SetGeoTransform(geotransform)
+    worker_state['src_ds'] = src_ds
+
+def haines_timestep_worker(types, slot, valid_time):
+    fields = dict(
+        (field, worker_state['fields'][slot, n])
+        for n, field in enumerate(timestep_fields(types))
+    )
+    process_timestep(types, worker_state['src_ds'], fields, worker_state['elevation_class'], valid_time)
+    return stage_metrics.pop_records()
+
+def haines_index_parallel(types, src_ds, index, elevation_class, times, workers):
+    """
+    Scadenze distribuite su <workers> processi. Il processo principale legge i campi di una
+    scadenza in uno slot libero della memoria condivisa (2 slot per worker: la lettura della
+    scadenza successiva si sovrappone al calcolo); i worker calcolano e scrivono le immagini.
+    """
+    rows = src_ds.RasterYSize
+    cols = src_ds.RasterXSize
+    nslots = 2 * workers
+    fields_shape = (nslots, len(timestep_fields(types)), rows, cols)
+
+    fields_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(fields_shape)) * 4)
+    elevation_shm = shared_memory.SharedMemory(create=True, size=elevation_class.nbytes)
+    fields = None
+    try:
+        fields = np.ndarray(fields_shape, dtype=np.float32, buffer=fields_shm.buf)
+        np.ndarray(elevation_class.shape, dtype=np.int8, buffer=elevation_shm.buf)[:] = elevation_class
+
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_worker,
+                initargs=(fields_shm.name, elevation_shm.name, fields_shape, src_ds.GetGeoTransform(),
+                          worker_settings())) as executor:
+            free = list(range(nslots))
+            pending = {}
+            for valid_time in times:
+                if not free:
+                    [done, not_done] = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        free.append(pending.pop(future))
+                        stage_metrics.add_records(future.result())
+                slot = free.pop()
+                with stage_metrics.stage('read'):
+                    read_timestep(types, src_ds, index, valid_time, fields[slot])
+                pending[executor.submit(haines_timestep_worker, types, slot, valid_time)] = slot
+            for future in pending:
+                stage_metrics.add_records(future.result())
+    finally:
+        """Le viste numpy vanno rilasciate prima di chiudere la memoria condivisa"""
+        fields = None
+        fields_shm.close()
+        fields_shm.unlink()
+        elevation_shm.close()
+        elevation_shm.unlink()
 
+def haines_index_calc(types):
 
-        geopotential_array_300_900_temp1 = np.less_equal(geopotential_array_300_900, 300)
-        np.putmask(geopotential_array_300_900, geopotential_array_300_900_temp1, 0)
+    src_ds = gdal.Open(grib_filename)
 
-        geopotential_array_300_900_temp3 = np.logical_and([np.greater(geopotential_array_300_900, 300)],
-                                        [np.less_equal(geopotential_array_300_900, 900)])
-        np.putmask(geopotential_array_300_900, geopotential_array_300_900_temp3, 1)
+    """Indice delle bande: una sola lettura dei metadati, riusata finche' il GRIB non cambia"""
+    with stage_metrics.stage('band_scan'):
+        index = grib_index.load_index(grib_filename, src_ds)
 
-        geopotential_array_300_900_temp2 = np.greater(geopotential_array_300_900, 900)
-        np.putmask(geopotential_array_300_900, geopotential_array_300_900_temp2, 0)
-        #write_geotiff('haines_images_all/geopotential_array_300_900', variable_haines_list[c]['tempo'], src_ds, geopotential_array_300_900, 'MID')
+    with stage_metrics.stage('elevation_class'):
+        elevation_class = load_elevation_class(src_ds, index)
+    times = common_times(types, index)
 
+    if workers > 1:
+        haines_index_parallel(types, src_ds, index, elevation_class, times, workers)
+        return
 
-        geopotential_array_900_temp1 = np.less_equal(geopotential_array_900, 900)
-        np.putmask(geopotential_array_900, geopotential_array_900_temp1, 0)
+    if streaming:
+        haines_index_stream(types, src_ds, index, elevation_class, times)
+        return
 
-        geopotential_array_900_temp2 = np.greater(geopotential_array_900, 900)
-        np.putmask(geopotential_array_900, geopotential_array_900_temp2, 1)
-        #write_geotiff('haines_images_all/geopotential_array_900', variable_haines_list[c]['tempo'], src_ds, geopotential_array_900, 'HIGH')
+    variable_dict = new_variable_dict()
 
+    for key, value in types.items():
+        with stage_metrics.stage('read', type=key):
+            variable_dict = read_variables(key, value, src_ds, index, variable_dict, times)
+    variable_dict['tempi'] = [format_time(valid_time) for valid_time in times]
+    dict_len = len(variable_dict['tempi'])
 
-        new_low = np.multiply(variable_haines_list[c]['haines']['low'], geopotential_array_300)
-        #write_geotiff('haines_images_all/haines_index_reclass', variable_haines_list[c]['tempo'], src_ds, new_low, 'LOW')
+    variable_haines_list = []
 
-        new_mid = np.multiply(variable_haines_list[c]['haines']['mid'], geopotential_array_300_900)
-        #write_geotiff('haines_images_all/haines_index_reclass', variable_haines_list[c]['tempo'], src_ds, new_mid, 'MID')
+    for i in range(dict_len):
 
-        new_high = np.multiply(variable_haines_list[c]['haines']['high'], geopotential_array_900)
-        #write_geotiff('haines_images_all/haines_index_reclass', variable_haines_list[c]['tempo'], src_ds, new_high,'HIGH')
+        variable_haines_list.append(new_variable_haines(variable_dict['tempi'][i], elevation_class))
 
-        new_total = new_low+new_mid+new_high
+        for key, value in types.items():
+            write_haines_array(key, value, src_ds, variable_dict, i, True, variable_haines_list)
 
-        write_geotiff('haines_images_all/haines_index_reclass', variable_haines_list[c]['tempo'], src_ds, new_total, 'ALL', gdal.GDT_Byte)
+    for c in range(len(variable_haines_list)):
+        blend_haines(src_ds, variable_haines_list[c])
+
+def append_datacube(src_ds, tempo, haines_all):
+    """Una slice per tempo di validita': una corsa successiva sovrascrive le scadenze gia' presenti"""
+    with stage_metrics.stage('datacube'):
+        datacube.append_product(
+            datacube_filename,
+            {
+                'geotransform': src_ds.GetGeoTransform(),
+                'rows': src_ds.RasterYSize,
+                'cols': src_ds.RasterXSize,
+                'projection': wkt_projection,
+                'geographic': True,
+                'runs': None
+            },
+            datacube.haines_variables,
+            datetime.strptime(tempo, '%Y%m%dT%H%M%S000Z'),
+            {'haines_class': haines_all.astype(np.uint8)}
+        )
 
 """
 OROGRAFIA
@@ -388,17 +524,28 @@ can be used to identify weather systems such as cyclones, anticyclones, troughs
     GRIB_SHORT_NAME=0-SFC
     GRIB_UNIT=[m^2/s^2]
 """
+def write_stage_metrics(metrics_dir):
+    """Le misure non devono far fallire l'elaborazione"""
+    if metrics_dir is None:
+        return
+    try:
+        stage_metrics.write_metrics('haines_index_calc_all', metrics_dir, time.time() - start_time)
+    except Exception as e:
+        print(e)
+
 def print_usage():
-    print("haines_index_calc_all.py -e <elevation>")
+    print("haines_index_calc_all.py -e <elevation> [--metrics <dir>] [--tracemalloc] [--format <fmt>] [--datacube <file.nc>] [--zones <zone>] [--stream] [-j <workers>]")
 
 def main(argv):
+    global product_formats, datacube_filename, zonal_zones, streaming, workers
     #print("ARGV      :", sys.argv[1:])
     elev = None
+    metrics_dir = None
     try:
         # opts is a list of returning key-value pairs, args is the options left after striped
         # the short options 'hi:o:', if an option requires an input, it should be followed by a ":"
         # the long options 'ifile=' is an option that requires an input, followed by a "="
-        opts, args = getopt.getopt(argv, "he:", ["help", "elevation="])
+        opts, args = getopt.getopt(argv, "he:j:", ["help", "elevation=", "metrics=", "tracemalloc", "format=", "datacube=", "zones=", "stream", "workers="])
     except getopt.GetoptError as err:
         print(err)  # will print something like "option -a not recognized"
         print_usage()
@@ -408,10 +555,27 @@ def main(argv):
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print("haines_index_calc_all.py -e <elevation>")
+            print("haines_index_calc_all.py -e <elevation> [--metrics <dir>] [--tracemalloc] [--format <fmt>] [--datacube <file.nc>] [--zones <zone>] [--stream] [-j <workers>]")
             sys.exit(2)
         elif opt in ("-e", "--elevation"):
             elev = arg
+        elif opt == "--metrics":
+            metrics_dir = arg
+        elif opt == "--tracemalloc":
+            stage_metrics.enable_tracemalloc()
+        elif opt == "--format":
+            product_formats = output_backend.parse_formats(arg, 'gtiff')
+            if 'rst' in product_formats.values():
+                print("formati ammessi: gtiff, cog")
+                sys.exit(2)
+        elif opt == "--datacube":
+            datacube_filename = arg
+        elif opt == "--zones":
+            zonal_zones = zonal_stats.parse_zones(arg)
+        elif opt == "--stream":
+            streaming = True
+        elif opt in ("-j", "--workers"):
+            workers = int(arg)
         else:
             assert False, "unhandled option"
 
@@ -433,7 +597,9 @@ def main(argv):
         haines_index_calc(elev)
     except Exception as e:
         print(e)
+        write_stage_metrics(metrics_dir)
         sys.exit(2)
+    write_stage_metrics(metrics_dir)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+Kernel numerico dell'indice di Haines (temperatura di rugiada, fattori A/B, classe del giorno).
+
+Stesse formule di dewpoint_temp_calc() e write_haines_array() ma in float32/int8 su buffer
+allocati una sola volta per griglia, con ufunc in place (out=): nessun temporaneo grande
+per passo, nessun pow(..., 14) su array float64.
+
+ - fattore (A o B): 1 se x <= uno, 3 se x >= tre, 2 altrimenti, cioe' 1 + (x > uno) + (x >= tre)
+   (le tabelle check_termine_a/b hanno due = [uno, tre])
+ - classe del giorno: A + B (2..6) -> 1, 1, 2, 3, 4 con una tabella (take)
+
+I NaN in ingresso danno fattore 1 invece di restare NaN: i campi GRIB non ne contengono.
+"""
+
+import numpy as np
+
+"""Classe del giorno per A + B = 0..6 (0 e 1 non si presentano)"""
+class_lut = np.array([0, 0, 1, 1, 2, 3, 4], dtype=np.int8)
+
+kernel_buffers = {}
+
+
+def buffers_for(shape):
+    """Buffer riusati da tutte le scadenze con la stessa griglia (un processo, un thread)"""
+    shape = tuple(shape)
+    if shape not in kernel_buffers:
+        kernel_buffers[shape] = {
+            't_sup': np.empty(shape, dtype=np.float32),
+            't_inf': np.empty(shape, dtype=np.float32),
+            'q': np.empty(shape, dtype=np.float32),
+            'lapse_rate': np.empty(shape, dtype=np.float32),
+            'moisture': np.empty(shape, dtype=np.float32),
+            'work1': np.empty(shape, dtype=np.float32),
+            'work2': np.empty(shape, dtype=np.float32),
+            'work3': np.empty(shape, dtype=np.float32),
+            'mask': np.empty(shape, dtype=bool),
+            'factor_a': np.empty(shape, dtype=np.int8),
+            'factor_b': np.empty(shape, dtype=np.int8),
+            'haines_values': np.empty(shape, dtype=np.int8)
+        }
+    return kernel_buffers[shape]
+
+
+def dewpoint(level, temperature, humidity, out, buffers):
+    """
+    Temperatura di rugiada (C) in <out>, come dewpoint_temp_calc():
+    td = T - ((14.55 + 0.114 T) s + ((2.5 + 0.007 T) s)^3 + (15.9 + 0.117 T) s^14), s = 1 - 0.01 rh
+    """
+    t1 = buffers['work1']
+    t2 = buffers['work2']
+    t3 = buffers['work3']
+    pc = np.float32(level * 10000)
+
+    """10^exp, exp = (0.7859 + 0.03477 T) / (1 + 0.00412 T) + 2"""
+    np.multiply(temperature, np.float32(0.03477), out=t1)
+    t1 += np.float32(0.7859)
+    np.multiply(temperature, np.float32(0.00412), out=t2)
+    t2 += np.float32(1.0)
+    t1 /= t2
+    t1 += np.float32(2)
+    np.power(np.float32(10), t1, out=t1)
+
+    """rh = pc q / 10^exp / (0.378 q + 0.622), poi s = 1 - 0.01 rh"""
+    np.multiply(humidity, np.float32(0.378), out=t2)
+    t2 += np.float32(0.622)
+    np.multiply(humidity, pc, out=t3)
+    t3 /= t1
+    t3 /= t2
+    t3 *= np.float32(-0.01)
+    t3 += np.float32(1)
+
+    """(14.55 + 0.114 T) s"""
+    np.multiply(temperature, np.float32(0.114), out=out)
+    out += np.float32(14.55)
+    out *= t3
+
+    """((2.5 + 0.007 T) s)^3"""
+    np.multiply(temperature, np.float32(0.007), out=t1)
+    t1 += np.float32(2.5)
+    t1 *= t3
+    np.multiply(t1, t1, out=t2)
+    t2 *= t1
+    out += t2
+
+    """
+    (15.9 + 0.117 T) s^14 con s^14 = s^8 s^4 s^2.
+    s limitato a 0..1 (rh 0..100): con rh molto fuori dall'intervallo s^14 supera il float32
+    """
+    np.clip(t3, np.float32(0), np.float32(1), out=t3)
+    np.multiply(t3, t3, out=t1)
+    np.multiply(t1, t1, out=t2)
+    np.multiply(t2, t2, out=t3)
+    t3 *= t2
+    t3 *= t1
+    np.multiply(temperature, np.float32(0.117), out=t1)
+    t1 += np.float32(15.9)
+    t1 *= t3
+    out += t1
+
+    np.subtract(temperature, out, out=out)
+    return out
+
+
+def factor(values, one, three, out, mask):
+    """Fattore 1/2/3 in <out> (int8): 1 + (x > uno) + (x >= tre)"""
+    np.greater(values, one, out=mask)
+    np.add(mask, 1, out=out, casting='unsafe')
+    np.greater_equal(values, three, out=mask)
+    out += mask
+    return out
+
+
+def haines_class(factor_a, factor_b, values, out):
+    """Somma dei fattori in <values> e classe del giorno in <out>"""
+    np.add(factor_a, factor_b, out=values)
+    np.take(class_lut, values, out=out)
+    return out
+
+
+def haines_type(key, level, t_sup, t_inf, q, limits_a, limits_b, out=None):
+    """
+    Indice di Haines di un tipo (low/mid/high) in <out> (int8, allocato se None).
+    level: livello (hPa) dell'umidita' <q>, inf per LOW, sup per MID e HIGH.
+    Restituisce i buffer con i valori intermedi (lapse_rate, moisture, fattori, somma).
+    """
+    buffers = buffers_for(np.shape(t_sup))
+    np.copyto(buffers['t_sup'], t_sup, casting='same_kind')
+    np.copyto(buffers['t_inf'], t_inf, casting='same_kind')
+    np.copyto(buffers['q'], q, casting='same_kind')
+    temperature = buffers['t_inf'] if key == 'low' else buffers['t_sup']
+
+    """(A) lapse rate"""
+    np.subtract(buffers['t_sup'], buffers['t_inf'], out=buffers['lapse_rate'])
+    factor(buffers['lapse_rate'], limits_a[0], limits_a[1], buffers['factor_a'], buffers['mask'])
+
+    """(B) moisture = T - Td al livello dell'umidita'"""
+    dewpoint(level, temperature, buffers['q'], buffers['moisture'], buffers)
+    np.subtract(temperature, buffers['moisture'], out=buffers['moisture'])
+    factor(buffers['moisture'], limits_b[0], limits_b[1], buffers['factor_b'], buffers['mask'])
+
+    if out is None:
+        out = np.empty(np.shape(t_sup), dtype=np.int8)
+    haines_class(buffers['factor_a'], buffers['factor_b'], buffers['haines_values'], out)
+    return out, buffers
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Scrittura dei prodotti finali nei formati richiesti da riga di comando.
+
+Formati:
+ - rst: IDRISI (formato storico dei prodotti fuoco prescritto)
+ - gtiff: GeoTIFF senza compressione (formato storico degli indici di Haines)
+ - cog: Cloud Optimized GeoTIFF a tile, compresso, con overview interne;
+        il tile server legge solo i blocchi necessari con richieste a intervalli
+
+Maschere 0/1 e classi (tipi interi) vengono compresse senza predittore e le overview
+sono calcolate con NEAREST (nessuna classe inventata); i valori continui (float) usano
+il predittore floating point e overview AVERAGE. Le classi scritte come float
+(es. *_reclass degli indici di Haines) vanno scritte con categorical=True.
+Con GDAL < 3.1 (senza driver COG) il file viene costruito in memoria con le overview
+e copiato in GeoTIFF a tile con COPY_SRC_OVERVIEWS, che produce la stessa struttura.
+
+Il formato si sceglie per prodotto: "cog" per tutti, oppure "threshold=cog,criteria=rst".
+"""
+
+from osgeo import gdal
+
+output_formats = ('rst', 'gtiff', 'cog')
+output_extensions = {
+    'rst': '.rst',
+    'gtiff': '.tif',
+    'cog': '.tif'
+}
+
+cog_compress = 'DEFLATE'
+cog_blocksize = 256
+
+integer_types = (gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_Int16, gdal.GDT_UInt32, gdal.GDT_Int32)
+
+
+def parse_formats(value, default):
+    """'cog' oppure 'prodotto=formato,...' -> {'default': ..., prodotto: formato}"""
+    formats = {'default': default}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            [product, fmt] = item.split('=', 1)
+        else:
+            [product, fmt] = ['default', item]
+        fmt = fmt.lower()
+        if fmt not in output_formats:
+            raise ValueError('Formato di uscita non valido: ' + fmt)
+        formats[product] = fmt
+    return formats
+
+
+def product_format(formats, product):
+    return formats.get(product, formats['default'])
+
+
+def overview_levels(rows, cols, blocksize=cog_blocksize):
+    """Fattori 2, 4, 8... finche' il livello precedente e' piu' grande di un blocco"""
+    levels = []
+    factor = 2
+    while max(rows, cols) // (factor // 2) > blocksize:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def memory_dataset(array, geotransform, projection, data_type, nodata=None, metadata=None):
+    [rows, cols] = array.shape
+    dataset = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, data_type)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(projection)
+    if metadata:
+        dataset.SetMetadata(metadata)
+    band = dataset.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(array)
+    return dataset
+
+
+def write_cog(filename, dataset, categorical):
+    resampling = 'NEAREST' if categorical else 'AVERAGE'
+    if gdal.GetDriverByName('COG') is not None:
+        options = [
+            'COMPRESS=' + cog_compress,
+            'BLOCKSIZE=' + str(cog_blocksize),
+            'PREDICTOR=' + ('NO' if categorical else 'FLOATING_POINT'),
+            'OVERVIEW_RESAMPLING=' + resampling,
+            'RESAMPLING=' + resampling
+        ]
+        gdal.GetDriverByName('COG').CreateCopy(filename, dataset, options=options)
+        return
+
+    levels = overview_levels(dataset.RasterYSize, dataset.RasterXSize)
+    if levels:
+        dataset.BuildOverviews(resampling, levels)
+    options = [
+        'TILED=YES',
+        'BLOCKXSIZE=' + str(cog_blocksize),
+        'BLOCKYSIZE=' + str(cog_blocksize),
+        'COMPRESS=' + cog_compress,
+        'PREDICTOR=' + ('1' if categorical else '3'),
+        'COPY_SRC_OVERVIEWS=YES'
+    ]
+    gdal.GetDriverByName('GTiff').CreateCopy(filename, dataset, options=options)
+
+
+def write_raster(filename, array, geotransform, projection, data_type, fmt='rst', nodata=None, metadata=None,
+                 categorical=None):
+    """
+    Scrivo il raster nel formato richiesto (filename comprende l'estensione).
+    categorical: classi (nessun predittore, overview NEAREST); se None lo decide il tipo di dato
+    """
+    if categorical is None:
+        categorical = data_type in integer_types
+    if fmt == 'cog':
+        dataset = memory_dataset(array, geotransform, projection, data_type, nodata, metadata)
+        write_cog(filename, dataset, categorical)
+        dataset = None
+        return
+
+    driver = gdal.GetDriverByName('RST' if fmt == 'rst' else 'GTiff')
+    [rows, cols] = array.shape
+    dataset = driver.Create(filename, cols, rows, 1, data_type)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(projection)
+    if metadata:
+        dataset.SetMetadata(metadata)
+    band = dataset.GetRasterBand(1)
+    band.WriteArray(array)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    dataset.FlushCache()
+    dataset = None
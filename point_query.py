@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+Interrogazione dei prodotti pubblicati in un insieme di punti (stazioni, siti di bruciatura).
+
+Le coordinate (lon/lat WGS84 oppure un EPSG, es. 32632 per UTM 32N) vengono convertite
+in indici riga/colonna una sola volta per griglia: tutti i prodotti fuoco prescritto
+condividono la griglia prec, tutte le immagini Haines la griglia del GRIB.
+I raster IDRISI (.rst) sono letti come memmap descritti dal .rdc, senza aprire GDAL,
+e si accede solo alle pagine che contengono i punti; gli altri formati (GeoTIFF, COG)
+sono letti con GDAL.
+
+I punti si indicano con --point x,y[,nome] (ripetibile) o con un csv nome,x,y (--points);
+i prodotti sono file o pattern glob, ad esempio
+    point_query.py --points stazioni.csv '/mnt/hd/operativo/risout_prev/arw/fire_presc_threshold_Run0_*.rst'
+"""
+
+import os
+import sys
+import getopt
+import csv
+import json
+import glob
+import numpy as np
+from osgeo import gdal, osr
+import time
+start_time = time.time()
+
+import calc_fuoco_prescritto as fp
+
+"""Tipi IDRISI -> dtype (file binari little endian)"""
+rdc_types = {
+    'byte': np.dtype(np.uint8),
+    'integer': np.dtype('<i2'),
+    'real': np.dtype('<f4')
+}
+
+"""Sistemi di riferimento IDRISI dei prodotti"""
+rdc_reference_systems = {
+    'latlong': fp.wkt_projection,
+    'utm-32n': fp.wkt_projection_prec
+}
+
+
+def read_points(filename):
+    """csv con colonne nome,x,y (intestazione facoltativa)"""
+    points = []
+    with open(filename, newline='') as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith('#'):
+                continue
+            try:
+                points.append((row[0], float(row[1]), float(row[2])))
+            except ValueError:
+                """Intestazione"""
+                continue
+    return points
+
+
+def parse_point(value, n):
+    fields = value.split(',')
+    name = fields[2] if len(fields) > 2 else 'p' + str(n)
+    return (name, float(fields[0]), float(fields[1]))
+
+
+def read_rdc(filename):
+    """Documentazione IDRISI (.rdc): chiave : valore"""
+    header = {}
+    with open(filename) as f:
+        for line in f:
+            if ':' in line:
+                [key, value] = line.split(':', 1)
+                header[key.strip()] = value.strip()
+    return header
+
+
+def rst_grid(filename):
+    """Griglia e tipo dal .rdc; None se il raster va letto con GDAL"""
+    rdc = os.path.splitext(filename)[0] + '.rdc'
+    if not filename.lower().endswith('.rst') or not os.path.exists(rdc):
+        return None
+    header = read_rdc(rdc)
+    projection = rdc_reference_systems.get(header.get('ref. system', '').lower())
+    if (projection is None or header.get('file type', 'binary') != 'binary' or
+            header.get('data type') not in rdc_types):
+        return None
+    rows = int(header['rows'])
+    cols = int(header['columns'])
+    min_x = float(header['min. X'])
+    max_x = float(header['max. X'])
+    min_y = float(header['min. Y'])
+    max_y = float(header['max. Y'])
+    return {
+        'geotransform': (min_x, (max_x - min_x) / cols, 0, max_y, 0, -(max_y - min_y) / rows),
+        'projection': projection,
+        'shape': (rows, cols),
+        'dtype': rdc_types[header['data type']]
+    }
+
+
+def open_product(filename):
+    """(griglia, array): memmap per gli rst, banda letta con GDAL altrimenti"""
+    grid = rst_grid(filename)
+    if grid is not None:
+        return grid, np.memmap(filename, dtype=grid['dtype'], mode='r', shape=grid['shape'])
+
+    src_ds = gdal.Open(filename)
+    if src_ds is None:
+        raise IOError('Impossibile aprire ' + filename)
+    grid = {
+        'geotransform': tuple(src_ds.GetGeoTransform()),
+        'projection': src_ds.GetProjection() or fp.wkt_projection,
+        'shape': (src_ds.RasterYSize, src_ds.RasterXSize)
+    }
+    array = src_ds.GetRasterBand(1).ReadAsArray()
+    src_ds = None
+    return grid, array
+
+
+def spatial_reference(value):
+    srs = osr.SpatialReference()
+    if value == 'lonlat':
+        srs.ImportFromEPSG(4326)
+    elif value.isdigit():
+        srs.ImportFromEPSG(int(value))
+    else:
+        srs.ImportFromWkt(value)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        """Only for gdal > 3: mantengo l'ordine lon/lat"""
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def pixel_indices(points, srs, grid, cache):
+    """Righe e colonne dei punti nella griglia (-1 fuori griglia), calcolate una volta per griglia"""
+    key = (grid['geotransform'], grid['projection'], grid['shape'])
+    if key in cache:
+        return cache[key]
+
+    xy = np.array([[x, y] for name, x, y in points], dtype=np.float64)
+    src_srs = spatial_reference(srs)
+    dst_srs = spatial_reference(grid['projection'])
+    if not src_srs.IsSame(dst_srs):
+        transform = osr.CoordinateTransformation(src_srs, dst_srs)
+        xy = np.array(transform.TransformPoints(xy.tolist()))[:, :2]
+
+    geotransform = grid['geotransform']
+    [rows, cols] = grid['shape']
+    col = np.floor((xy[:, 0] - geotransform[0]) / geotransform[1]).astype(np.int64)
+    row = np.floor((xy[:, 1] - geotransform[3]) / geotransform[5]).astype(np.int64)
+    outside = (row < 0) | (row >= rows) | (col < 0) | (col >= cols)
+    row[outside] = -1
+    col[outside] = -1
+
+    cache[key] = (row, col)
+    return row, col
+
+
+def query(points, filenames, srs='lonlat'):
+    """Valori dei punti per ogni prodotto: [{'product', 'name', 'x', 'y', 'row', 'col', 'value'}]"""
+    results = []
+    cache = {}
+    for filename in filenames:
+        [grid, array] = open_product(filename)
+        [row, col] = pixel_indices(points, srs, grid, cache)
+        inside = row >= 0
+        values = np.zeros(len(points), dtype=array.dtype)
+        values[inside] = array[row[inside], col[inside]]
+        array = None
+        product = os.path.basename(filename)
+        for n, [name, x, y] in enumerate(points):
+            results.append({
+                'product': product,
+                'name': name,
+                'x': x,
+                'y': y,
+                'row': int(row[n]),
+                'col': int(col[n]),
+                'value': values[n].item() if inside[n] else None
+            })
+    return results
+
+
+def expand_products(patterns):
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        filenames.extend(matches if matches else [pattern])
+    return filenames
+
+
+def write_results(results, fmt, output):
+    f = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        if fmt == 'json':
+            json.dump(results, f, indent=1)
+            f.write('\n')
+        else:
+            writer = csv.DictWriter(f, fieldnames=['product', 'name', 'x', 'y', 'row', 'col', 'value'])
+            writer.writeheader()
+            writer.writerows(results)
+    finally:
+        if output:
+            f.close()
+
+
+def print_usage():
+    print("point_query.py (--point <x>,<y>[,<nome>] | --points <punti.csv>) [-s <lonlat|epsg>] [-f <csv|json>] [-o <output>] <prodotto> [<prodotto> ...]")
+    print("    i prodotti possono essere pattern glob; le coordinate sono lon/lat WGS84 se non si indica -s")
+
+
+def main(argv):
+    points = []
+    srs = 'lonlat'
+    fmt = 'csv'
+    output = None
+    try:
+        opts, args = getopt.getopt(argv, "hs:f:o:", ["help", "point=", "points=", "srs=", "format=", "output="])
+    except getopt.GetoptError as err:
+        print(err)
+        print_usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_usage()
+            sys.exit(2)
+        elif opt == "--point":
+            points.append(parse_point(arg, len(points)))
+        elif opt == "--points":
+            points.extend(read_points(arg))
+        elif opt in ("-s", "--srs"):
+            srs = arg
+        elif opt in ("-f", "--format"):
+            fmt = arg
+        elif opt in ("-o", "--output"):
+            output = arg
+        else:
+            assert False, "unhandled option"
+
+    if not points or not args or fmt not in ('csv', 'json'):
+        print_usage()
+        sys.exit(2)
+
+    try:
+        write_results(query(points, expand_products(args), srs), fmt, output)
+    except Exception as e:
+        print(e)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+    print("--- %s seconds ---" % (time.time() - start_time), file=sys.stderr)
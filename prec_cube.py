@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""
+Cubo giornaliero della pioggia (tempo x righe x colonne, float32) mappato in memoria.
+
+Consolida i raster toscana_Prec_dem1000_1_1_263_239_<data>.rst della cartella metout
+in un unico file binario append-only (prec_cube.dat) con un indice data -> offset
+(prec_cube.json). Una finestra di qualsiasi lunghezza e' una slice senza copie.
+
+L'aggiunta di un giorno e' atomica: prima si scrivono i dati in coda al file,
+poi si sostituisce l'indice con os.replace. I lettori vedono solo i giorni
+presenti nell'indice, quindi il cubo puo' essere aggiornato mentre viene letto.
+I giorni mancanti vengono riempiti con NaN e registrati in "missing"; quando il file
+arriva (prec_cube.py -d <giorno>) il giorno viene scritto al suo posto.
+"""
+
+import os
+import sys
+import getopt
+import json
+import fcntl
+import fnmatch
+import uuid
+import numpy as np
+from osgeo import gdal
+from datetime import timedelta, datetime
+import time
+start_time = time.time()
+
+prec_prefix = 'toscana_Prec_dem1000_1_1_263_239_'
+data_filename = 'prec_cube.dat'
+index_filename = 'prec_cube.json'
+lock_filename = 'prec_cube.lock'
+
+
+def parse_date(giorno):
+    return datetime.strptime(giorno, "%Y-%m-%d").date()
+
+
+def read_index(cube_dir):
+    with open(os.path.join(cube_dir, index_filename)) as f:
+        return json.load(f)
+
+
+def write_index(cube_dir, index):
+    """Sostituisco l'indice in modo atomico"""
+    filename = os.path.join(cube_dir, index_filename)
+    tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def open_cube(cube_dir):
+    """Apro il cubo in sola lettura; restituisce None se non esiste"""
+    if not os.path.exists(os.path.join(cube_dir, index_filename)):
+        return None
+    index = read_index(cube_dir)
+    if index['ndays'] == 0:
+        return None
+    data = np.memmap(
+        os.path.join(cube_dir, data_filename),
+        dtype=np.dtype(index['dtype']),
+        mode='r',
+        shape=(index['ndays'], index['nrows'], index['ncols']))
+    return {
+        'index': index,
+        'start_date': parse_date(index['start_date']),
+        'missing': set(index['missing']),
+        'data': data
+    }
+
+
+def date_offset(cube, giorno):
+    """Offset del giorno nel cubo (None se fuori dal cubo)"""
+    offset = (giorno - cube['start_date']).days
+    if offset < 0 or offset >= cube['index']['ndays']:
+        return None
+    return offset
+
+
+def has_window(cube, start_date, end_date):
+    """Vero se tutti i giorni della finestra [start_date, end_date] sono nel cubo"""
+    if cube is None:
+        return False
+    if date_offset(cube, start_date) is None or date_offset(cube, end_date) is None:
+        return False
+    for n in range((end_date - start_date).days + 1):
+        if (start_date + timedelta(days=n)).strftime("%Y-%m-%d") in cube['missing']:
+            return False
+    return True
+
+
+def window_identity(cube_dir, cube, start_date, end_date):
+    """
+    Identita' dei dati della finestra: il cubo e' append-only e un giorno gia' presente
+    (non in "missing": has_window esclude le finestre con giorni mancanti) non cambia piu',
+    quindi bastano l'identita' del cubo e le date della finestra;
+    le aggiunte dei giorni successivi non la cambiano.
+    I cubi creati prima dell'id sono identificati dall'inode del file dati.
+    """
+    cube_id = cube['index'].get('id')
+    if cube_id is None:
+        cube_id = os.stat(os.path.join(cube_dir, data_filename)).st_ino
+    return [
+        cube_id,
+        cube['index']['start_date'],
+        start_date.strftime("%Y-%m-%d"),
+        end_date.strftime("%Y-%m-%d")
+    ]
+
+
+def read_window(cube, start_date, end_date):
+    """Finestra [start_date, end_date] come vista sul file mappato (nessuna copia)"""
+    return cube['data'][date_offset(cube, start_date):date_offset(cube, end_date) + 1]
+
+
+def read_prec_file(filename):
+    src_ds_prec = gdal.Open(filename)
+    if src_ds_prec is None:
+        return None
+    prec = src_ds_prec.ReadAsArray().astype(np.float32)
+    src_ds_prec = None
+    return prec
+
+
+def append_days(cube_dir, giorno, arrays):
+    """
+    Aggiungo in coda i giorni a partire da <giorno>.
+    Eventuali giorni saltati fra la fine del cubo e <giorno> vengono riempiti con NaN.
+    Un giorno gia' nel cubo ma registrato in "missing" (file di pioggia arrivato in ritardo)
+    viene scritto nella sua posizione e tolto da "missing"; gli altri giorni gia' presenti
+    non possono essere riscritti.
+    """
+    os.makedirs(cube_dir, exist_ok=True)
+    with open(os.path.join(cube_dir, lock_filename), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        [nrows, ncols] = arrays[0].shape
+        if os.path.exists(os.path.join(cube_dir, index_filename)):
+            index = read_index(cube_dir)
+        else:
+            index = {
+                'id': uuid.uuid4().hex,
+                'start_date': giorno.strftime("%Y-%m-%d"),
+                'ndays': 0,
+                'nrows': nrows,
+                'ncols': ncols,
+                'dtype': 'float32',
+                'missing': []
+            }
+
+        if (nrows, ncols) != (index['nrows'], index['ncols']):
+            raise ValueError('Dimensioni diverse da quelle del cubo: ' + str((nrows, ncols)))
+
+        start_date = parse_date(index['start_date'])
+        offset = (giorno - start_date).days
+        if offset < 0:
+            raise ValueError('Il giorno ' + giorno.strftime("%Y-%m-%d") + ' precede l\'inizio del cubo')
+        for n in range(offset, min(offset + len(arrays), index['ndays'])):
+            day = (start_date + timedelta(days=n)).strftime("%Y-%m-%d")
+            if day not in index['missing']:
+                raise ValueError('Il giorno ' + day + ' e\' gia\' nel cubo')
+
+        frame_bytes = nrows * ncols * 4
+        with open(os.path.join(cube_dir, data_filename), 'ab+') as f:
+            """Elimino eventuali dati di un'aggiunta interrotta"""
+            f.truncate(index['ndays'] * frame_bytes)
+
+        with open(os.path.join(cube_dir, data_filename), 'r+b') as f:
+            """Giorni mancanti gia' nel cubo: li scrivo nella loro posizione"""
+            for n in range(offset, min(offset + len(arrays), index['ndays'])):
+                f.seek(n * frame_bytes)
+                f.write(np.ascontiguousarray(arrays[n - offset], dtype=np.float32).tobytes())
+                index['missing'].remove((start_date + timedelta(days=n)).strftime("%Y-%m-%d"))
+
+            f.seek(index['ndays'] * frame_bytes)
+            for n in range(index['ndays'], offset):
+                f.write(np.full((nrows, ncols), np.nan, dtype=np.float32).tobytes())
+                index['missing'].append((start_date + timedelta(days=n)).strftime("%Y-%m-%d"))
+            for array in arrays[max(index['ndays'] - offset, 0):]:
+                f.write(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        index['ndays'] = max(index['ndays'], offset + len(arrays))
+        write_index(cube_dir, index)
+
+
+def update_cube(metout_dir, cube_dir, giorno=None):
+    """Aggiungo al cubo il giorno richiesto o tutti i file di metout successivi alla fine del cubo o mancanti"""
+    if giorno is not None:
+        prec = read_prec_file(os.path.join(metout_dir, prec_prefix + giorno + '.rst'))
+        if prec is None:
+            raise IOError('File di pioggia mancante per il giorno ' + giorno)
+        append_days(cube_dir, parse_date(giorno), [prec])
+        return
+
+    end_date = None
+    missing = set()
+    if os.path.exists(os.path.join(cube_dir, index_filename)):
+        index = read_index(cube_dir)
+        end_date = parse_date(index['start_date']) + timedelta(days=index['ndays'] - 1)
+        missing = set(index['missing'])
+
+    filelists = sorted(fnmatch.filter(os.listdir(metout_dir), prec_prefix + '????-??-??.rst'))
+    for filename in filelists:
+        prec_date = parse_date(filename[len(prec_prefix):-len('.rst')])
+        if end_date is not None and prec_date <= end_date and prec_date.strftime("%Y-%m-%d") not in missing:
+            continue
+        prec = read_prec_file(os.path.join(metout_dir, filename))
+        if prec is None:
+            continue
+        append_days(cube_dir, prec_date, [prec])
+        end_date = prec_date if end_date is None else max(end_date, prec_date)
+
+
+def print_usage():
+    print("prec_cube.py -m <metout> -c <cube> [-d <day>]")
+
+
+def main(argv):
+    metout_dir = None
+    cube_dir = None
+    giorno = None
+    try:
+        opts, args = getopt.getopt(argv, "hm:c:d:", ["help", "metout=", "cube=", "day="])
+    except getopt.GetoptError as err:
+        print(err)
+        print_usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_usage()
+            sys.exit(2)
+        elif opt in ("-m", "--metout"):
+            metout_dir = arg
+        elif opt in ("-c", "--cube"):
+            cube_dir = arg
+        elif opt in ("-d", "--day"):
+            giorno = arg
+        else:
+            assert False, "unhandled option"
+
+    if metout_dir is None or cube_dir is None:
+        print_usage()
+        sys.exit(2)
+
+    try:
+        """Senza -d vengono aggiunti tutti i giorni nuovi presenti in metout"""
+        update_cube(metout_dir, cube_dir, giorno)
+    except Exception as e:
+        print(e)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+    print("--- %s seconds ---" % (time.time() - start_time))
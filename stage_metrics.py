@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+Misure delle fasi di elaborazione.
+
+    with stage_metrics.stage('prec_threshold'):
+        prec_threshold(...)
+
+Per ogni fase si registrano durata, byte letti e scritti (rchar/wchar di /proc/self/io,
+comprendono NFS e cache) e picco RSS del processo (ru_maxrss); con enable_tracemalloc()
+anche il picco della memoria allocata da Python durante la fase.
+I contatori sono del processo: le fasi eseguite in parallelo (thread) vedono anche
+l'I/O delle altre fasi attive. Anche il picco di tracemalloc e' unico per il processo,
+quindi viene registrato solo per le fasi senza altre fasi attive (di altri thread o annidate);
+il picco complessivo di ogni processo e' la fase 'process'.
+
+write_metrics() aggrega le fasi con lo stesso nome ed etichette e scrive:
+ - una riga JSON in coda a <directory>/<job>.jsonl
+ - il file <directory>/<job>.prom per il textfile collector di node_exporter
+"""
+
+import os
+import json
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+import time
+
+metrics_prefix = 'fire_stage_'
+metrics_lock = threading.Lock()
+metrics_records = []
+
+"""Fasi attive e picco di tracemalloc del processo fino all'ultimo reset_peak()"""
+tracemalloc_state = {'active': [], 'peak': 0}
+
+
+def read_io():
+    """Byte letti e scritti dal processo fino ad ora (0 se /proc/self/io non e' disponibile)"""
+    counters = {'rchar': 0, 'wchar': 0}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                [name, value] = line.split(':')
+                if name in counters:
+                    counters[name] = int(value)
+    except (IOError, ValueError):
+        pass
+    return counters
+
+
+def peak_rss():
+    """Picco RSS del processo in byte (ru_maxrss e' in KB su Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def enable_tracemalloc():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def tracemalloc_enabled():
+    return tracemalloc.is_tracing()
+
+
+def tracemalloc_peak():
+    """Picco della memoria Python del processo dall'ultimo pop_records()"""
+    return max(tracemalloc_state['peak'], tracemalloc.get_traced_memory()[1])
+
+
+def start_tracing():
+    """
+    Registro la fase fra quelle attive; il picco viene azzerato solo se non ce ne sono altre,
+    cosi' non si altera il picco delle fasi in corso
+    """
+    entry = {'overlap': False}
+    with metrics_lock:
+        active = tracemalloc_state['active']
+        if active:
+            entry['overlap'] = True
+            for other in active:
+                other['overlap'] = True
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc_state['peak'] = tracemalloc_peak()
+            tracemalloc.reset_peak()
+        else:
+            """Senza reset_peak (python < 3.9) il picco e' quello del processo"""
+            entry['overlap'] = True
+        active.append(entry)
+    return entry
+
+
+def stop_tracing(entry):
+    """Picco della fase, None se la fase si e' sovrapposta ad altre"""
+    with metrics_lock:
+        tracemalloc_state['active'].remove(entry)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc_state['peak'] = max(tracemalloc_state['peak'], peak)
+    return None if entry['overlap'] else peak
+
+
+def process_record():
+    return {
+        'stage': 'process',
+        'labels': {},
+        'status': 'ok',
+        'seconds': 0.0,
+        'read_bytes': 0,
+        'write_bytes': 0,
+        'peak_rss_bytes': peak_rss(),
+        'tracemalloc_peak_bytes': tracemalloc_peak()
+    }
+
+
+@contextmanager
+def stage(name, **labels):
+    """Misuro il blocco come fase <name>; le etichette (es. run='0') distinguono le ripetizioni"""
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracing = start_tracing()
+    start_io = read_io()
+    start = time.time()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        end = time.time()
+        end_io = read_io()
+        record = {
+            'stage': name,
+            'labels': dict((key, str(value)) for key, value in labels.items()),
+            'status': status,
+            'seconds': end - start,
+            'read_bytes': end_io['rchar'] - start_io['rchar'],
+            'write_bytes': end_io['wchar'] - start_io['wchar'],
+            'peak_rss_bytes': peak_rss()
+        }
+        if tracing:
+            peak = stop_tracing(tracing)
+            if peak is not None:
+                record['tracemalloc_peak_bytes'] = peak
+        with metrics_lock:
+            metrics_records.append(record)
+
+
+def pop_records():
+    """
+    Restituisco e azzero le misure (per passarle dal worker al processo principale),
+    compreso il picco di tracemalloc del processo
+    """
+    with metrics_lock:
+        records = list(metrics_records)
+        del metrics_records[:]
+        if tracemalloc.is_tracing():
+            records.append(process_record())
+            tracemalloc_state['peak'] = 0
+            if hasattr(tracemalloc, 'reset_peak') and not tracemalloc_state['active']:
+                tracemalloc.reset_peak()
+    return records
+
+
+def add_records(records):
+    with metrics_lock:
+        metrics_records.extend(records)
+
+
+def summary():
+    """Misure aggregate per (fase, etichette): somme di tempi e byte, massimo dei picchi"""
+    stages = {}
+    with metrics_lock:
+        records = list(metrics_records)
+        if tracemalloc.is_tracing():
+            records.append(process_record())
+    for record in records:
+        key = (record['stage'], tuple(sorted(record['labels'].items())))
+        if key not in stages:
+            stages[key] = {
+                'stage': record['stage'],
+                'labels': record['labels'],
+                'count': 0,
+                'errors': 0,
+                'seconds': 0.0,
+                'read_bytes': 0,
+                'write_bytes': 0,
+                'peak_rss_bytes': 0
+            }
+        entry = stages[key]
+        entry['count'] += 1
+        entry['errors'] += record['status'] == 'error'
+        entry['seconds'] += record['seconds']
+        entry['read_bytes'] += record['read_bytes']
+        entry['write_bytes'] += record['write_bytes']
+        entry['peak_rss_bytes'] = max(entry['peak_rss_bytes'], record['peak_rss_bytes'])
+        if 'tracemalloc_peak_bytes' in record:
+            entry['tracemalloc_peak_bytes'] = max(
+                entry.get('tracemalloc_peak_bytes', 0), record['tracemalloc_peak_bytes'])
+    return [stages[key] for key in sorted(stages)]
+
+
+def prometheus_labels(labels):
+    return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('"', '\\"')) for key, value in sorted(labels.items())) + '}'
+
+
+def prometheus_text(job, stages, total_seconds):
+    metrics = [
+        ('seconds', 'Durata della fase (s)', 'seconds'),
+        ('read_bytes', 'Byte letti durante la fase', 'read_bytes'),
+        ('write_bytes', 'Byte scritti durante la fase', 'write_bytes'),
+        ('peak_rss_bytes', 'Picco RSS del processo alla fine della fase', 'peak_rss_bytes'),
+        ('tracemalloc_peak_bytes', 'Picco della memoria Python durante la fase', 'tracemalloc_peak_bytes'),
+        ('count', 'Numero di esecuzioni della fase', 'count'),
+        ('errors', 'Esecuzioni della fase terminate con errore', 'errors')
+    ]
+    lines = []
+    for [metric, description, field] in metrics:
+        rows = [entry for entry in stages if field in entry]
+        if not rows:
+            continue
+        lines.append('# HELP {0}{1} {2}'.format(metrics_prefix, metric, description))
+        lines.append('# TYPE {0}{1} gauge'.format(metrics_prefix, metric))
+        for entry in rows:
+            labels = dict(entry['labels'], job=job, stage=entry['stage'])
+            lines.append('{0}{1}{2} {3}'.format(metrics_prefix, metric, prometheus_labels(labels), entry[field]))
+    lines.append('# HELP {0}job_seconds Durata complessiva (s)'.format(metrics_prefix))
+    lines.append('# TYPE {0}job_seconds gauge'.format(metrics_prefix))
+    lines.append('{0}job_seconds{1} {2}'.format(metrics_prefix, prometheus_labels({'job': job}), total_seconds))
+    lines.append('# HELP {0}job_timestamp_seconds Fine dell\'elaborazione (epoch)'.format(metrics_prefix))
+    lines.append('# TYPE {0}job_timestamp_seconds gauge'.format(metrics_prefix))
+    lines.append('{0}job_timestamp_seconds{1} {2}'.format(metrics_prefix, prometheus_labels({'job': job}), int(time.time())))
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(job, directory, total_seconds, extra=None):
+    """Riga JSON in <job>.jsonl e file <job>.prom (sostituito in modo atomico)"""
+    stages = summary()
+    os.makedirs(directory, exist_ok=True)
+
+    line = {
+        'job': job,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'seconds': total_seconds,
+        'peak_rss_bytes': peak_rss(),
+        'stages': stages
+    }
+    if extra:
+        line.update(extra)
+    with open(os.path.join(directory, job + '.jsonl'), 'a') as f:
+        f.write(json.dumps(line, sort_keys=True) + '\n')
+
+    filename = os.path.join(directory, job + '.prom')
+    tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.write(prometheus_text(job, stages, total_seconds))
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Statistiche zonali (comuni, distretti forestali) calcolate insieme ai prodotti.
+
+I poligoni vengono rasterizzati una sola volta sulla griglia del prodotto in un raster
+di etichette (0 fuori da tutte le zone, n per la zona n) salvato in cache e riusato
+finche' non cambiano lo shapefile o la griglia. Per ogni prodotto le frequenze delle
+classi per zona si ottengono con un solo np.bincount sull'array ancora in memoria.
+
+Le zone si indicano come nome=file[:campo], es. comuni=comuni.shp:NOME,distretti=distretti.shp:ID;
+senza campo le zone sono identificate dal FID.
+"""
+
+import os
+import csv
+import json
+import hashlib
+import threading
+import numpy as np
+from osgeo import gdal, ogr
+
+zones_version = 1
+
+
+def parse_zones(value):
+    """'nome=file[:campo],...' -> {nome: (file, campo)}"""
+    zones = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        [name, source] = item.split('=', 1)
+        if ':' in source:
+            [filename, field] = source.rsplit(':', 1)
+        else:
+            [filename, field] = [source, None]
+        zones[name] = (filename, field)
+    return zones
+
+
+def label_cache_filename(cache_dir, filename, field, geotransform, shape, projection):
+    """La chiave comprende dimensione e data del vettoriale: uno shapefile aggiornato invalida la cache"""
+    identity = []
+    base = os.path.splitext(filename)[0]
+    for ext in ('.shp', '.dbf', '.gpkg', '.geojson'):
+        if os.path.exists(base + ext):
+            stat = os.stat(base + ext)
+            identity.append([ext, stat.st_size, stat.st_mtime_ns])
+    key = json.dumps([zones_version, os.path.abspath(filename), field, identity,
+                      list(geotransform), list(shape), projection], sort_keys=True)
+    return os.path.join(cache_dir, 'zones_' + hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+
+def rasterize_zones(filename, field, geotransform, shape, projection):
+    """Etichette int32 sulla griglia e nomi delle zone (indice n -> zona n)"""
+    source = ogr.Open(filename)
+    if source is None:
+        raise IOError('Impossibile aprire ' + filename)
+    layer = source.GetLayer(0)
+
+    """Copia in memoria con il campo intero 'zone': RasterizeLayer riproietta sul sistema del raster"""
+    memory = ogr.GetDriverByName('Memory').CreateDataSource('')
+    zones_layer = memory.CreateLayer('zones', layer.GetSpatialRef(), ogr.wkbMultiPolygon)
+    zones_layer.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+    names = ['']
+    for feature in layer:
+        names.append(str(feature.GetField(field)) if field else str(feature.GetFID()))
+        zone = ogr.Feature(zones_layer.GetLayerDefn())
+        zone.SetGeometry(feature.GetGeometryRef())
+        zone.SetField('zone', len(names) - 1)
+        zones_layer.CreateFeature(zone)
+
+    [rows, cols] = shape
+    dataset = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Int32)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(projection)
+    gdal.RasterizeLayer(dataset, [1], zones_layer, options=['ATTRIBUTE=zone'])
+    labels = dataset.GetRasterBand(1).ReadAsArray().astype(np.int32)
+    dataset = None
+    source = None
+    return labels, names
+
+
+def load_zones(cache_dir, filename, field, geotransform, shape, projection):
+    """Raster delle etichette dalla cache, rasterizzato e salvato se manca"""
+    cache_filename = label_cache_filename(cache_dir, filename, field, geotransform, shape, projection)
+    if os.path.exists(cache_filename):
+        with np.load(cache_filename) as cached:
+            return cached['labels'], list(cached['names'])
+
+    [labels, names] = rasterize_zones(filename, field, geotransform, shape, projection)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_filename = cache_filename + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp.npz'
+    np.savez(tmp_filename, labels=labels, names=np.array(names))
+    os.replace(tmp_filename, cache_filename)
+    return labels, names
+
+
+def pixel_area(geotransform, shape, geographic):
+    """Area dei pixel in km2: costante per le griglie proiettate, per riga (cos lat) in lon/lat"""
+    if not geographic:
+        return abs(geotransform[1] * geotransform[5]) / 1e6
+    [rows, cols] = shape
+    lat = geotransform[3] + (np.arange(rows) + 0.5) * geotransform[5]
+    row_area = abs(geotransform[1] * geotransform[5]) * 111.32 ** 2 * np.cos(np.radians(lat))
+    return np.repeat(row_area[:, None], cols, axis=1)
+
+
+def zonal_counts(labels, nzones, values, nclasses):
+    """Pixel per (zona, classe) con un solo bincount; values interi in [0, nclasses)"""
+    index = labels.astype(np.int64) * nclasses + values
+    return np.bincount(index.ravel(), minlength=nzones * nclasses).reshape(nzones, nclasses)
+
+
+def zonal_areas(labels, nzones, values, nclasses, area):
+    """Area (km2) per (zona, classe) con i pesi dell'area dei pixel"""
+    index = labels.astype(np.int64) * nclasses + values
+    return np.bincount(index.ravel(), weights=area.ravel(),
+                       minlength=nzones * nclasses).reshape(nzones, nclasses)
+
+
+def write_zonal_csv(filename, names, counts, areas, classes):
+    """Una riga per zona: pixel, area (km2) e frazione dell'area per classe"""
+    tmp_filename = filename + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+    with open(tmp_filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        header = ['zone', 'pixels', 'area_km2']
+        for value, name in classes:
+            header += [name + '_pixels', name + '_area_km2', name + '_fraction']
+        writer.writerow(header)
+        for n in range(1, len(names)):
+            total = counts[n].sum()
+            total_area = areas[n].sum()
+            row = [names[n], int(total), round(float(total_area), 4)]
+            for value, name in classes:
+                row += [
+                    int(counts[n, value]),
+                    round(float(areas[n, value]), 4),
+                    round(float(areas[n, value] / total_area), 6) if total_area else ''
+                ]
+            writer.writerow(row)
+    os.replace(tmp_filename, filename)
+
+
+def zonal_stats(zones, cache_dir, values, classes, geotransform, projection, filename_pattern, geographic=False):
+    """
+    Statistiche del prodotto <values> per ogni insieme di zone.
+    classes: [(valore, nome)] con valori interi in [0, nclasses); filename_pattern contiene {zones}.
+    """
+    shape = values.shape
+    nclasses = max(value for value, name in classes) + 1
+    values = np.clip(values, 0, nclasses - 1).astype(np.int64)
+    area = pixel_area(geotransform, shape, geographic)
+    for zones_name, [filename, field] in zones.items():
+        [labels, names] = load_zones(cache_dir, filename, field, geotransform, shape, projection)
+        counts = zonal_counts(labels, len(names), values, nclasses)
+        if np.isscalar(area):
+            areas = counts * area
+        else:
+            areas = zonal_areas(labels, len(names), values, nclasses, area)
+        write_zonal_csv(filename_pattern.format(zones=zones_name), names, counts, areas, classes)